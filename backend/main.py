@@ -1,6 +1,6 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response, JSONResponse
 from pydantic import BaseModel
 import numpy as np
 import cv2
@@ -8,15 +8,37 @@ from io import BytesIO
 from collections import Counter
 from datetime import datetime, timedelta, timezone
 import logging
-from scipy import ndimage
 import time
 import os
-import joblib
 import uuid
-import pandas as pd
+import json
+import asyncio
+import multiprocessing
+import zipfile
+import zlib
+import threading
+import hashlib
+import sqlite3
+import queue
+import atexit
+import csv
+import bisect
+import itertools
+from io import StringIO
+try:
+    import fcntl
+except ImportError:  # Windows: sem trava entre processos
+    fcntl = None
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 logging.basicConfig(level=logging.INFO) # Logs INFO e acima serão exibidos
 logger = logging.getLogger(__name__)
+# Os detalhes de cada etapa de cada requisição são DEBUG; LOG_VERBOSO=1 volta a exibi-los
+LOG_VERBOSO = os.getenv("LOG_VERBOSO", "0") == "1"
+logger.setLevel(logging.DEBUG if LOG_VERBOSO else logging.INFO)
 
 app = FastAPI(
     title="API de Contagem de Colônias",
@@ -43,7 +65,13 @@ app.add_middleware(
         "X-Feedback-Area-Amostrada-Cm2",
         "X-Feedback-Densidade-Colonias-Cm2",
         "X-Feedback-Estimativa-Total-Colonias",
-        "X-Feedback-Filtradas-Tamanho-Maximo"
+        "X-Feedback-Filtradas-Tamanho-Maximo",
+        "X-Feedback-Confianca-Placa",
+        "X-Cache",
+        "X-Motor-Segmentacao",
+        "X-Placas-Detectadas",
+        "X-Modelo-Cor",
+        "Server-Timing"
     ]
 )
 
@@ -51,32 +79,573 @@ AREA_PADRAO_PLACA_CM2 = 57.5  # cm²
 MAX_IMAGE_DIM = 1200
 MIN_PERIMETER_THRESHOLD = 5.0 # pixels
 MAX_COLONY_RADIUS_FACTOR_OF_PETRI_MARGIN = 0.2 # 20% do raio da margem da placa
+# Decodifica JPEGs grandes já reduzidos (1/2, 1/4, 1/8) pelo libjpeg antes do resize final
+JPEG_REDUCED_DECODE = os.getenv("JPEG_REDUCED_DECODE", "1") != "0"
+# Detecção da placa: "piramide" (Hough reduzido + refinamento) ou "completo" (Hough na imagem inteira)
+PLATE_DETECTION_MODE = os.getenv("PLATE_DETECTION_MODE", "piramide")
+PLATE_DETECTION_COARSE_DIM = int(os.getenv("PLATE_DETECTION_COARSE_DIM", "300"))
+
+# Execução do pipeline fora do event loop. PROCESS_POOL_WORKERS=0 usa uma thread em vez de processos.
+PROCESS_POOL_WORKERS = int(os.getenv("PROCESS_POOL_WORKERS", os.cpu_count() or 1))
+PROCESS_POOL_MAX_QUEUE = int(os.getenv("PROCESS_POOL_MAX_QUEUE", max(1, PROCESS_POOL_WORKERS) * 2))
+PROCESS_JOB_TIMEOUT_S = float(os.getenv("PROCESS_JOB_TIMEOUT_S", "120"))
+PROCESS_POOL_RETRY_AFTER_S = int(os.getenv("PROCESS_POOL_RETRY_AFTER_S", "5"))
+OPENCV_THREADS_PER_WORKER = int(os.getenv(
+    "OPENCV_THREADS_PER_WORKER", max(1, (os.cpu_count() or 1) // max(1, PROCESS_POOL_WORKERS))
+))
+
+# Modo de alta resolução (alta_resolucao=true): segmentação na resolução nativa em blocos sobrepostos.
+# TILE_SIZE é o lado do núcleo de cada bloco e TILE_OVERLAP a folga extra (px nativos) para colônias
+# que cruzam a borda; a memória por bloco é proporcional a (TILE_SIZE + 2 * sobreposição)².
+TILE_SIZE = int(os.getenv("TILE_SIZE", "1024"))
+TILE_OVERLAP = int(os.getenv("TILE_OVERLAP", "128"))
+TILE_WORKERS = int(os.getenv("TILE_WORKERS", OPENCV_THREADS_PER_WORKER))
+TILE_DEDUP_IOU = float(os.getenv("TILE_DEDUP_IOU", "0.5"))
+
+# Motores de segmentação (motor_segmentacao): "watershed" é o pipeline completo; "componentes" trata cada
+# componente conexo da limiarização como uma colônia (uma semente) e só separa os que parecem fundidos,
+# isto é, com área maior que COMPONENTES_RAZAO_FUSAO vezes a do maior círculo inscrito.
+# Acima de COMPONENTES_RAZAO_MAX o componente é fino/extenso demais para ser um aglomerado de colônias
+# (borda da máscara da placa, riscos, reflexos) e segue inteiro para os filtros, sem ser separado.
+MOTORES_SEGMENTACAO = ("watershed", "componentes")
+COMPONENTES_RAZAO_FUSAO = float(os.getenv("COMPONENTES_RAZAO_FUSAO", "1.45"))
+COMPONENTES_RAZAO_MAX = float(os.getenv("COMPONENTES_RAZAO_MAX", "30"))
 
-# Carrega modelo de classificação de cor, se disponível
+# Várias placas na mesma foto (POST /contar_placas/, bandejas/racks): são aceitos círculos com raio de
+# pelo menos PLACAS_RAIO_MIN_FRAC do menor lado, confiança >= PLACAS_CONFIANCA_MIN e sem sobreposição;
+# cada placa é contada em paralelo por até PLACAS_WORKERS threads dentro do mesmo worker.
+PLACAS_MAX = int(os.getenv("PLACAS_MAX", "6"))
+PLACAS_RAIO_MIN_FRAC = float(os.getenv("PLACAS_RAIO_MIN_FRAC", "0.08"))
+PLACAS_CONFIANCA_MIN = float(os.getenv("PLACAS_CONFIANCA_MIN", "0.5"))
+PLACAS_WORKERS = int(os.getenv("PLACAS_WORKERS", OPENCV_THREADS_PER_WORKER))
+MODOS_IMAGEM_PLACAS = ("combinada", "por_placa", "nenhuma")
+
+# Carrega modelo de classificação de cor, se disponível. Por padrão o carregamento (joblib/scikit-learn)
+# ocorre em segundo plano e as regras HSV (ou a LUT) são usadas até ele terminar.
+# O servidor verifica o arquivo do modelo e a LUT a cada COLOR_MODEL_WATCH_S segundos (0 desativa) e
+# também recarrega por POST /modelo_cor/recarregar. O novo modelo é carregado em segundo plano,
+# conferido nas sondas e só então trocado de uma vez; se falhar, o modelo atual continua ativo.
 COLOR_MODEL_PATH = os.path.join(os.path.dirname(__file__), "color_model.pkl")
-try:
-    color_model = joblib.load(COLOR_MODEL_PATH)
-    logger.info(f"Modelo de cor carregado de {COLOR_MODEL_PATH}")
-except Exception as e:
-    color_model = None
-    logger.warning(
-        f"Modelo de cor não encontrado ou falhou ao carregar: {e}. Usando regras HSV."
-    )
+COLOR_MODEL_BACKGROUND_LOAD = os.getenv("COLOR_MODEL_BACKGROUND_LOAD", "1") != "0"
+COLOR_MODEL_WATCH_S = float(os.getenv("COLOR_MODEL_WATCH_S", "5"))
+COLOR_MODEL_PROBE_PATH = os.getenv(
+    "COLOR_MODEL_PROBE_PATH", os.path.join(os.path.dirname(__file__), "color_model_probe.csv")
+)
+COLOR_MODEL_PROBE_MIN_ACC = float(os.getenv("COLOR_MODEL_PROBE_MIN_ACC", "0.9"))
+VERSAO_REGRAS_HSV = "regras_hsv"
+_modelo_cor_carregado = threading.Event()
+_ndimage = None
+
+
+def obter_ndimage():
+    """Importa scipy.ndimage apenas quando necessário (a importação custa ~0,25 s)."""
+    global _ndimage
+    if _ndimage is None:
+        from scipy import ndimage
+        _ndimage = ndimage
+    return _ndimage
+
+
+# Tabela de consulta (LUT) opcional com a classe pré-calculada para cada (h, s, v) do OpenCV
+COLOR_LUT_PATH = os.path.join(os.path.dirname(__file__), "color_model_lut.npy")
+COLOR_LUT_CLASSES_PATH = os.path.join(os.path.dirname(__file__), "color_model_lut.json")
+COLOR_LUT_SHAPE = (180, 256, 256)
+
+
+def carregar_lut_cor(versao_modelo=None):
+    """Mapeia a LUT de cor em memória se ela existir e não for mais antiga que o modelo.
+
+    Retorna (lut, classes, versão do modelo compilado). Com ``versao_modelo``, uma LUT compilada a partir
+    de outra versão do modelo é ignorada.
+    """
+    if not (os.path.exists(COLOR_LUT_PATH) and os.path.exists(COLOR_LUT_CLASSES_PATH)):
+        return None, None, None
+    if os.path.exists(COLOR_MODEL_PATH) and os.path.getmtime(COLOR_MODEL_PATH) > os.path.getmtime(COLOR_LUT_PATH):
+        logger.warning(f"LUT de cor em {COLOR_LUT_PATH} é mais antiga que {COLOR_MODEL_PATH}; ignorando LUT.")
+        return None, None, None
+    try:
+        lut = np.load(COLOR_LUT_PATH, mmap_mode="r")
+        with open(COLOR_LUT_CLASSES_PATH, encoding="utf-8") as f:
+            metadados = json.load(f)
+        classes = metadados["classes"]
+        versao_lut = metadados.get("versao_modelo")
+        if lut.shape != COLOR_LUT_SHAPE or lut.dtype != np.uint8:
+            raise ValueError(f"formato inesperado {lut.shape} {lut.dtype}")
+        if versao_modelo is not None and versao_lut is not None and versao_lut != versao_modelo:
+            logger.warning(f"LUT de cor compilada do modelo {versao_lut}, não do {versao_modelo}; ignorando LUT.")
+            return None, None, None
+        logger.info(f"LUT de cor carregada de {COLOR_LUT_PATH} ({len(classes)} classes)")
+        return lut, classes, versao_lut
+    except Exception as e:
+        logger.warning(f"Falha ao carregar LUT de cor: {e}. Usando predição direta.")
+        return None, None, None
+
+
+class ModeloCor:
+    """Classificador de cor ativo. É sempre trocado inteiro (modelo, LUT e versão juntos), nunca alterado."""
+
+    def __init__(self, modelo=None, lut=None, lut_classes=None, versao=VERSAO_REGRAS_HSV, status="carregando"):
+        self.modelo = modelo
+        self.lut = lut
+        self.lut_classes = lut_classes
+        self.versao = versao
+        self.status = status
+
+
+def versao_modelo_cor(conteudo):
+    """Versão do modelo: início do SHA-256 do arquivo, igual em todos os processos que o carregarem."""
+    return hashlib.sha256(conteudo).hexdigest()[:12]
+
+
+def versao_arquivo_modelo(caminho):
+    with open(caminho, "rb") as f:
+        return versao_modelo_cor(f.read())
+
+
+def assinatura_arquivos_modelo_cor():
+    """(mtime, tamanho) do modelo e da LUT; muda quando algum deles é substituído."""
+    assinatura = []
+    for caminho in (COLOR_MODEL_PATH, COLOR_LUT_PATH, COLOR_LUT_CLASSES_PATH):
+        try:
+            estado = os.stat(caminho)
+            assinatura.append((estado.st_mtime_ns, estado.st_size))
+        except OSError:
+            assinatura.append(None)
+    return tuple(assinatura)
+
+
+# Sondas fixas cobrindo o espaço HSV do OpenCV (12 x 6 x 6 pontos)
+SONDAS_MODELO_COR = np.stack(np.meshgrid(
+    np.arange(0, 180, 15), np.arange(0, 256, 51), np.arange(0, 256, 51), indexing="ij"
+), axis=-1).reshape(-1, 3).astype(np.uint8)
+
+
+def validar_modelo_cor(modelo):
+    """Confere um modelo recém-carregado antes de ativá-lo; levanta ValueError se ele não servir.
+
+    O modelo precisa prever uma classe por cor nas SONDAS_MODELO_COR e, se COLOR_MODEL_PROBE_PATH
+    existir (CSV h,s,v,label), acertar ao menos COLOR_MODEL_PROBE_MIN_ACC dessas cores.
+    """
+    previstas = np.asarray(modelo.predict(SONDAS_MODELO_COR))
+    if previstas.shape != (len(SONDAS_MODELO_COR),):
+        raise ValueError(f"predição com formato {previstas.shape} para {len(SONDAS_MODELO_COR)} sondas")
+    if not os.path.exists(COLOR_MODEL_PROBE_PATH):
+        return
+    with open(COLOR_MODEL_PROBE_PATH, newline="", encoding="utf-8") as f:
+        linhas = list(csv.DictReader(f))
+    if not linhas:
+        return
+    hsv = np.array([[int(linha["h"]), int(linha["s"]), int(linha["v"])] for linha in linhas], dtype=np.uint8)
+    acertos = np.mean(np.asarray(modelo.predict(hsv)).astype(str) == np.array([linha["label"] for linha in linhas]))
+    if acertos < COLOR_MODEL_PROBE_MIN_ACC:
+        raise ValueError(
+            f"acerto de {acertos:.0%} nas sondas de {COLOR_MODEL_PROBE_PATH}, abaixo de {COLOR_MODEL_PROBE_MIN_ACC:.0%}"
+        )
+
+
+# A LUT já pode ser usada enquanto o modelo carrega
+_lut_inicial, _classes_lut_inicial, _versao_lut_inicial = carregar_lut_cor()
+modelo_cor = ModeloCor(
+    lut=_lut_inicial,
+    lut_classes=_classes_lut_inicial,
+    versao=_versao_lut_inicial or (
+        versao_arquivo_modelo(COLOR_MODEL_PATH) if _lut_inicial is not None and os.path.exists(COLOR_MODEL_PATH)
+        else VERSAO_REGRAS_HSV
+    ),
+)
+_assinatura_modelo_cor = None
+_erro_modelo_cor = None
+_lock_carga_modelo_cor = threading.Lock()
+
+
+def carregar_modelo_cor(inicial=False):
+    """Carrega e valida o modelo e a LUT em disco e os ativa de uma vez.
+
+    Retorna (ativado, versão ou mensagem de erro). Fora da carga ``inicial`` um modelo que falha ao
+    carregar ou na validação é descartado e o classificador atual continua em uso.
+    """
+    global modelo_cor, _assinatura_modelo_cor, _erro_modelo_cor
+    with _lock_carga_modelo_cor:
+        assinatura = assinatura_arquivos_modelo_cor()
+        inicio = time.time()
+        try:
+            if inicial or os.path.exists(COLOR_MODEL_PATH):
+                # Lido uma vez só, para a versão ser a do conteúdo carregado mesmo que o arquivo mude no meio
+                with open(COLOR_MODEL_PATH, "rb") as f:
+                    conteudo = f.read()
+                import joblib
+                modelo = joblib.load(BytesIO(conteudo))
+                validar_modelo_cor(modelo)
+                versao, status = versao_modelo_cor(conteudo), "carregado"
+            else:
+                modelo, versao, status = None, VERSAO_REGRAS_HSV, "indisponivel"
+            _erro_modelo_cor = None
+        except Exception as e:
+            # A mesma assinatura não é tentada de novo pelo observador; só um arquivo novo
+            _assinatura_modelo_cor = assinatura
+            _erro_modelo_cor = str(e)
+            if not inicial:
+                logger.error(f"Novo modelo de cor rejeitado: {e}. Mantendo o modelo {modelo_cor.versao}.")
+                return False, _erro_modelo_cor
+            logger.warning(
+                f"Modelo de cor não encontrado ou falhou ao carregar: {e}. Usando regras HSV."
+            )
+            modelo, versao, status = None, VERSAO_REGRAS_HSV, "indisponivel"
+        lut, classes, versao_lut = carregar_lut_cor(versao if modelo is not None else None)
+        if modelo is None and lut is not None:
+            versao = versao_lut or "lut"
+        modelo_cor = ModeloCor(modelo, lut, classes, versao, status)
+        _assinatura_modelo_cor = assinatura
+    if modelo is not None:
+        logger.info(f"Modelo de cor {versao} carregado de {COLOR_MODEL_PATH} em {time.time() - inicio:.2f}s")
+    return True, versao
+
+
+def _carga_inicial_modelo_cor():
+    try:
+        carregar_modelo_cor(inicial=True)
+    finally:
+        _modelo_cor_carregado.set()
+
+
+def aguardar_modelo_cor(timeout=None):
+    """Bloqueia até o fim da tentativa de carregar o modelo de cor (útil em scripts)."""
+    return _modelo_cor_carregado.wait(timeout)
+
+
+def _carregar_em_segundo_plano():
+    _carga_inicial_modelo_cor()
+    obter_ndimage()
+
+
+if COLOR_MODEL_BACKGROUND_LOAD:
+    threading.Thread(target=_carregar_em_segundo_plano, name="carregar-modelo-cor", daemon=True).start()
+else:
+    _carga_inicial_modelo_cor()
+
+# Armazena temporariamente dados das colônias processadas para coleta de feedback.
+# TOKEN_STORE_BACKEND=sqlite permite compartilhar os tokens entre workers do uvicorn.
+TOKEN_STORE_BACKEND = os.getenv("TOKEN_STORE_BACKEND", "memoria")
+TOKEN_STORE_PATH = os.getenv("TOKEN_STORE_PATH", os.path.join(os.path.dirname(__file__), "feedback_tokens.sqlite3"))
+TOKEN_STORE_MAX_ENTRIES = int(os.getenv("TOKEN_STORE_MAX_ENTRIES", "10000"))
+TOKEN_STORE_TTL_S = float(os.getenv("TOKEN_STORE_TTL_S", "86400"))
+
+# Registro compacto de colônia: 16 bytes em vez de um dict Python por colônia
+COLONIA_DTYPE = np.dtype([
+    ("h", "u1"), ("s", "u1"), ("v", "u1"), ("pred", "u1"),
+    ("cx", "<i4"), ("cy", "<i4"), ("r", "<i4"),
+])
+
+
+def compactar_colonias(colony_data):
+    """Converte a lista de colônias em (classes, bytes de um array estruturado COLONIA_DTYPE, versão do modelo).
+
+    Todas as colônias de uma análise são classificadas pelo mesmo modelo, então a versão é guardada uma vez.
+    """
+    classes = sorted({c["pred"] for c in colony_data})
+    indice_classe = {classe: i for i, classe in enumerate(classes)}
+    registros = np.zeros(len(colony_data), dtype=COLONIA_DTYPE)
+    for i, c in enumerate(colony_data):
+        registros[i] = (c["h"], c["s"], c["v"], indice_classe[c["pred"]], c["cx"], c["cy"], c["r"])
+    modelo = colony_data[0].get("modelo_cor") if colony_data else None
+    return classes, registros.tobytes(), modelo
+
+
+def expandir_colonias(classes, dados, modelo=None):
+    registros = np.frombuffer(dados, dtype=COLONIA_DTYPE)
+    extras = {} if modelo is None else {"modelo_cor": modelo}
+    return [
+        {
+            "h": int(reg["h"]),
+            "s": int(reg["s"]),
+            "v": int(reg["v"]),
+            "pred": classes[reg["pred"]],
+            "cx": int(reg["cx"]),
+            "cy": int(reg["cy"]),
+            "r": int(reg["r"]),
+            **extras,
+        }
+        for reg in registros
+    ]
 
-# Armazena temporariamente dados das colônias processadas para coleta de feedback
-PENDING_FEEDBACK = {}
+
+class TokensFeedbackMemoria:
+    """Tokens de feedback no próprio processo, em ordem LRU, com limite de entradas e expiração por TTL.
+
+    O TTL conta a partir da criação; como um acesso move o token para o fim, tokens vencidos que não
+    estão no início da fila são descartados na leitura.
+    """
+
+    def __init__(self, max_entradas, ttl_s):
+        self.max_entradas = max_entradas
+        self.ttl_s = ttl_s
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expirar(self, agora):
+        while self._itens:
+            token, (criado, *_) = next(iter(self._itens.items()))
+            if agora - criado <= self.ttl_s and len(self._itens) <= self.max_entradas:
+                break
+            del self._itens[token]
+
+    def armazenar(self, token, colony_data):
+        classes, dados, modelo = compactar_colonias(colony_data)
+        with self._lock:
+            agora = time.time()
+            self._itens[token] = (agora, classes, dados, modelo)
+            self._expirar(agora)
+
+    def obter(self, token):
+        with self._lock:
+            agora = time.time()
+            self._expirar(agora)
+            item = self._itens.get(token)
+            if item is None:
+                return None
+            if agora - item[0] > self.ttl_s:
+                del self._itens[token]
+                return None
+            self._itens.move_to_end(token)
+        return expandir_colonias(*item[1:])
+
+    def remover(self, token):
+        with self._lock:
+            self._itens.pop(token, None)
+
+    def fechar(self):
+        pass
+
+    def __len__(self):
+        return len(self._itens)
+
+
+class TokensFeedbackSQLite:
+    """Tokens de feedback em um arquivo SQLite (WAL), compartilhado entre processos."""
+
+    def __init__(self, caminho, max_entradas, ttl_s):
+        self.caminho = caminho
+        self.max_entradas = max_entradas
+        self.ttl_s = ttl_s
+        self._local = threading.local()
+        # Todas as conexões abertas (uma por thread), para fechar no encerramento
+        self._conexoes = []
+        self._lock_conexoes = threading.Lock()
+        with self._conexao() as conexao:
+            conexao.execute(
+                "CREATE TABLE IF NOT EXISTS tokens ("
+                "token TEXT PRIMARY KEY, criado REAL NOT NULL, classes TEXT NOT NULL, dados BLOB NOT NULL)"
+            )
+            conexao.execute("CREATE INDEX IF NOT EXISTS tokens_criado ON tokens (criado)")
+
+    def _conexao(self):
+        conexao = getattr(self._local, "conexao", None)
+        if conexao is None:
+            # check_same_thread=False só para fechar() poder fechá-la; cada conexão é usada por uma thread
+            conexao = sqlite3.connect(self.caminho, timeout=10, check_same_thread=False)
+            conexao.execute("PRAGMA journal_mode=WAL")
+            conexao.execute("PRAGMA synchronous=NORMAL")
+            self._local.conexao = conexao
+            with self._lock_conexoes:
+                self._conexoes.append(conexao)
+        return conexao
+
+    def fechar(self):
+        """Fecha as conexões de todas as threads; uma thread que voltar a usar o store abre outra."""
+        with self._lock_conexoes:
+            conexoes, self._conexoes = self._conexoes, []
+        for conexao in conexoes:
+            try:
+                conexao.close()
+            except sqlite3.Error as e:
+                logger.warning(f"Falha ao fechar conexão do store de tokens: {e}")
+        self._local = threading.local()
+
+    def armazenar(self, token, colony_data):
+        classes, dados, modelo = compactar_colonias(colony_data)
+        agora = time.time()
+        with self._conexao() as conexao:
+            # A coluna classes guarda {"classes", "modelo_cor"}; tokens antigos têm só a lista de classes
+            conexao.execute(
+                "INSERT OR REPLACE INTO tokens (token, criado, classes, dados) VALUES (?, ?, ?, ?)",
+                (token, agora, json.dumps({"classes": classes, "modelo_cor": modelo}, ensure_ascii=False), dados),
+            )
+            conexao.execute("DELETE FROM tokens WHERE criado < ?", (agora - self.ttl_s,))
+            conexao.execute(
+                "DELETE FROM tokens WHERE token IN ("
+                "SELECT token FROM tokens ORDER BY criado DESC LIMIT -1 OFFSET ?)",
+                (self.max_entradas,),
+            )
+
+    def obter(self, token):
+        linha = self._conexao().execute(
+            "SELECT classes, dados FROM tokens WHERE token = ? AND criado >= ?",
+            (token, time.time() - self.ttl_s),
+        ).fetchone()
+        if linha is None:
+            return None
+        cabecalho = json.loads(linha[0])
+        if isinstance(cabecalho, list):
+            return expandir_colonias(cabecalho, linha[1])
+        return expandir_colonias(cabecalho["classes"], linha[1], cabecalho["modelo_cor"])
+
+    def remover(self, token):
+        with self._conexao() as conexao:
+            conexao.execute("DELETE FROM tokens WHERE token = ?", (token,))
+
+    def __len__(self):
+        return self._conexao().execute("SELECT COUNT(*) FROM tokens").fetchone()[0]
+
+
+def criar_token_store():
+    if TOKEN_STORE_BACKEND == "sqlite":
+        logger.info(f"Tokens de feedback em SQLite: {TOKEN_STORE_PATH}")
+        return TokensFeedbackSQLite(TOKEN_STORE_PATH, TOKEN_STORE_MAX_ENTRIES, TOKEN_STORE_TTL_S)
+    return TokensFeedbackMemoria(TOKEN_STORE_MAX_ENTRIES, TOKEN_STORE_TTL_S)
+
+
+PENDING_FEEDBACK = criar_token_store()
 
 ANALYSIS_LOG_PATH = os.path.join(os.path.dirname(__file__), "analysis_hsv_log.csv")
+FEEDBACK_LOG_PATH = os.path.join(os.path.dirname(__file__), "feedback_data.csv")
+ANALYSIS_LOG_COLUMNS = ["h", "s", "v", "label"]
+FEEDBACK_LOG_COLUMNS = ["h", "s", "v", "label", "data", "hora"]
+
+# Gravação dos logs fora do caminho da requisição, em lotes por tamanho ou intervalo.
+# LOG_FORMATS aceita "csv", "npy" e "parquet" (este último requer pyarrow).
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "500"))
+LOG_FLUSH_INTERVAL_S = float(os.getenv("LOG_FLUSH_INTERVAL_S", "2"))
+LOG_FORMATS = {f.strip() for f in os.getenv("LOG_FORMATS", "csv").split(",") if f.strip()}
+
+
+class GravadorLogs:
+    """Fila de registros gravada em lote por uma thread de fundo.
+
+    Cada lote é anexado ao CSV com uma única escrita sob trava de arquivo (seguro com vários
+    workers) e, opcionalmente, salvo como arquivo colunar em ``<log>_partes/`` via renomeação atômica.
+    """
+
+    _FIM = object()
+
+    def __init__(self, tamanho_lote, intervalo_s, formatos):
+        self.tamanho_lote = tamanho_lote
+        self.intervalo_s = intervalo_s
+        self.formatos = formatos
+        self._fila = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._sequencia = 0
+
+    def registrar(self, caminho, colunas, linhas):
+        if not linhas:
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._executar, name="gravador-logs", daemon=True)
+                self._thread.start()
+        self._fila.put((caminho, colunas, linhas))
+
+    def _executar(self):
+        pendentes = {}
+        quantidade = 0
+        ultimo_envio = time.monotonic()
+        while True:
+            espera = max(0.0, self.intervalo_s - (time.monotonic() - ultimo_envio))
+            try:
+                item = self._fila.get(timeout=espera)
+            except queue.Empty:
+                item = None
+            if item is self._FIM:
+                self._gravar(pendentes)
+                return
+            if item is not None:
+                caminho, colunas, linhas = item
+                pendentes.setdefault(caminho, (colunas, []))[1].extend(linhas)
+                quantidade += len(linhas)
+            if quantidade >= self.tamanho_lote or time.monotonic() - ultimo_envio >= self.intervalo_s:
+                self._gravar(pendentes)
+                pendentes = {}
+                quantidade = 0
+                ultimo_envio = time.monotonic()
+
+    def _gravar(self, pendentes):
+        for caminho, (colunas, linhas) in pendentes.items():
+            if not linhas:
+                continue
+            try:
+                if "csv" in self.formatos:
+                    self._gravar_csv(caminho, colunas, linhas)
+                if "npy" in self.formatos or "parquet" in self.formatos:
+                    self._gravar_colunar(caminho, colunas, linhas)
+            except Exception:
+                logger.exception(f"Falha ao gravar {len(linhas)} registros em {caminho}")
+
+    @staticmethod
+    def _gravar_csv(caminho, colunas, linhas):
+        buffer = StringIO()
+        escritor = csv.DictWriter(buffer, fieldnames=colunas, lineterminator="\n", extrasaction="ignore")
+        for linha in linhas:
+            escritor.writerow(linha)
+        with open(caminho, "a", newline="", encoding="utf-8") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.fstat(f.fileno()).st_size == 0:
+                    f.write(",".join(colunas) + "\n")
+                f.write(buffer.getvalue())
+                f.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _gravar_colunar(self, caminho, colunas, linhas):
+        diretorio = os.path.splitext(caminho)[0] + "_partes"
+        os.makedirs(diretorio, exist_ok=True)
+        self._sequencia += 1
+        base = os.path.join(diretorio, f"{int(time.time() * 1000)}-{os.getpid()}-{self._sequencia}")
+        if "npy" in self.formatos:
+            campos = []
+            for coluna in colunas:
+                valores = [linha[coluna] for linha in linhas]
+                if all(isinstance(v, (int, np.integer)) for v in valores):
+                    campos.append((coluna, "<i4"))
+                else:
+                    campos.append((coluna, f"<U{max(1, max(len(str(v)) for v in valores))}"))
+            registros = np.array([tuple(linha[c] for c in colunas) for linha in linhas], dtype=campos)
+            with open(base + ".npy.tmp", "wb") as f:
+                np.save(f, registros)
+            os.replace(base + ".npy.tmp", base + ".npy")
+        if "parquet" in self.formatos:
+            try:
+                import pandas as pd
+                pd.DataFrame(linhas, columns=colunas).to_parquet(base + ".parquet.tmp", index=False)
+            except ImportError:
+                logger.warning("Formato parquet requer pyarrow; gravando apenas os demais formatos.")
+                self.formatos = self.formatos - {"parquet"}
+            else:
+                os.replace(base + ".parquet.tmp", base + ".parquet")
+
+    def encerrar(self, timeout=10):
+        """Grava tudo o que estiver na fila e encerra a thread."""
+        with self._lock:
+            thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        self._fila.put(self._FIM)
+        thread.join(timeout)
+
+
+gravador_logs = GravadorLogs(LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL_S, LOG_FORMATS)
+atexit.register(gravador_logs.encerrar)
 
 
 def log_analysis_data(colony_data):
     if not colony_data:
         return
-    df = pd.DataFrame([
+    gravador_logs.registrar(ANALYSIS_LOG_PATH, ANALYSIS_LOG_COLUMNS, [
         {"h": c["h"], "s": c["s"], "v": c["v"], "label": c["pred"]}
         for c in colony_data
     ])
-    df.to_csv(ANALYSIS_LOG_PATH, mode="a", header=not os.path.exists(ANALYSIS_LOG_PATH), index=False)
 
 
 def classificar_cor_hsv(hsv_color_mean):
@@ -91,17 +660,126 @@ def classificar_cor_hsv(hsv_color_mean):
         return 'bege'
 
 
-def classificar_cor(hsv_color_mean):
-    """Classifica a cor usando modelo treinado se disponível."""
-    if color_model is not None:
+def classificar_cores(hsv_colonias, classificador=None):
+    """Classifica de uma só vez as cores médias HSV (N x 3) de todas as colônias de uma imagem.
+
+    ``classificador`` é o ModeloCor a usar (padrão: o ativo); quem precisa informar a versão usada
+    deve obtê-lo antes e passá-lo aqui, já que o modelo ativo pode ser trocado a qualquer momento.
+    """
+    classificador = classificador or modelo_cor
+    hsv_colonias = np.asarray(hsv_colonias, dtype=np.uint8).reshape(-1, 3)
+    if len(hsv_colonias) == 0:
+        return []
+    if classificador.lut is not None:
+        indices = classificador.lut[hsv_colonias[:, 0], hsv_colonias[:, 1], hsv_colonias[:, 2]]
+        return [classificador.lut_classes[i] for i in indices]
+    if classificador.modelo is not None:
         try:
-            return color_model.predict([hsv_color_mean])[0]
+            return [str(tipo) for tipo in classificador.modelo.predict(hsv_colonias)]
         except Exception as e:
             logger.warning(f"Falha na predição pelo modelo de cor: {e}. Usando fallback HSV.")
-    return classificar_cor_hsv(hsv_color_mean)
+    return [classificar_cor_hsv(hsv) for hsv in hsv_colonias]
 
-def detectar_placa(img_gray):
-    detection_start_time = time.time()
+
+def compilar_lut_cor(modelo=None):
+    """Avalia o modelo (ou as regras HSV) em todo o espaço HSV do OpenCV.
+
+    Retorna ``(lut, classes)``: ``lut`` é um array uint8 180x256x256 com o índice em
+    ``classes`` da cor prevista para cada (h, s, v).
+    """
+    s_grid, v_grid = np.meshgrid(np.arange(256), np.arange(256), indexing="ij")
+    s_grid, v_grid = s_grid.ravel(), v_grid.ravel()
+    classes = []
+    lut = np.zeros(COLOR_LUT_SHAPE, dtype=np.uint8)
+    for h in range(COLOR_LUT_SHAPE[0]):
+        bloco = np.column_stack([np.full(s_grid.size, h), s_grid, v_grid]).astype(np.uint8)
+        if modelo is not None:
+            previstas = modelo.predict(bloco)
+        else:
+            previstas = [classificar_cor_hsv(hsv) for hsv in bloco]
+        rotulos_bloco, inversos = np.unique(np.asarray(previstas, dtype=str), return_inverse=True)
+        mapa = np.empty(len(rotulos_bloco), dtype=np.uint8)
+        for i, rotulo in enumerate(rotulos_bloco):
+            if rotulo not in classes:
+                if len(classes) > 255:
+                    raise ValueError("A LUT de cor suporta no máximo 256 classes.")
+                classes.append(rotulo)
+            mapa[i] = classes.index(rotulo)
+        lut[h] = mapa[inversos].reshape(256, 256)
+    return lut, classes
+
+
+def salvar_lut_cor(lut, classes, caminho_lut=COLOR_LUT_PATH, caminho_classes=COLOR_LUT_CLASSES_PATH,
+                   versao_modelo=None):
+    np.save(caminho_lut, lut)
+    metadados = {"classes": [str(c) for c in classes]}
+    if versao_modelo is not None:
+        metadados["versao_modelo"] = versao_modelo
+    with open(caminho_classes, "w", encoding="utf-8") as f:
+        json.dump(metadados, f, ensure_ascii=False)
+
+
+def extrair_estatisticas_colonias(markers, img, deslocamento=(0, 0)):
+    """Calcula área, perímetro, círculo envolvente e cor média BGR de todos os rótulos do watershed.
+
+    Cada rótulo é processado apenas no recorte do seu bounding box (``ndimage.find_objects``)
+    e a cor média de todos os rótulos sai de uma única redução com ``np.bincount``,
+    evitando máscaras do tamanho da imagem inteira por colônia. ``deslocamento`` (x, y) é
+    somado aos contornos quando ``markers`` é um recorte da imagem.
+    """
+    rotulos_validos = np.where(markers > 1, markers, 0)
+    n_rotulos = int(rotulos_validos.max()) + 1 if rotulos_validos.size else 1
+    rotulos_planos = rotulos_validos.ravel()
+    contagem_pixels = np.bincount(rotulos_planos, minlength=n_rotulos)
+    somas_bgr = np.stack([
+        np.bincount(rotulos_planos, weights=img[..., canal].ravel(), minlength=n_rotulos)
+        for canal in range(3)
+    ], axis=1)
+
+    altura, largura = markers.shape[:2]
+    rotulos, areas, perimetros, centros_x, centros_y, raios = [], [], [], [], [], []
+    for indice, fatia in enumerate(obter_ndimage().find_objects(rotulos_validos)):
+        marker_val = indice + 1
+        if fatia is None or marker_val <= 1:
+            continue
+        # Margem de 1 px para que o contorno não encoste na borda do recorte
+        y0 = max(fatia[0].start - 1, 0)
+        y1 = min(fatia[0].stop + 1, altura)
+        x0 = max(fatia[1].start - 1, 0)
+        x1 = min(fatia[1].stop + 1, largura)
+        mask_colonia = (markers[y0:y1, x0:x1] == marker_val).astype(np.uint8) * 255
+        contours, _ = cv2.findContours(mask_colonia, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x0 + deslocamento[0], y0 + deslocamento[1]))
+        if not contours:
+            continue
+        cnt = max(contours, key=cv2.contourArea)
+        (cx, cy), radius_colonia_float = cv2.minEnclosingCircle(cnt)
+        rotulos.append(marker_val)
+        areas.append(cv2.contourArea(cnt))
+        perimetros.append(cv2.arcLength(cnt, True))
+        centros_x.append(cx)
+        centros_y.append(cy)
+        raios.append(radius_colonia_float)
+
+    rotulos = np.array(rotulos, dtype=np.int64)
+    if rotulos.size:
+        # Multiplica pelo inverso da contagem como cv2.mean, para truncar para uint8 da mesma forma
+        bgr_medio = somas_bgr[rotulos] * (1.0 / contagem_pixels[rotulos])[:, None]
+    else:
+        bgr_medio = np.zeros((0, 3), dtype=np.float64)
+    return {
+        "rotulo": rotulos,
+        "area": np.array(areas, dtype=np.float64),
+        "perimetro": np.array(perimetros, dtype=np.float64),
+        "cx": np.array(centros_x, dtype=np.float64),
+        "cy": np.array(centros_y, dtype=np.float64),
+        "raio": np.array(raios, dtype=np.float64),
+        "bgr_medio": bgr_medio,
+    }
+
+
+def detectar_placa_hough_completo(img_gray):
+    """Detecção original: HoughCircles na imagem inteira, na resolução de trabalho."""
+    detection_start_time = time.perf_counter()
     img_blur = cv2.medianBlur(img_gray, 5)
     min_dim_img = min(img_gray.shape[0], img_gray.shape[1])
     min_radius_hough = int(min_dim_img * 0.15)
@@ -110,43 +788,238 @@ def detectar_placa(img_gray):
 
     circulos = cv2.HoughCircles(img_blur, cv2.HOUGH_GRADIENT, dp=1.2, minDist=min_dist_hough,
                                  param1=50, param2=30, minRadius=min_radius_hough, maxRadius=max_radius_hough)
-    logger.info(f"Tempo para cv2.HoughCircles: {time.time() - detection_start_time:.4f}s. Parâmetros: minDist={min_dist_hough}, param2=30, minR={min_radius_hough}, maxR={max_radius_hough}")
+    logger.debug("Tempo para cv2.HoughCircles: %.4fs. Parâmetros: minDist=%s, param2=30, minR=%s, maxR=%s",
+                 time.perf_counter() - detection_start_time, min_dist_hough, min_radius_hough, max_radius_hough)
     if circulos is not None:
         circulos = np.uint16(np.around(circulos))
         best_circle = circulos[0][0]
-        logger.info(f"Placa detectada com centro em ({best_circle[0]}, {best_circle[1]}) e raio {best_circle[2]}")
+        logger.debug("Placa detectada com centro em (%s, %s) e raio %s", best_circle[0], best_circle[1], best_circle[2])
         return best_circle
     logger.warning("Nenhuma placa detectada na imagem.")
     return None
 
-def processar_imagem(
-    imagem_bytes: bytes,
-    nome_amostra: str,
-    x_manual=None,
-    y_manual=None,
-    r_manual=None,
-    area_min: float = 10.0,
-    circularidade_min: float = 0.40,
-    max_colony_size_factor: float = MAX_COLONY_RADIUS_FACTOR_OF_PETRI_MARGIN,
-    local_max_filter_size: int = 7,
-    thresh_block_size: int = 41,
-    thresh_c: int = 4,
+
+def confianca_circulo(bordas, x, y, r, tolerancia=2, n_angulos=360):
+    """Fração do perímetro do círculo com borda (Canny) a até ``tolerancia`` px do raio."""
+    angulos = np.linspace(0, 2 * np.pi, n_angulos, endpoint=False)
+    raios = np.arange(r - tolerancia, r + tolerancia + 1, dtype=np.float64)
+    xs = np.rint(x + np.outer(np.cos(angulos), raios)).astype(np.int64)
+    ys = np.rint(y + np.outer(np.sin(angulos), raios)).astype(np.int64)
+    dentro = (xs >= 0) & (xs < bordas.shape[1]) & (ys >= 0) & (ys < bordas.shape[0])
+    suporte = np.zeros(xs.shape, dtype=bool)
+    suporte[dentro] = bordas[ys[dentro], xs[dentro]] > 0
+    return float(suporte.any(axis=1).mean())
+
+
+def detectar_placas_candidatas(
+    img_gray,
+    max_candidatos=1,
+    raio_min_frac=0.15,
+    raio_max_frac=0.50,
+    min_dist_frac=0.5,
 ):
-    total_process_start_time = time.time()
-    logger.info(f"[{nome_amostra}] Iniciando processamento da imagem.")
+    """Detecção em pirâmide: Hough em uma cópia reduzida e refinamento em faixa estreita de raio.
+
+    Retorna até ``max_candidatos`` tuplas ``(x, y, r, confianca)`` na resolução de ``img_gray``,
+    ordenadas pela confiança (fração do perímetro com suporte de bordas).
+    """
+    detection_start_time = time.perf_counter()
+    altura, largura = img_gray.shape[:2]
+    min_dim_img = min(altura, largura)
+    escala = min(1.0, PLATE_DETECTION_COARSE_DIM / min_dim_img)
+    if escala < 1.0:
+        img_reduzida = cv2.resize(img_gray, None, fx=escala, fy=escala, interpolation=cv2.INTER_AREA)
+    else:
+        img_reduzida = img_gray
+    min_dim_reduzida = min(img_reduzida.shape[:2])
+    circulos = cv2.HoughCircles(
+        cv2.medianBlur(img_reduzida, 3), cv2.HOUGH_GRADIENT, dp=1,
+        minDist=max(1, int(min_dim_reduzida * min_dist_frac)),
+        param1=50, param2=20,
+        minRadius=int(min_dim_reduzida * raio_min_frac), maxRadius=int(min_dim_reduzida * raio_max_frac),
+    )
+    logger.debug("Tempo para HoughCircles reduzido (%dx%d): %.4fs",
+                 img_reduzida.shape[1], img_reduzida.shape[0], time.perf_counter() - detection_start_time)
+    if circulos is None:
+        return []
+
+    # Tolerância do refinamento: erro de quantização da escala reduzida mais folga
+    tolerancia = int(np.ceil(2 / escala)) + 3
+    candidatos = []
+    for xc, yc, rc in circulos[0][:max_candidatos]:
+        xc, yc, rc = xc / escala, yc / escala, rc / escala
+        x0 = max(int(xc - rc - tolerancia - 4), 0)
+        y0 = max(int(yc - rc - tolerancia - 4), 0)
+        x1 = min(int(xc + rc + tolerancia + 5), largura)
+        y1 = min(int(yc + rc + tolerancia + 5), altura)
+        recorte = cv2.medianBlur(np.ascontiguousarray(img_gray[y0:y1, x0:x1]), 5)
+        refinado = cv2.HoughCircles(
+            recorte, cv2.HOUGH_GRADIENT, dp=1, minDist=max(recorte.shape),
+            param1=50, param2=30,
+            minRadius=max(1, int(rc - tolerancia)), maxRadius=int(rc + tolerancia),
+        )
+        if refinado is not None:
+            xr, yr, rr = refinado[0][0]
+            xc, yc, rc = xr + x0, yr + y0, rr
+        x, y, r = (int(v) for v in np.around((xc, yc, rc)))
+        bordas = cv2.Canny(recorte, 25, 50)
+        confianca = confianca_circulo(bordas, x - x0, y - y0, r)
+        candidatos.append((x, y, r, confianca))
+    candidatos.sort(key=lambda c: c[3], reverse=True)
+    logger.debug("Tempo para detecção em pirâmide: %.4fs. Candidatos (x, y, r, confiança): %s",
+                 time.perf_counter() - detection_start_time, candidatos)
+    return candidatos
+
+
+def detectar_placa(img_gray):
+    """Retorna ``(x, y, r, confianca)`` da placa ou None.
+
+    Usa a detecção em pirâmide e, se ela não encontrar nada (ou com PLATE_DETECTION_MODE=completo),
+    o HoughCircles original na imagem inteira.
+    """
+    if PLATE_DETECTION_MODE != "completo":
+        candidatos = detectar_placas_candidatas(img_gray)
+        if candidatos:
+            x, y, r, confianca = candidatos[0]
+            logger.debug("Placa detectada com centro em (%s, %s) e raio %s (confiança %.2f)", x, y, r, confianca)
+            return candidatos[0]
+        logger.debug("Detecção em pirâmide sem resultado; tentando HoughCircles na imagem inteira.")
+    circulo = detectar_placa_hough_completo(img_gray)
+    if circulo is None:
+        return None
+    x, y, r = (int(v) for v in circulo)
+    confianca = confianca_circulo(cv2.Canny(cv2.medianBlur(img_gray, 5), 25, 50), x, y, r)
+    return x, y, r, confianca
+
+
+def detectar_placas(img_gray, max_placas=PLACAS_MAX):
+    """Retorna ``(x, y, r, confianca)`` de cada placa de uma foto com várias placas.
+
+    Os candidatos da detecção em pirâmide são aceitos por ordem de confiança, descartando os que
+    ficam abaixo de PLACAS_CONFIANCA_MIN ou se sobrepõem a uma placa já aceita (círculos internos,
+    reflexos). Sem nenhum candidato confiável cai em detectar_placa, como uma foto de placa única.
+    As placas voltam em ordem de leitura: linhas de cima para baixo, da esquerda para a direita.
+    """
+    candidatos = detectar_placas_candidatas(
+        img_gray, max_candidatos=max(10, 4 * max_placas),
+        raio_min_frac=PLACAS_RAIO_MIN_FRAC, min_dist_frac=2 * PLACAS_RAIO_MIN_FRAC,
+    )
+    placas = []
+    for x, y, r, confianca in candidatos:
+        if confianca < PLACAS_CONFIANCA_MIN or len(placas) == max_placas:
+            break
+        # Folga de 10% para placas encostadas, cujos círculos detectados podem se cruzar um pouco
+        if any(np.hypot(x - px, y - py) < 0.9 * (r + pr) for px, py, pr, _ in placas):
+            continue
+        placas.append((x, y, r, confianca))
+    if not placas:
+        circulo = detectar_placa(img_gray)
+        return [circulo] if circulo is not None else []
+
+    raio_medio = float(np.mean([p[2] for p in placas]))
+    linhas = []
+    for placa in sorted(placas, key=lambda p: p[1]):
+        if linhas and placa[1] - linhas[-1][0][1] < raio_medio:
+            linhas[-1].append(placa)
+        else:
+            linhas.append([placa])
+    placas = [placa for linha in linhas for placa in sorted(linha, key=lambda p: p[0])]
+    logger.debug("%d placas detectadas: %s", len(placas), placas)
+    return placas
+
+@contextmanager
+def medir_estagio(tempos_estagios, nome):
+    """Acumula em ``tempos_estagios[nome]`` a duração (s) do bloco; não faz nada se o dict for None."""
+    if tempos_estagios is None:
+        yield
+        return
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        tempos_estagios[nome] = tempos_estagios.get(nome, 0.0) + time.perf_counter() - inicio
 
-    decode_start_time = time.time()
-    file_bytes = np.asarray(bytearray(imagem_bytes), dtype=np.uint8)
-    img_original = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
-    logger.info(f"[{nome_amostra}] Tempo para decodificar imagem: {time.time() - decode_start_time:.4f}s")
+
+def _estagio_em_cache(cache_estagios, nome, chave, calcular, tempos_estagios=None):
+    """Reutiliza o resultado de um estágio se a chave (parâmetros que o afetam) não mudou.
+
+    Com ``tempos_estagios`` a duração de ``calcular`` é registrada sob ``nome``.
+    """
+    if cache_estagios is not None:
+        entrada = cache_estagios.get(nome)
+        if entrada is not None and entrada[0] == chave:
+            return entrada[1]
+    with medir_estagio(tempos_estagios, nome):
+        valor = calcular()
+    if cache_estagios is not None:
+        cache_estagios[nome] = (chave, valor)
+    return valor
+
+
+def _dimensoes_jpeg(imagem_bytes):
+    """Lê (altura, largura) do marcador SOF de um JPEG sem decodificá-lo. Retorna None se não for JPEG."""
+    if len(imagem_bytes) < 4 or imagem_bytes[0] != 0xFF or imagem_bytes[1] != 0xD8:
+        return None
+    i = 2
+    while i + 9 < len(imagem_bytes):
+        if imagem_bytes[i] != 0xFF:
+            i += 1
+            continue
+        marcador = imagem_bytes[i + 1]
+        if marcador == 0xFF:
+            i += 1
+            continue
+        if marcador == 0x01 or 0xD0 <= marcador <= 0xD8:
+            i += 2
+            continue
+        if 0xC0 <= marcador <= 0xCF and marcador not in (0xC4, 0xC8, 0xCC):
+            altura = int.from_bytes(imagem_bytes[i + 5:i + 7], "big")
+            largura = int.from_bytes(imagem_bytes[i + 7:i + 9], "big")
+            return altura, largura
+        i += 2 + int.from_bytes(imagem_bytes[i + 2:i + 4], "big")
+    return None
+
+
+def _flag_decodificacao(imagem_bytes):
+    """Escolhe o maior fator de redução do JPEG que ainda mantém a imagem acima de MAX_IMAGE_DIM."""
+    dimensoes = _dimensoes_jpeg(imagem_bytes) if JPEG_REDUCED_DECODE else None
+    if dimensoes is None:
+        return cv2.IMREAD_COLOR, 1, None
+    maior_dim = max(dimensoes)
+    for fator, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if maior_dim // fator >= MAX_IMAGE_DIM:
+            return flag, fator, dimensoes
+    return cv2.IMREAD_COLOR, 1, dimensoes
+
+
+def decodificar_imagem(imagem_bytes, nome_amostra, tempos_estagios=None, nativa=False):
+    """Decodifica a imagem e a reduz para no máximo MAX_IMAGE_DIM. Retorna (img, gray, altura_orig, largura_orig).
+
+    ``altura_orig``/``largura_orig`` são sempre as dimensões da imagem enviada, mesmo quando o
+    JPEG é decodificado em resolução reduzida, para que x/y/r manuais sejam reescalados corretamente.
+    Com ``nativa=True`` o JPEG é decodificado por inteiro e a imagem na resolução original é
+    devolvida como quinto elemento (modo de alta resolução).
+    """
+    file_bytes = np.frombuffer(imagem_bytes, dtype=np.uint8)
+    if nativa:
+        flag, fator_reducao, dimensoes_jpeg = cv2.IMREAD_COLOR, 1, None
+    else:
+        flag, fator_reducao, dimensoes_jpeg = _flag_decodificacao(imagem_bytes)
+    with medir_estagio(tempos_estagios, "decodificacao"):
+        img_original = cv2.imdecode(file_bytes, flag)
+    logger.debug("[%s] Imagem decodificada com redução 1/%d", nome_amostra, fator_reducao)
 
     if img_original is None:
         logger.error(f"[{nome_amostra}] Não foi possível decodificar a imagem.")
         raise ValueError("Não foi possível decodificar a imagem.")
 
-    resize_start_time = time.time()
     altura_orig, largura_orig = img_original.shape[:2]
-    img = img_original.copy()
+    if fator_reducao > 1:
+        altura_orig, largura_orig = dimensoes_jpeg
+        # A orientação EXIF é aplicada na decodificação; o cabeçalho SOF traz as dimensões antes da rotação
+        if (img_original.shape[1] > img_original.shape[0]) != (largura_orig > altura_orig):
+            altura_orig, largura_orig = largura_orig, altura_orig
+    img = img_original
 
     if altura_orig > MAX_IMAGE_DIM or largura_orig > MAX_IMAGE_DIM:
         if altura_orig > largura_orig:
@@ -155,205 +1028,477 @@ def processar_imagem(
         else:
             nova_largura = MAX_IMAGE_DIM
             nova_altura = int(altura_orig * (MAX_IMAGE_DIM / largura_orig))
-        logger.info(f"[{nome_amostra}] Redimensionando imagem de {largura_orig}x{altura_orig} para {nova_largura}x{nova_altura}")
-        img = cv2.resize(img_original, (nova_largura, nova_altura), interpolation=cv2.INTER_AREA)
+        logger.debug("[%s] Redimensionando imagem de %dx%d para %dx%d",
+                     nome_amostra, largura_orig, altura_orig, nova_largura, nova_altura)
+        with medir_estagio(tempos_estagios, "redimensionamento"):
+            img = cv2.resize(img_original, (nova_largura, nova_altura), interpolation=cv2.INTER_AREA)
     else:
-        logger.info(f"[{nome_amostra}] Imagem ({largura_orig}x{altura_orig}) não requer redimensionamento (MAX_DIM: {MAX_IMAGE_DIM}).")
-    logger.info(f"[{nome_amostra}] Tempo para redimensionar: {time.time() - resize_start_time:.4f}s")
+        logger.debug("[%s] Imagem (%dx%d) não requer redimensionamento (MAX_DIM: %d).",
+                     nome_amostra, largura_orig, altura_orig, MAX_IMAGE_DIM)
+
+    with medir_estagio(tempos_estagios, "redimensionamento"):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if nativa:
+        return img, gray, altura_orig, largura_orig, img_original
+    return img, gray, altura_orig, largura_orig
 
-    desenhar = img.copy()
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
-    r_detectado_placa = 0 
+def localizar_placa(gray, altura_orig, largura_orig, nome_amostra, x_manual=None, y_manual=None, r_manual=None):
+    """Retorna (x, y, r, confianca) da placa na imagem redimensionada, a partir dos valores manuais ou de detectar_placa.
+
+    ``confianca`` é None quando a placa é informada manualmente.
+    """
+    r_detectado_placa = 0
+    confianca = None
 
-    placa_detection_start_time = time.time()
     if x_manual is not None and y_manual is not None and r_manual is not None:
-        fator_escala_largura = img.shape[1] / largura_orig
-        fator_escala_altura = img.shape[0] / altura_orig
+        fator_escala_largura = gray.shape[1] / largura_orig
+        fator_escala_altura = gray.shape[0] / altura_orig
         fator_escala_raio = min(fator_escala_largura, fator_escala_altura)
         x = int(x_manual * fator_escala_largura)
         y = int(y_manual * fator_escala_altura)
         r_detectado_placa = int(r_manual * fator_escala_raio)
-        logger.info(f"[{nome_amostra}] Usando parâmetros manuais reescalados para a placa: ({x}, {y}, {r_detectado_placa})")
+        logger.debug("[%s] Usando parâmetros manuais reescalados para a placa: (%d, %d, %d)", nome_amostra, x, y, r_detectado_placa)
     else:
         circulo = detectar_placa(gray)
         if circulo is None:
             logger.warning(f"[{nome_amostra}] Não foi possível detectar a placa automaticamente.")
             raise HTTPException(status_code=422, detail="Placa de Petri não detectada automaticamente.")
-        x, y, r_detectado_placa = circulo
-    logger.info(f"[{nome_amostra}] Tempo para detecção da placa: {time.time() - placa_detection_start_time:.4f}s. Raio 'r_detectado_placa' definido como: {r_detectado_placa}")
+        x, y, r_detectado_placa, confianca = circulo
+    logger.debug("[%s] Raio 'r_detectado_placa' definido como: %s", nome_amostra, r_detectado_placa)
 
     if r_detectado_placa == 0:
         logger.error(f"[{nome_amostra}] Raio da placa (r_detectado_placa) é zero, impossível prosseguir.")
         raise HTTPException(status_code=422, detail="Raio da placa (r) é zero.")
+    return x, y, r_detectado_placa, confianca
+
+
+def recorte_placa(shape, x, y, r_margem_calculada, margem):
+    """Retorna (y0, y1, x0, x1) do retângulo que contém o círculo da placa mais ``margem`` pixels."""
+    altura, largura = shape[:2]
+    alcance = int(r_margem_calculada) + int(margem)
+    return (
+        max(int(y) - alcance, 0),
+        min(int(y) + alcance + 1, altura),
+        max(int(x) - alcance, 0),
+        min(int(x) + alcance + 1, largura),
+    )
+
+
+def margem_recorte(local_max_filter_size, thresh_block_size):
+    """Margem em torno da placa para que o recorte dê o mesmo resultado da imagem inteira.
+
+    Cobre o suporte do GaussianBlur, do bloco do adaptiveThreshold e do maximum_filter, de
+    modo que a faixa externa do recorte seja sempre fundo (zero) em todos os estágios.
+    """
+    return int(thresh_block_size) // 2 + int(local_max_filter_size) + 8
 
-    core_processing_start_time = time.time()
-    r_margem_calculada = int(r_detectado_placa * 0.90) 
-    logger.info(f"[{nome_amostra}] 'r_margem_calculada' calculada como: {r_margem_calculada} (baseado em r_detectado_placa={r_detectado_placa})")
 
+def lut_equalizacao(hist):
+    """LUT equivalente a cv2.equalizeHist para o histograma ``hist`` (256 contagens).
+
+    Permite equalizar blocos de uma imagem com o histograma da placa inteira.
+    """
+    hist = np.asarray(hist, dtype=np.int64).ravel()
+    lut = np.zeros(256, dtype=np.uint8)
+    nao_zeros = np.flatnonzero(hist)
+    if nao_zeros.size == 0:
+        return lut
+    primeiro = int(nao_zeros[0])
+    total = int(hist.sum())
+    if hist[primeiro] == total:
+        lut[:] = primeiro
+        return lut
+    escala = np.float32(255.0 / (total - hist[primeiro]))
+    acumulado = np.cumsum(hist[primeiro + 1:])
+    lut[primeiro + 1:] = np.clip(np.rint(acumulado.astype(np.float32) * escala), 0, 255).astype(np.uint8)
+    return lut
+
+
+def preprocessar_placa(img, gray, x, y, r_margem_calculada, lut_eq=None):
+    """Aplica a máscara circular da placa e equaliza/suaviza o cinza. Retorna (img_masked, blurred).
+
+    ``lut_eq`` (de lut_equalizacao) substitui o equalizeHist local, para blocos de uma placa maior.
+    """
     mask_placa = np.zeros(gray.shape, dtype=np.uint8)
     cv2.circle(mask_placa, (x, y), r_margem_calculada, 255, -1)
     img_masked = cv2.bitwise_and(img, img, mask=mask_placa)
     gray_masked = cv2.bitwise_and(gray, gray, mask=mask_placa)
-    gray_eq = cv2.equalizeHist(gray_masked)
+    gray_eq = cv2.equalizeHist(gray_masked) if lut_eq is None else cv2.LUT(gray_masked, lut_eq)
     blurred = cv2.GaussianBlur(gray_eq, (5, 5), 0)
-    thresh = cv2.adaptiveThreshold(
-        blurred,
-        255,
-        cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-        cv2.THRESH_BINARY_INV,
-        int(thresh_block_size),
-        int(thresh_c),
-    )
-    opened = cv2.morphologyEx(thresh, cv2.MORPH_OPEN,
-                               cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3,3)))
-    dist_transform = cv2.distanceTransform(opened, cv2.DIST_L2, 5)
-    logger.info(f"[{nome_amostra}] Usando local_max_filter_size: {local_max_filter_size}")
-    local_max = ndimage.maximum_filter(dist_transform, size=local_max_filter_size) == dist_transform
-    markers, num_features = ndimage.label(local_max)
-    logger.info(f"[{nome_amostra}] Número inicial de marcadores (picos locais): {num_features}")
-    markers = markers + 1
-    unknown = cv2.subtract(opened, np.uint8(local_max * 255))
-    markers[unknown == 255] = 0
-    watershed_start_time = time.time()
-    markers = cv2.watershed(img_masked, markers.astype(np.int32))
-    logger.info(f"[{nome_amostra}] Tempo para cv2.watershed: {time.time() - watershed_start_time:.4f}s")
+    return img_masked, blurred
 
-    classificacoes_cores = []
-    total_avaliadas = 0
-    total_filtradas_area = 0
-    total_filtradas_circularidade = 0
-    total_filtradas_tamanho_maximo = 0
-    total_desenhadas = 0
-    colony_data = []
 
-    AREA_MIN_COLONIA = float(area_min)
-    AREA_MAX_COLONIA_FATOR = 0.05
-    AREA_MAX_COLONIA = np.pi * (r_margem_calculada**2) * AREA_MAX_COLONIA_FATOR
-    CIRCULARIDADE_MIN = float(circularidade_min)
-    
-    logger.info(f"[{nome_amostra}] Limites de filtro: AREA_MIN={AREA_MIN_COLONIA:.2f}px, AREA_MAX={AREA_MAX_COLONIA:.2f}px (baseado em r_margem_calculada={r_margem_calculada}), CIRC_MIN={CIRCULARIDADE_MIN:.2f}, PERIM_MIN={MIN_PERIMETER_THRESHOLD:.2f}px")
+def limiarizar_placa(blurred, thresh_block_size, thresh_c, tempos_estagios=None):
+    """Limiarização adaptativa seguida de abertura 3x3. Retorna a máscara binária das colônias."""
+    with medir_estagio(tempos_estagios, "limiarizacao"):
+        thresh = cv2.adaptiveThreshold(
+            blurred,
+            255,
+            cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+            cv2.THRESH_BINARY_INV,
+            int(thresh_block_size),
+            int(thresh_c),
+        )
+        return cv2.morphologyEx(thresh, cv2.MORPH_OPEN,
+                                cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3,3)))
 
-    loop_marcadores_start_time = time.time()
-    for marker_val in np.unique(markers):
-        if marker_val <= 1:
-            continue
-        mask_colonia = np.zeros(gray.shape, dtype=np.uint8)
-        mask_colonia[markers == marker_val] = 255
-        contours, _ = cv2.findContours(mask_colonia, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        if not contours:
-            continue
-        cnt = max(contours, key=cv2.contourArea)
-        area = cv2.contourArea(cnt)
-        total_avaliadas += 1
-        if area < AREA_MIN_COLONIA or area > AREA_MAX_COLONIA:
-            # Logs de colônias filtradas por área podem ser mantidos como DEBUG se desejado,
-            # ou removidos se forem muito verbosos para produção.
-            # if area < AREA_MIN_COLONIA: logger.debug(f"[{nome_amostra}] Colônia filtrada por área mínima: {area:.2f}px")
-            # else: logger.debug(f"[{nome_amostra}] Colônia filtrada por área máxima: {area:.2f}px")
-            total_filtradas_area += 1
-            continue
-        perimeter = cv2.arcLength(cnt, True)
-        if perimeter < MIN_PERIMETER_THRESHOLD:
-            # logger.debug(f"[{nome_amostra}] Colônia filtrada por perímetro mínimo: {perimeter:.2f}px")
-            total_filtradas_circularidade += 1
-            continue
-        circularity = 4 * np.pi * (area / (perimeter * perimeter))
-        if circularity < CIRCULARIDADE_MIN:
-            # logger.debug(f"[{nome_amostra}] Colônia filtrada por circularidade: {circularity:.2f}")
-            total_filtradas_circularidade += 1
-            continue
-        (cx, cy), radius_colonia_float = cv2.minEnclosingCircle(cnt)
-        center_colonia = (int(cx), int(cy))
-        radius_colonia_int = int(radius_colonia_float)
-        if np.linalg.norm(np.array(center_colonia) - np.array((x, y))) > r_margem_calculada: 
-            # logger.debug(f"[{nome_amostra}] Colônia filtrada por estar fora da margem r_margem_calculada")
-            continue
-        if radius_colonia_float > (r_margem_calculada * float(max_colony_size_factor)):
-            logger.info(
-                f"[{nome_amostra}] Colônia grande filtrada (raio colônia: {radius_colonia_float:.2f}px > {float(max_colony_size_factor)*100}% do r_margem_calculada da placa: {r_margem_calculada * float(max_colony_size_factor):.2f}px)"
-            )
-            total_filtradas_tamanho_maximo +=1
-            continue
-        mean_color_bgr = cv2.mean(img, mask=mask_colonia)[:3]
-        hsv_pixel = cv2.cvtColor(np.uint8([[mean_color_bgr]]), cv2.COLOR_BGR2HSV)
-        tipo = classificar_cor(hsv_pixel[0][0])
-        classificacoes_cores.append(tipo)
-        colony_data.append({
-            "h": int(hsv_pixel[0][0][0]),
-            "s": int(hsv_pixel[0][0][1]),
-            "v": int(hsv_pixel[0][0][2]),
-            "pred": tipo,
-            "cx": center_colonia[0],
-            "cy": center_colonia[1],
-            "r": radius_colonia_int,
-        })
-        cor_desenho = (0, 0, 255)
-        if tipo == 'amarela': cor_desenho = (0, 255, 255)
-        elif tipo == 'rosada': cor_desenho = (203, 192, 255)
-        elif tipo == 'clara': cor_desenho = (255, 255, 255)
-        cv2.circle(desenhar, center_colonia, radius_colonia_int, cor_desenho, 2)
-        total_desenhadas += 1
-    logger.info(f"[{nome_amostra}] Tempo para loop de marcadores e classificação: {time.time() - loop_marcadores_start_time:.4f}s")
 
-    resumo_contagem = dict(Counter(classificacoes_cores))
-    resumo_contagem['total'] = total_desenhadas
-    logger.info(f"[{nome_amostra}] Resultados da contagem: Avaliadas={total_avaliadas}, "
-                f"Filtradas Área={total_filtradas_area}, Filtradas Circ.={total_filtradas_circularidade}, "
-                f"Filtradas Tam.Max={total_filtradas_tamanho_maximo}, Desenhadas/Total Final={total_desenhadas}. "
-                f"Detalhe cores: {resumo_contagem}")
-    logger.info(f"[{nome_amostra}] Tempo do núcleo de processamento (segmentação e filtros): {time.time() - core_processing_start_time:.4f}s")
+def segmentar_colonias(img_masked, blurred, nome_amostra, local_max_filter_size, thresh_block_size, thresh_c,
+                       tempos_estagios=None):
+    """Limiarização adaptativa, transformada de distância e watershed. Retorna os marcadores."""
+    opened = limiarizar_placa(blurred, thresh_block_size, thresh_c, tempos_estagios)
+    logger.debug("[%s] Usando local_max_filter_size: %s", nome_amostra, local_max_filter_size)
+    with medir_estagio(tempos_estagios, "distancia"):
+        dist_transform = cv2.distanceTransform(opened, cv2.DIST_L2, 5)
+        # cv2.dilate com kernel quadrado equivale a ndimage.maximum_filter (modo reflect) e
+        # connectedComponents com conectividade 4 numera como ndimage.label
+        tamanho_filtro = int(local_max_filter_size)
+        local_max = cv2.dilate(dist_transform, np.ones((tamanho_filtro, tamanho_filtro), np.uint8)) == dist_transform
+        num_rotulos, markers = cv2.connectedComponents(local_max.astype(np.uint8), connectivity=4, ltype=cv2.CV_32S)
+    num_features = num_rotulos - 1
+    logger.debug("[%s] Número inicial de marcadores (picos locais): %d", nome_amostra, num_features)
+    with medir_estagio(tempos_estagios, "watershed"):
+        markers = markers + 1
+        unknown = cv2.subtract(opened, np.uint8(local_max * 255))
+        markers[unknown == 255] = 0
+        markers = cv2.watershed(img_masked, markers.astype(np.int32))
+    return markers
 
-    # --- Início da Lógica de Densidade e Estimativa (Limpa) ---
-    total_contado_na_subarea = resumo_contagem.get('total', 0)
-    
-    densidade_ufc_por_cm2 = 0.0
-    estimativa_ufc_placa_inteira = float(total_contado_na_subarea) 
-    area_efetiva_amostrada_cm2 = 0.0
-    fracao_amostrada = 0.0
 
-    logger.info(f"[{nome_amostra}] Calculando densidade: r_detectado_placa={r_detectado_placa}, r_margem_calculada={r_margem_calculada}")
+def segmentar_componentes(img_masked, blurred, img, nome_amostra, local_max_filter_size, thresh_block_size, thresh_c,
+                          deslocamento=(0, 0), tempos_estagios=None, contadores=None):
+    """Segmentação rápida guiada por componentes conexos (cv2.connectedComponentsWithStats).
 
-    area_pixels_subarea = np.pi * (r_margem_calculada ** 2)
-    # Usar conversão explícita para float para o raio ao quadrado por robustez
-    area_pixels_placa_inteira = np.pi * (float(r_detectado_placa) ** 2) 
+    Cada componente da limiarização recebe uma única semente, no platô do seu pico da transformada
+    de distância; só os que parecem colônias fundidas (área acima de COMPONENTES_RAZAO_FUSAO vezes a
+    do maior círculo inscrito) recebem uma semente por máximo local, como no watershed completo.
+    Um único watershed com essas sementes ainda ajusta a borda de cada colônia à cor, já que a
+    limiarização inclui um halo de alguns pixels, mas as estatísticas saem de um único findContours
+    para as colônias isoladas e do bounding box de cada componente fundido, em vez de uma máscara por
+    região para as milhares de regiões do watershed completo.
+    Retorna as estatísticas no formato de extrair_estatisticas_colonias.
+    """
+    opened = limiarizar_placa(blurred, thresh_block_size, thresh_c, tempos_estagios)
+    with medir_estagio(tempos_estagios, "componentes"):
+        n_rotulos, rotulos, cc_stats, _ = cv2.connectedComponentsWithStats(opened, connectivity=8, ltype=cv2.CV_32S)
+        # As reduções por componente só olham os pixels de frente (poucos % do recorte)
+        frente = rotulos > 0
+        rotulos_frente = rotulos[frente]
+    with medir_estagio(tempos_estagios, "distancia"):
+        dist = cv2.distanceTransform(opened, cv2.DIST_L2, 5)
+        dist_frente = dist[frente]
+        dist_max = np.zeros(n_rotulos, dtype=np.float32)
+        np.maximum.at(dist_max, rotulos_frente, dist_frente)
+        razao = cc_stats[:, cv2.CC_STAT_AREA] / np.maximum(np.pi * dist_max.astype(np.float64) ** 2, 1e-9)
+        fundido = (dist_max >= 2) & (razao > COMPONENTES_RAZAO_FUSAO) & (razao <= COMPONENTES_RAZAO_MAX)
+        fundido[0] = False
+        fundidos = np.flatnonzero(fundido)
 
-    if area_pixels_placa_inteira > 1e-6: 
-        fracao_amostrada = area_pixels_subarea / area_pixels_placa_inteira
-        logger.info(f"[{nome_amostra}] Detalhes cálculo fração: r_margem_calculada={r_margem_calculada}px, r_detectado_placa={r_detectado_placa}px. "
-                    f"Área subárea (pixels): {area_pixels_subarea:.2f}, Área placa inteira (pixels): {area_pixels_placa_inteira:.2f}. "
-                    f"Fração Amostrada: {fracao_amostrada:.4f}")
+        # Rótulos das sementes: 1 é o fundo, componente c vira c + 1 e o pico p de um componente
+        # fundido vira n_rotulos + p; pixels de frente sem semente (0) são decididos pelo watershed
+        sementes = np.where(dist_frente >= dist_max[rotulos_frente], rotulos_frente + 1, 0).astype(np.int32)
+        if fundidos.size:
+            tamanho_filtro = int(local_max_filter_size)
+            local_max = cv2.dilate(dist, np.ones((tamanho_filtro, tamanho_filtro), np.uint8)) == dist
+            local_max &= frente & fundido[rotulos]
+            _, picos = cv2.connectedComponents(local_max.astype(np.uint8), connectivity=4, ltype=cv2.CV_32S)
+            em_fundido = fundido[rotulos_frente]
+            picos_fundidos = picos[frente][em_fundido]
+            sementes[em_fundido] = np.where(picos_fundidos > 0, picos_fundidos + n_rotulos, 0)
+    logger.debug("[%s] %d componentes, %d com colônias fundidas", nome_amostra, n_rotulos - 1, fundidos.size)
 
-        if fracao_amostrada > 1e-6: 
-            estimativa_ufc_placa_inteira = total_contado_na_subarea / fracao_amostrada
-            
-            if AREA_PADRAO_PLACA_CM2 > 1e-6:
-                densidade_ufc_por_cm2 = estimativa_ufc_placa_inteira / AREA_PADRAO_PLACA_CM2
-                area_efetiva_amostrada_cm2 = fracao_amostrada * AREA_PADRAO_PLACA_CM2
-            else:
-                logger.warning(f"[{nome_amostra}] AREA_PADRAO_PLACA_CM2 ({AREA_PADRAO_PLACA_CM2}) é inválida. ")
+    with medir_estagio(tempos_estagios, "watershed"):
+        markers = np.ones(opened.shape, dtype=np.int32)
+        markers[frente] = sementes
+        markers = cv2.watershed(img_masked, markers)
+
+    with medir_estagio(tempos_estagios, "marcadores"):
+        regioes_frente = markers[frente]
+        validas = regioes_frente > 1
+        regioes_validas = regioes_frente[validas]
+        n_regioes = int(regioes_validas.max()) + 1 if regioes_validas.size else 2
+        contagem_pixels = np.bincount(regioes_validas, minlength=n_regioes)
+        bgr_frente = img[frente][validas]
+        somas_bgr = np.stack([
+            np.bincount(regioes_validas, weights=bgr_frente[:, canal], minlength=n_regioes)
+            for canal in range(3)
+        ], axis=1)
+
+        # O watershed só distribui pixels do próprio componente: regiões de componentes com semente
+        # única nunca se tocam e saem todas de um único findContours; RETR_CCOMP mantém no primeiro
+        # nível também as que estão dentro do furo de outra (ex.: colônias dentro da borda da máscara)
+        contornos_por_regiao = {}
+        unicas = ((markers > 1) & (markers <= n_rotulos)).astype(np.uint8)
+        contours, hierarquia = cv2.findContours(
+            unicas, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE, offset=deslocamento
+        )
+        for cnt, (_, _, _, pai) in zip(contours, hierarquia[0] if hierarquia is not None else ()):
+            if pai < 0:
+                regiao = int(markers[cnt[0, 0, 1] - deslocamento[1], cnt[0, 0, 0] - deslocamento[0]])
+                contornos_por_regiao.setdefault(regiao, []).append(cnt)
+
+        # Componentes fundidos: cada pico vira uma região, contornada dentro do bounding box do componente
+        altura, largura = markers.shape
+        for componente in fundidos:
+            bx, by, bw, bh = (int(v) for v in cc_stats[componente, :4])
+            y0, y1 = max(by - 1, 0), min(by + bh + 1, altura)
+            x0, x1 = max(bx - 1, 0), min(bx + bw + 1, largura)
+            recorte = markers[y0:y1, x0:x1]
+            do_componente = recorte[rotulos[y0:y1, x0:x1] == componente]
+            for regiao in np.unique(do_componente[do_componente > n_rotulos]):
+                mask_colonia = (recorte == regiao).astype(np.uint8) * 255
+                contornos_por_regiao[int(regiao)], _ = cv2.findContours(
+                    mask_colonia, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                    offset=(x0 + deslocamento[0], y0 + deslocamento[1]),
+                )
+
+        regioes, areas, perimetros, centros_x, centros_y, raios = [], [], [], [], [], []
+        for regiao, contornos_regiao in sorted(contornos_por_regiao.items()):
+            if not contornos_regiao:
+                continue
+            cnt = max(contornos_regiao, key=cv2.contourArea)
+            (cx, cy), radius_colonia_float = cv2.minEnclosingCircle(cnt)
+            regioes.append(regiao)
+            areas.append(cv2.contourArea(cnt))
+            perimetros.append(cv2.arcLength(cnt, True))
+            centros_x.append(cx)
+            centros_y.append(cy)
+            raios.append(radius_colonia_float)
+
+        regioes = np.array(regioes, dtype=np.int64)
+        if regioes.size:
+            bgr_medio = somas_bgr[regioes] * (1.0 / np.maximum(contagem_pixels[regioes], 1))[:, None]
         else:
-            logger.warning(f"[{nome_amostra}] Fração amostrada ({fracao_amostrada:.4f}) é muito pequena ou zero.")
+            bgr_medio = np.zeros((0, 3), dtype=np.float64)
+    if contadores is not None:
+        contadores["componentes_fundidos"] = contadores.get("componentes_fundidos", 0) + int(fundidos.size)
+    return {
+        "rotulo": regioes,
+        "area": np.array(areas, dtype=np.float64),
+        "perimetro": np.array(perimetros, dtype=np.float64),
+        "cx": np.array(centros_x, dtype=np.float64),
+        "cy": np.array(centros_y, dtype=np.float64),
+        "raio": np.array(raios, dtype=np.float64),
+        "bgr_medio": bgr_medio,
+    }
+
+
+def segmentar_e_extrair(img_masked, blurred, img, nome_amostra, local_max_filter_size, thresh_block_size, thresh_c,
+                        motor_segmentacao="watershed", deslocamento=(0, 0), tempos_estagios=None, contadores=None):
+    """Segmenta o recorte com o motor escolhido e retorna as estatísticas de cada região."""
+    if motor_segmentacao == "componentes":
+        return segmentar_componentes(img_masked, blurred, img, nome_amostra, local_max_filter_size,
+                                     thresh_block_size, thresh_c, deslocamento, tempos_estagios, contadores)
+    markers = segmentar_colonias(img_masked, blurred, nome_amostra, local_max_filter_size,
+                                 thresh_block_size, thresh_c, tempos_estagios)
+    with medir_estagio(tempos_estagios, "marcadores"):
+        return extrair_estatisticas_colonias(markers, img, deslocamento=deslocamento)
+
+
+def _impar(valor, minimo=3):
+    valor = max(minimo, int(round(valor)))
+    return valor if valor % 2 else valor + 1
+
+
+def _iou_circulos(x1, y1, r1, x2, y2, r2):
+    d = float(np.hypot(x1 - x2, y1 - y2))
+    if d >= r1 + r2:
+        return 0.0
+    menor, maior = min(r1, r2), max(r1, r2)
+    if d <= maior - menor:
+        intersecao = np.pi * menor * menor
     else:
-        logger.error(f"[{nome_amostra}] Área da placa inteira em pixels ({area_pixels_placa_inteira:.2f}) é zero ou muito pequena.")
+        a1 = r1 * r1 * np.arccos(np.clip((d * d + r1 * r1 - r2 * r2) / (2 * d * r1), -1, 1))
+        a2 = r2 * r2 * np.arccos(np.clip((d * d + r2 * r2 - r1 * r1) / (2 * d * r2), -1, 1))
+        a3 = 0.5 * np.sqrt(max(0.0, (-d + r1 + r2) * (d + r1 - r2) * (d - r1 + r2) * (d + r1 + r2)))
+        intersecao = a1 + a2 - a3
+    uniao = np.pi * (r1 * r1 + r2 * r2) - intersecao
+    return float(intersecao / uniao) if uniao > 0 else 0.0
 
-    logger.info(f"[{nome_amostra}] Resultados FINAIS dos cálculos de densidade/estimativa: "
-                f"Total Contado Subárea: {total_contado_na_subarea} UFC, "
-                f"Fração Amostrada (usada): {fracao_amostrada:.4f}, "
-                f"Estimativa Placa Inteira: {estimativa_ufc_placa_inteira:.2f} UFC, "
-                f"Área Amostrada (cm²): {area_efetiva_amostrada_cm2:.2f} cm², "
-                f"Densidade (UFC/cm²): {densidade_ufc_por_cm2:.2f} UFC/cm²")
-    # --- Fim da Lógica de Densidade e Estimativa ---
 
-    hora_brasilia = datetime.now(timezone.utc) - timedelta(hours=3)
-    texto_cabecalho = [
+def _filtrar_estatisticas(stats, manter):
+    return {chave: valores[manter] for chave, valores in stats.items()}
+
+
+def _concatenar_estatisticas(lista_stats):
+    return {
+        chave: np.concatenate([stats[chave] for stats in lista_stats])
+        for chave in lista_stats[0]
+    }
+
+
+def blocos_segmentacao(y0, y1, x0, x1, tamanho, folga):
+    """Divide o recorte em núcleos de até ``tamanho`` px. Retorna (núcleo, bloco estendido por ``folga``)."""
+    blocos = []
+    for by in range(y0, y1, tamanho):
+        for bx in range(x0, x1, tamanho):
+            nucleo = (by, min(by + tamanho, y1), bx, min(bx + tamanho, x1))
+            estendido = (max(by - folga, y0), min(nucleo[1] + folga, y1), max(bx - folga, x0), min(nucleo[3] + folga, x1))
+            blocos.append((nucleo, estendido))
+    return blocos
+
+
+def _segmentar_bloco(img, gray, lut_eq, x, y, r_margem, bloco, recorte, nome_amostra, lmfs, block, c, motor):
+    """Segmenta um bloco e mantém só as colônias cujo centro está no núcleo e que não tocam a borda interna."""
+    (ny0, ny1, nx0, nx1), (ey0, ey1, ex0, ex1) = bloco
+    tempos, contadores = {}, {}
+    img_bloco = img[ey0:ey1, ex0:ex1]
+    with medir_estagio(tempos, "preprocessamento"):
+        img_masked, blurred = preprocessar_placa(
+            img_bloco, gray[ey0:ey1, ex0:ex1], x - ex0, y - ey0, r_margem, lut_eq=lut_eq
+        )
+    stats = segmentar_e_extrair(img_masked, blurred, img_bloco, nome_amostra, lmfs, block, c, motor,
+                                deslocamento=(ex0, ey0), tempos_estagios=tempos, contadores=contadores)
+    cx, cy, raio = stats["cx"], stats["cy"], stats["raio"]
+    manter = (cx >= nx0) & (cx < nx1) & (cy >= ny0) & (cy < ny1)
+    # Colônias cortadas pela borda do bloco (exceto a borda do recorte) aparecem inteiras no vizinho
+    ry0, ry1, rx0, rx1 = recorte
+    if ex0 > rx0:
+        manter &= cx - raio > ex0
+    if ex1 < rx1:
+        manter &= cx + raio < ex1 - 1
+    if ey0 > ry0:
+        manter &= cy - raio > ey0
+    if ey1 < ry1:
+        manter &= cy + raio < ey1 - 1
+    return _filtrar_estatisticas(stats, manter), tempos, contadores
+
+
+def deduplicar_colonias(stats, origem, limites_nucleos, iou_min=TILE_DEDUP_IOU, area_max=np.inf):
+    """Remove colônias detectadas em dois blocos vizinhos.
+
+    Só são comparadas colônias de blocos diferentes que tocam uma divisa entre núcleos; duas são a
+    mesma quando os dois centroides caem dentro de ambos os círculos (distância menor que o raio
+    menor) ou o IoU dos círculos passa de ``iou_min``. Fica a de maior área. Regiões acima de
+    ``area_max`` (fundo, halos), que o filtro de área descarta depois, não entram na comparação e não
+    podem apagar colônias menores cujo centro caia dentro delas. Retorna a máscara booleana das
+    colônias mantidas.
+    """
+    cx, cy, raio = stats["cx"], stats["cy"], stats["raio"]
+    manter = np.ones(cx.size, dtype=bool)
+    divisas_x, divisas_y = limites_nucleos
+    perto = np.zeros(cx.size, dtype=bool)
+    for divisa in divisas_x:
+        perto |= np.abs(cx - divisa) <= raio + 1
+    for divisa in divisas_y:
+        perto |= np.abs(cy - divisa) <= raio + 1
+    candidatas = np.flatnonzero(perto & (stats["area"] <= area_max))
+    if candidatas.size < 2:
+        return manter
+    celula = max(1.0, float(raio[candidatas].max()))
+    grade = {}
+    for i in candidatas[np.argsort(-stats["area"][candidatas], kind="stable")]:
+        gx, gy = int(cx[i] // celula), int(cy[i] // celula)
+        duplicada = False
+        for vizinha in ((gx + dx, gy + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)):
+            for j in grade.get(vizinha, ()):
+                if origem[i] == origem[j]:
+                    continue
+                distancia = np.hypot(cx[i] - cx[j], cy[i] - cy[j])
+                if distancia < min(raio[i], raio[j]) or _iou_circulos(
+                    cx[i], cy[i], raio[i], cx[j], cy[j], raio[j]
+                ) >= iou_min:
+                    duplicada = True
+                    break
+            if duplicada:
+                break
+        if duplicada:
+            manter[i] = False
+        else:
+            grade.setdefault((gx, gy), []).append(i)
+    return manter
+
+
+def segmentar_em_blocos(img, x, y, r_margem, nome_amostra, lmfs, block, c, motor_segmentacao="watershed",
+                        tempos_estagios=None, contadores=None):
+    """Segmentação da placa em blocos sobrepostos, em paralelo, na resolução de ``img``.
+
+    A equalização usa o histograma da placa inteira, para que todos os blocos vejam o mesmo contraste.
+    Retorna as estatísticas (como extrair_estatisticas_colonias) em coordenadas de ``img``.
+    """
+    margem = margem_recorte(lmfs, block)
+    recorte = recorte_placa(img.shape, x, y, r_margem, margem)
+    y0, y1, x0, x1 = recorte
+    with medir_estagio(tempos_estagios, "preprocessamento"):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        mascara = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        cv2.circle(mascara, (x - x0, y - y0), r_margem, 255, -1)
+        hist = cv2.calcHist([gray[y0:y1, x0:x1]], [0], mascara, [256], [0, 256])
+        # Pixels fora do círculo entram como zero no equalizeHist original
+        hist[0] += mascara.size - cv2.countNonZero(mascara)
+        lut_eq = lut_equalizacao(hist)
+        del mascara
+
+    folga = margem + TILE_OVERLAP
+    blocos = blocos_segmentacao(y0, y1, x0, x1, max(64, TILE_SIZE), folga)
+    logger.debug("[%s] Segmentação em %d blocos de até %dpx (+%dpx de sobreposição)",
+                 nome_amostra, len(blocos), TILE_SIZE, folga)
+
+    def processar_bloco(bloco):
+        return _segmentar_bloco(
+            img, gray, lut_eq, x, y, r_margem, bloco, recorte, nome_amostra, lmfs, block, c, motor_segmentacao
+        )
+
+    with ThreadPoolExecutor(max_workers=max(1, min(TILE_WORKERS, len(blocos)))) as executor_blocos:
+        resultados = list(executor_blocos.map(processar_bloco, blocos))
+
+    if tempos_estagios is not None:
+        # Soma do tempo dos blocos (tempo de CPU, maior que o tempo de parede quando em paralelo)
+        for _, tempos, _ in resultados:
+            for nome, duracao in tempos.items():
+                tempos_estagios[nome] = tempos_estagios.get(nome, 0.0) + duracao
+    origem = np.concatenate([np.full(st["cx"].size, i) for i, (st, _, _) in enumerate(resultados)])
+    stats = _concatenar_estatisticas([st for st, _, _ in resultados])
+    with medir_estagio(tempos_estagios, "marcadores"):
+        divisas_x = sorted({nucleo[2] for nucleo, _ in blocos} - {x0})
+        divisas_y = sorted({nucleo[0] for nucleo, _ in blocos} - {y0})
+        # Mesmo limite de AREA_MAX_COLONIA de processar_imagem, na escala de ``img``
+        manter = deduplicar_colonias(stats, origem, (divisas_x, divisas_y), area_max=np.pi * r_margem * r_margem * 0.05)
+    if contadores is not None:
+        contadores["blocos"] = len(blocos)
+        contadores["colonias_duplicadas"] = int((~manter).sum())
+        for _, _, contadores_bloco in resultados:
+            for nome, valor in contadores_bloco.items():
+                contadores[nome] = contadores.get(nome, 0) + valor
+    return _filtrar_estatisticas(stats, manter)
+
+
+# Cor (BGR) do contorno de cada classe na imagem anotada; classes sem cor própria em vermelho
+CORES_DESENHO = {"amarela": (0, 255, 255), "rosada": (203, 192, 255), "clara": (255, 255, 255)}
+COR_DESENHO_PADRAO = (0, 0, 255)
+
+# Formatos de saída da imagem anotada: extensão para o cv2.imencode, media type e flag de qualidade
+FORMATOS_IMAGEM = {
+    "jpeg": (".jpg", "image/jpeg", cv2.IMWRITE_JPEG_QUALITY),
+    "webp": (".webp", "image/webp", cv2.IMWRITE_WEBP_QUALITY),
+    "png": (".png", "image/png", None),
+}
+
+
+def linhas_legenda(nome_amostra, total, densidade_ufc_por_cm2, estimativa_ufc_placa_inteira, hora=None):
+    """Linhas do quadro de legenda da imagem anotada; ``hora`` padrão é agora, no horário de Brasília."""
+    if hora is None:
+        hora = datetime.now(timezone.utc) - timedelta(hours=3)
+    return [
         f"{nome_amostra}",
-        f"{hora_brasilia.strftime('%Y-%m-%d %H:%M:%S')}",
-        f"Contagem TOTAL: {total_contado_na_subarea} UFC",
+        f"{hora.strftime('%Y-%m-%d %H:%M:%S')}",
+        f"Contagem TOTAL: {total} UFC",
         f"Densidade: {densidade_ufc_por_cm2:.2f} UFC/cm^2",
         f"Estimativa Placa ({AREA_PADRAO_PLACA_CM2:.1f} cm^2): {round(estimativa_ufc_placa_inteira):.0f} UFC"
     ]
-    
+
+
+def desenhar_colonias(desenhar, colony_data, deslocamento=(0, 0)):
+    """Desenha em ``desenhar`` (no lugar) o contorno de cada colônia, deslocado por ``deslocamento``."""
+    dx, dy = deslocamento
+    for colonia in colony_data:
+        cor_desenho = CORES_DESENHO.get(colonia["pred"], COR_DESENHO_PADRAO)
+        cv2.circle(desenhar, (colonia["cx"] - dx, colonia["cy"] - dy), colonia["r"], cor_desenho, 2)
+
+
+def desenhar_legenda(desenhar, texto_cabecalho):
+    """Desenha em ``desenhar`` (no lugar) o quadro de legenda no canto superior esquerdo."""
     altura_legenda = 22 * len(texto_cabecalho) + 20
     largura_max_texto = 0
     for linha_texto in texto_cabecalho:
@@ -366,29 +1511,1571 @@ def processar_imagem(
         y_texto = 25 + i * 22
         cv2.putText(desenhar, linha, (10, y_texto), cv2.FONT_HERSHEY_SIMPLEX, 0.55, (255, 255, 255), 1, cv2.LINE_AA)
 
-    encode_start_time = time.time()
-    _, buffer = cv2.imencode('.jpg', desenhar)
-    logger.info(f"[{nome_amostra}] Tempo para encodificar imagem: {time.time() - encode_start_time:.4f}s")
 
-    feedback_headers = {
-        "X-Resumo-Total": str(total_contado_na_subarea),
-        "X-Resumo-Amarela": str(resumo_contagem.get('amarela',0)),
-        "X-Resumo-Bege": str(resumo_contagem.get('bege',0)),
-        "X-Resumo-Clara": str(resumo_contagem.get('clara',0)),
-        "X-Resumo-Rosada": str(resumo_contagem.get('rosada',0)),
-        "X-Feedback-Avaliadas": str(total_avaliadas),
-        "X-Feedback-Filtradas-Area": str(total_filtradas_area),
-        "X-Feedback-Filtradas-Circularidade": str(total_filtradas_circularidade),
-        "X-Feedback-Filtradas-Tamanho-Maximo": str(total_filtradas_tamanho_maximo),
-        "X-Feedback-Desenhadas": str(total_desenhadas),
-        "X-Feedback-Raio-Detectado-Px": str(r_detectado_placa),
-        "X-Feedback-Area-Amostrada-Cm2": f"{area_efetiva_amostrada_cm2:.2f}",
-        "X-Feedback-Densidade-Colonias-Cm2": f"{densidade_ufc_por_cm2:.2f}",
-        "X-Feedback-Estimativa-Total-Colonias": f"{round(estimativa_ufc_placa_inteira):.0f}"
+def desenhar_anotacoes(img, colony_data, texto_cabecalho):
+    """Cópia de ``img`` com o contorno de cada colônia contada e o quadro de legenda."""
+    desenhar = img.copy()
+    desenhar_colonias(desenhar, colony_data)
+    desenhar_legenda(desenhar, texto_cabecalho)
+    return desenhar
+
+
+def codificar_imagem(img, formato="jpeg", qualidade=None, lado_max=None):
+    """Codifica ``img`` em um dos FORMATOS_IMAGEM, reduzindo antes o maior lado para ``lado_max`` se informado.
+
+    ``qualidade`` (1-100) vale para JPEG e WebP; sem ela é usado o padrão do OpenCV.
+    """
+    extensao, _, flag_qualidade = FORMATOS_IMAGEM[formato]
+    if lado_max and max(img.shape[:2]) > lado_max:
+        fator = lado_max / max(img.shape[:2])
+        img = cv2.resize(
+            img, (max(1, round(img.shape[1] * fator)), max(1, round(img.shape[0] * fator))),
+            interpolation=cv2.INTER_AREA,
+        )
+    parametros = [flag_qualidade, int(qualidade)] if qualidade is not None and flag_qualidade is not None else []
+    ok, buffer = cv2.imencode(extensao, img, parametros)
+    if not ok:
+        raise ValueError(f"Não foi possível codificar a imagem como {formato}.")
+    return buffer.tobytes()
+
+
+# Etapas informadas ao callback ``progresso`` de processar_imagem, na ordem em que ocorrem
+ETAPAS_PROGRESSO = ("iniciada", "decodificada", "placa_localizada", "segmentada", "classificada", "renderizada")
+
+
+def _sem_progresso(etapa):
+    pass
+
+
+def processar_imagem(
+    imagem_bytes: bytes,
+    nome_amostra: str,
+    x_manual=None,
+    y_manual=None,
+    r_manual=None,
+    area_min: float = 10.0,
+    circularidade_min: float = 0.40,
+    max_colony_size_factor: float = MAX_COLONY_RADIUS_FACTOR_OF_PETRI_MARGIN,
+    local_max_filter_size: int = 7,
+    thresh_block_size: int = 41,
+    thresh_c: int = 4,
+    alta_resolucao: bool = False,
+    motor_segmentacao: str = "watershed",
+    renderizar: bool = True,
+    cache_estagios=None,
+    tempos_estagios=None,
+    contadores=None,
+    progresso=None,
+):
+    """Pipeline completo de contagem.
+
+    ``cache_estagios`` (opcional) é um dict mantido pelo chamador entre execuções da mesma
+    imagem; cada estágio só é recalculado quando os parâmetros que o afetam mudam.
+    ``tempos_estagios`` (opcional) recebe a duração em segundos de cada estágio executado
+    (estágios reaproveitados do cache não aparecem) e ``contadores`` (opcional) o número de
+    pixels e de colônias processados.
+    ``alta_resolucao`` segmenta a placa na resolução original em blocos (segmentar_em_blocos)
+    em vez de na imagem reduzida a MAX_IMAGE_DIM.
+    ``motor_segmentacao`` escolhe entre o watershed completo e o caminho rápido por componentes
+    conexos (segmentar_componentes); o motor usado volta no cabeçalho X-Motor-Segmentacao.
+    Com ``renderizar=False`` o desenho e a codificação da imagem anotada são pulados e o
+    segundo elemento retornado é None (só contagens, cabeçalhos e colony_data).
+    ``progresso`` (opcional) é chamado com o nome de cada etapa concluída (ETAPAS_PROGRESSO).
+    """
+    inicio_processamento = time.perf_counter()
+    logger.debug("[%s] Iniciando processamento da imagem.", nome_amostra)
+    if motor_segmentacao not in MOTORES_SEGMENTACAO:
+        raise ValueError(f"motor_segmentacao deve ser um de: {', '.join(MOTORES_SEGMENTACAO)}")
+    if progresso is None:
+        progresso = _sem_progresso
+    progresso("iniciada")
+
+    if alta_resolucao:
+        img, gray, altura_orig, largura_orig, img_nativa = _estagio_em_cache(
+            cache_estagios, "ingestao_nativa", None,
+            lambda: decodificar_imagem(imagem_bytes, nome_amostra, tempos_estagios, nativa=True),
+        )
+    else:
+        img, gray, altura_orig, largura_orig = _estagio_em_cache(
+            cache_estagios, "ingestao", None,
+            lambda: decodificar_imagem(imagem_bytes, nome_amostra, tempos_estagios),
+        )
+    progresso("decodificada")
+
+    chave_placa = (x_manual, y_manual, r_manual)
+    x, y, r_detectado_placa, confianca_placa = _estagio_em_cache(
+        cache_estagios, "placa", chave_placa,
+        lambda: localizar_placa(gray, altura_orig, largura_orig, nome_amostra, x_manual, y_manual, r_manual),
+        tempos_estagios,
+    )
+    progresso("placa_localizada")
+
+    r_margem_calculada = int(r_detectado_placa * 0.90) 
+    logger.debug("[%s] 'r_margem_calculada' calculada como: %d (baseado em r_detectado_placa=%s)",
+                 nome_amostra, r_margem_calculada, r_detectado_placa)
+
+    if alta_resolucao:
+        # Placa localizada na imagem de trabalho; a segmentação roda na resolução nativa com os
+        # tamanhos de vizinhança escalados, e as medidas voltam para a escala da imagem de trabalho,
+        # onde valem os mesmos filtros, cabeçalhos e colony_data do modo normal.
+        escala_x = img_nativa.shape[1] / img.shape[1]
+        escala_y = img_nativa.shape[0] / img.shape[0]
+        escala = (escala_x + escala_y) / 2
+        lmfs_nativo = _impar(int(local_max_filter_size) * escala, minimo=1)
+        block_nativo = _impar(int(thresh_block_size) * escala)
+        chave_segmentacao = (
+            "nativa", int(x), int(y), int(r_detectado_placa), int(local_max_filter_size),
+            int(thresh_block_size), int(thresh_c), motor_segmentacao,
+        )
+
+        def segmentar_nativa():
+            stats_nativas = segmentar_em_blocos(
+                img_nativa, int(round(x * escala_x)), int(round(y * escala_y)), int(r_margem_calculada * escala),
+                nome_amostra, lmfs_nativo, block_nativo, thresh_c, motor_segmentacao, tempos_estagios, contadores,
+            )
+            return {
+                **stats_nativas,
+                "area": stats_nativas["area"] / (escala * escala),
+                "perimetro": stats_nativas["perimetro"] / escala,
+                "cx": stats_nativas["cx"] / escala_x,
+                "cy": stats_nativas["cy"] / escala_y,
+                "raio": stats_nativas["raio"] / escala,
+            }
+
+        stats = _estagio_em_cache(cache_estagios, "segmentacao", chave_segmentacao, segmentar_nativa)
+        pixels_processados = img_nativa.shape[0] * img_nativa.shape[1]
+        pixels_placa = int(np.pi * (r_margem_calculada * escala) ** 2)
+    else:
+        # Todos os estágios de segmentação rodam apenas no recorte da placa; as coordenadas
+        # voltam para a imagem inteira só nas estatísticas (contornos) e no desenho.
+        # Com thresh_c <= 0 o fundo fora da placa também é limiarizado, então o recorte não
+        # seria equivalente e a imagem inteira é usada.
+        if int(thresh_c) > 0:
+            margem = margem_recorte(local_max_filter_size, thresh_block_size)
+            y0, y1, x0, x1 = recorte_placa(img.shape, x, y, r_margem_calculada, margem)
+        else:
+            margem = None
+            y0, y1, x0, x1 = 0, img.shape[0], 0, img.shape[1]
+        img_roi = img[y0:y1, x0:x1]
+        logger.debug("[%s] Recorte da placa: x=%d:%d, y=%d:%d (%dx%d de %dx%d)", nome_amostra, x0, x1, y0, y1,
+                     img_roi.shape[1], img_roi.shape[0], img.shape[1], img.shape[0])
+
+        chave_preprocessamento = (int(x), int(y), int(r_detectado_placa), margem)
+        img_masked, blurred = _estagio_em_cache(
+            cache_estagios, "preprocessamento", chave_preprocessamento,
+            lambda: preprocessar_placa(img_roi, gray[y0:y1, x0:x1], int(x) - x0, int(y) - y0, r_margem_calculada),
+            tempos_estagios,
+        )
+
+        # A segmentação só guarda as estatísticas por colônia; filtros posteriores não refazem o watershed
+        chave_segmentacao = (
+            chave_preprocessamento, int(local_max_filter_size), int(thresh_block_size), int(thresh_c), motor_segmentacao
+        )
+        stats = _estagio_em_cache(
+            cache_estagios, "segmentacao", chave_segmentacao,
+            lambda: segmentar_e_extrair(
+                img_masked, blurred, img_roi, nome_amostra, local_max_filter_size, thresh_block_size, thresh_c,
+                motor_segmentacao, deslocamento=(x0, y0), tempos_estagios=tempos_estagios, contadores=contadores,
+            ),
+        )
+        pixels_processados = img.shape[0] * img.shape[1]
+        pixels_placa = img_roi.shape[0] * img_roi.shape[1]
+    progresso("segmentada")
+
+    classificacoes_cores = []
+    total_desenhadas = 0
+    colony_data = []
+
+    AREA_MIN_COLONIA = float(area_min)
+    AREA_MAX_COLONIA_FATOR = 0.05
+    AREA_MAX_COLONIA = np.pi * (r_margem_calculada**2) * AREA_MAX_COLONIA_FATOR
+    CIRCULARIDADE_MIN = float(circularidade_min)
+    
+    logger.debug("[%s] Limites de filtro: AREA_MIN=%.2fpx, AREA_MAX=%.2fpx (baseado em r_margem_calculada=%d), "
+                 "CIRC_MIN=%.2f, PERIM_MIN=%.2fpx", nome_amostra, AREA_MIN_COLONIA, AREA_MAX_COLONIA,
+                 r_margem_calculada, CIRCULARIDADE_MIN, MIN_PERIMETER_THRESHOLD)
+
+    with medir_estagio(tempos_estagios, "marcadores"):
+        area = stats["area"]
+        perimeter = stats["perimetro"]
+        total_avaliadas = int(area.size)
+
+        restantes = np.ones(total_avaliadas, dtype=bool)
+        filtradas_area = (area < AREA_MIN_COLONIA) | (area > AREA_MAX_COLONIA)
+        restantes &= ~filtradas_area
+        filtradas_perimetro = restantes & (perimeter < MIN_PERIMETER_THRESHOLD)
+        restantes &= ~filtradas_perimetro
+        circularity = np.zeros(total_avaliadas, dtype=np.float64)
+        # Mesma ordem de operações do cálculo original, para o limite circularidade_min dar o mesmo resultado
+        np.divide(area, perimeter * perimeter, out=circularity, where=restantes)
+        circularity *= 4 * np.pi
+        filtradas_circularidade = restantes & (circularity < CIRCULARIDADE_MIN)
+        restantes &= ~filtradas_circularidade
+
+        centros_x = stats["cx"].astype(np.int64)
+        centros_y = stats["cy"].astype(np.int64)
+        dx = centros_x - int(x)
+        dy = centros_y - int(y)
+        fora_da_margem = restantes & (np.sqrt(dx * dx + dy * dy) > r_margem_calculada)
+        restantes &= ~fora_da_margem
+        raio_max_colonia = r_margem_calculada * float(max_colony_size_factor)
+        filtradas_tamanho = restantes & (stats["raio"] > raio_max_colonia)
+        restantes &= ~filtradas_tamanho
+        if logger.isEnabledFor(logging.DEBUG):
+            for radius_colonia_float in stats["raio"][filtradas_tamanho]:
+                logger.debug(
+                    "[%s] Colônia grande filtrada (raio colônia: %.2fpx > %s%% do r_margem_calculada da placa: %.2fpx)",
+                    nome_amostra, radius_colonia_float, float(max_colony_size_factor) * 100, raio_max_colonia,
+                )
+
+        total_filtradas_area = int(filtradas_area.sum())
+        total_filtradas_circularidade = int(filtradas_perimetro.sum() + filtradas_circularidade.sum())
+        total_filtradas_tamanho_maximo = int(filtradas_tamanho.sum())
+
+    aceitas = np.flatnonzero(restantes)
+    with medir_estagio(tempos_estagios, "classificacao"):
+        hsv_colonias = cv2.cvtColor(
+            stats["bgr_medio"][aceitas].astype(np.uint8).reshape(-1, 1, 3), cv2.COLOR_BGR2HSV
+        ).reshape(-1, 3) if aceitas.size else np.zeros((0, 3), dtype=np.uint8)
+        classificador = modelo_cor
+        tipos = classificar_cores(hsv_colonias, classificador)
+    for idx, hsv, tipo in zip(aceitas, hsv_colonias, tipos):
+        center_colonia = (int(centros_x[idx]), int(centros_y[idx]))
+        radius_colonia_int = int(stats["raio"][idx])
+        classificacoes_cores.append(tipo)
+        colony_data.append({
+            "h": int(hsv[0]),
+            "s": int(hsv[1]),
+            "v": int(hsv[2]),
+            "pred": tipo,
+            "cx": center_colonia[0],
+            "cy": center_colonia[1],
+            "r": radius_colonia_int,
+            "modelo_cor": classificador.versao,
+        })
+        total_desenhadas += 1
+    progresso("classificada")
+
+    resumo_contagem = dict(Counter(classificacoes_cores))
+    resumo_contagem['total'] = total_desenhadas
+    logger.debug("[%s] Resultados da contagem: Avaliadas=%d, Filtradas Área=%d, Filtradas Circ.=%d, "
+                 "Filtradas Tam.Max=%d, Desenhadas/Total Final=%d. Detalhe cores: %s",
+                 nome_amostra, total_avaliadas, total_filtradas_area, total_filtradas_circularidade,
+                 total_filtradas_tamanho_maximo, total_desenhadas, resumo_contagem)
+    if contadores is not None:
+        contadores.update(
+            pixels_originais=int(altura_orig) * int(largura_orig),
+            pixels_processados=pixels_processados,
+            pixels_placa=pixels_placa,
+            colonias_avaliadas=total_avaliadas,
+            colonias_contadas=total_desenhadas,
+        )
+
+    # --- Início da Lógica de Densidade e Estimativa (Limpa) ---
+    total_contado_na_subarea = resumo_contagem.get('total', 0)
+    
+    densidade_ufc_por_cm2 = 0.0
+    estimativa_ufc_placa_inteira = float(total_contado_na_subarea) 
+    area_efetiva_amostrada_cm2 = 0.0
+    fracao_amostrada = 0.0
+
+    logger.debug("[%s] Calculando densidade: r_detectado_placa=%s, r_margem_calculada=%d",
+                 nome_amostra, r_detectado_placa, r_margem_calculada)
+
+    area_pixels_subarea = np.pi * (r_margem_calculada ** 2)
+    # Usar conversão explícita para float para o raio ao quadrado por robustez
+    area_pixels_placa_inteira = np.pi * (float(r_detectado_placa) ** 2) 
+
+    if area_pixels_placa_inteira > 1e-6: 
+        fracao_amostrada = area_pixels_subarea / area_pixels_placa_inteira
+        logger.debug("[%s] Detalhes cálculo fração: r_margem_calculada=%dpx, r_detectado_placa=%spx. "
+                     "Área subárea (pixels): %.2f, Área placa inteira (pixels): %.2f. Fração Amostrada: %.4f",
+                     nome_amostra, r_margem_calculada, r_detectado_placa, area_pixels_subarea,
+                     area_pixels_placa_inteira, fracao_amostrada)
+
+        if fracao_amostrada > 1e-6: 
+            estimativa_ufc_placa_inteira = total_contado_na_subarea / fracao_amostrada
+            
+            if AREA_PADRAO_PLACA_CM2 > 1e-6:
+                densidade_ufc_por_cm2 = estimativa_ufc_placa_inteira / AREA_PADRAO_PLACA_CM2
+                area_efetiva_amostrada_cm2 = fracao_amostrada * AREA_PADRAO_PLACA_CM2
+            else:
+                logger.warning(f"[{nome_amostra}] AREA_PADRAO_PLACA_CM2 ({AREA_PADRAO_PLACA_CM2}) é inválida. ")
+        else:
+            logger.warning(f"[{nome_amostra}] Fração amostrada ({fracao_amostrada:.4f}) é muito pequena ou zero.")
+    else:
+        logger.error(f"[{nome_amostra}] Área da placa inteira em pixels ({area_pixels_placa_inteira:.2f}) é zero ou muito pequena.")
+
+    logger.debug("[%s] Resultados FINAIS dos cálculos de densidade/estimativa: "
+                 "Total Contado Subárea: %d UFC, Fração Amostrada (usada): %.4f, "
+                 "Estimativa Placa Inteira: %.2f UFC, Área Amostrada (cm²): %.2f cm², "
+                 "Densidade (UFC/cm²): %.2f UFC/cm²",
+                 nome_amostra, total_contado_na_subarea, fracao_amostrada, estimativa_ufc_placa_inteira,
+                 area_efetiva_amostrada_cm2, densidade_ufc_por_cm2)
+    # --- Fim da Lógica de Densidade e Estimativa ---
+
+    imagem_processada = None
+    if renderizar:
+        texto_cabecalho = linhas_legenda(
+            nome_amostra, total_contado_na_subarea, densidade_ufc_por_cm2, estimativa_ufc_placa_inteira
+        )
+        with medir_estagio(tempos_estagios, "desenho"):
+            desenhar = desenhar_anotacoes(img, colony_data, texto_cabecalho)
+        with medir_estagio(tempos_estagios, "encode"):
+            imagem_processada = BytesIO(codificar_imagem(desenhar))
+        progresso("renderizada")
+
+    feedback_headers = {
+        "X-Resumo-Total": str(total_contado_na_subarea),
+        "X-Resumo-Amarela": str(resumo_contagem.get('amarela',0)),
+        "X-Resumo-Bege": str(resumo_contagem.get('bege',0)),
+        "X-Resumo-Clara": str(resumo_contagem.get('clara',0)),
+        "X-Resumo-Rosada": str(resumo_contagem.get('rosada',0)),
+        "X-Feedback-Avaliadas": str(total_avaliadas),
+        "X-Feedback-Filtradas-Area": str(total_filtradas_area),
+        "X-Feedback-Filtradas-Circularidade": str(total_filtradas_circularidade),
+        "X-Feedback-Filtradas-Tamanho-Maximo": str(total_filtradas_tamanho_maximo),
+        "X-Feedback-Desenhadas": str(total_desenhadas),
+        "X-Feedback-Raio-Detectado-Px": str(r_detectado_placa),
+        "X-Feedback-Confianca-Placa": "manual" if confianca_placa is None else f"{confianca_placa:.2f}",
+        "X-Feedback-Area-Amostrada-Cm2": f"{area_efetiva_amostrada_cm2:.2f}",
+        "X-Feedback-Densidade-Colonias-Cm2": f"{densidade_ufc_por_cm2:.2f}",
+        "X-Feedback-Estimativa-Total-Colonias": f"{round(estimativa_ufc_placa_inteira):.0f}",
+        "X-Motor-Segmentacao": motor_segmentacao,
+        "X-Modelo-Cor": classificador.versao,
+    }
+    
+    logger.debug("[%s] Processamento total da imagem levou: %.4fs. Estágios: %s", nome_amostra,
+                 time.perf_counter() - inicio_processamento,
+                 {nome: round(duracao, 4) for nome, duracao in (tempos_estagios or {}).items()})
+    return resumo_contagem, imagem_processada, feedback_headers, colony_data
+
+
+def _com_faixa_legenda(img, texto_cabecalho):
+    """``img`` com a legenda em uma faixa preta abaixo, sem cobrir placas vizinhas ao canto superior.
+
+    As coordenadas da imagem original continuam válidas na imagem resultante.
+    """
+    faixa = np.zeros((22 * len(texto_cabecalho) + 30, img.shape[1], 3), dtype=img.dtype)
+    desenhar_legenda(faixa, texto_cabecalho)
+    return np.vstack([img, faixa])
+
+
+def processar_placas(
+    imagem_bytes: bytes,
+    nome_amostra: str,
+    max_placas: int = PLACAS_MAX,
+    imagens: str = "combinada",
+    alta_resolucao: bool = False,
+    tempos_estagios=None,
+    contadores=None,
+    **parametros,
+):
+    """Conta as colônias de cada placa de uma foto com várias placas.
+
+    A imagem é decodificada uma vez e as placas de detectar_placas são processadas em paralelo
+    (PLACAS_WORKERS threads) por processar_imagem, que recebe a decodificação e o círculo da placa
+    já prontos em ``cache_estagios``; ``parametros`` são os demais argumentos de processar_imagem.
+    ``imagens`` escolhe entre uma imagem anotada com todas as placas ("combinada"), um recorte
+    anotado por placa ("por_placa") ou nenhuma ("nenhuma").
+
+    Retorna (resumo somado, lista de imagens JPEG, cabeçalhos somados, placas), onde cada placa é um
+    dict com o número, o círculo em pixels da imagem original, a confiança, os cabeçalhos e colony_data.
+    """
+    if imagens not in MODOS_IMAGEM_PLACAS:
+        raise ValueError(f"imagens deve ser um de: {', '.join(MODOS_IMAGEM_PLACAS)}")
+    ingestao = decodificar_imagem(imagem_bytes, nome_amostra, tempos_estagios, nativa=alta_resolucao)
+    img, gray, altura_orig, largura_orig = ingestao[:4]
+    with medir_estagio(tempos_estagios, "placa"):
+        circulos = detectar_placas(gray, max_placas)
+    if not circulos:
+        logger.warning(f"[{nome_amostra}] Nenhuma placa detectada automaticamente.")
+        raise HTTPException(status_code=422, detail="Nenhuma placa de Petri detectada automaticamente.")
+    logger.debug("[%s] %d placas detectadas", nome_amostra, len(circulos))
+
+    def processar_placa(numero_circulo):
+        numero, circulo = numero_circulo
+        cache_placa = {
+            "ingestao_nativa" if alta_resolucao else "ingestao": (None, ingestao),
+            "placa": ((None, None, None), circulo),
+        }
+        tempos, contadores_placa = {}, {}
+        resultado = processar_imagem(
+            imagem_bytes, f"{nome_amostra} - placa {numero}", alta_resolucao=alta_resolucao, renderizar=False,
+            cache_estagios=cache_placa, tempos_estagios=tempos, contadores=contadores_placa, **parametros,
+        )
+        return resultado, tempos, contadores_placa
+
+    with ThreadPoolExecutor(max_workers=max(1, min(PLACAS_WORKERS, len(circulos)))) as executor_placas:
+        resultados = list(executor_placas.map(processar_placa, enumerate(circulos, 1)))
+
+    escala_x, escala_y = largura_orig / img.shape[1], altura_orig / img.shape[0]
+    resumo_total = Counter()
+    placas = []
+    for numero, ((x, y, r, confianca), ((resumo, _, headers, colony_data), tempos, contadores_placa)) in enumerate(
+        zip(circulos, resultados), 1
+    ):
+        resumo_total.update(resumo)
+        placas.append({
+            "placa": numero,
+            "x": round(x * escala_x),
+            "y": round(y * escala_y),
+            "r": round(r * (escala_x + escala_y) / 2),
+            "confianca": round(confianca, 2),
+            "nome_amostra": f"{nome_amostra} - placa {numero}",
+            "resumo": headers,
+            "colony_data": colony_data,
+        })
+        if tempos_estagios is not None:
+            # Soma do tempo das placas (tempo de CPU, maior que o tempo de parede quando em paralelo)
+            for nome, duracao in tempos.items():
+                tempos_estagios[nome] = tempos_estagios.get(nome, 0.0) + duracao
+        if contadores is not None:
+            for nome, valor in contadores_placa.items():
+                if nome not in ("pixels_originais", "pixels_processados"):
+                    contadores[nome] = contadores.get(nome, 0) + valor
+            contadores.update(
+                pixels_originais=contadores_placa["pixels_originais"],
+                pixels_processados=contadores_placa["pixels_processados"],
+            )
+    resumo_total = dict(resumo_total)
+
+    imagens_anotadas = []
+    if imagens != "nenhuma":
+        with medir_estagio(tempos_estagios, "desenho"):
+            if imagens == "combinada":
+                desenhar = img.copy()
+                for placa, (x, y, r, _) in zip(placas, circulos):
+                    desenhar_colonias(desenhar, placa["colony_data"])
+                    cv2.circle(desenhar, (x, y), r, (255, 0, 0), 2)
+                    cv2.putText(desenhar, f"{placa['placa']}: {placa['resumo']['X-Resumo-Total']} UFC",
+                                (max(x - r, 0), max(y - r - 8, 15)), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 0, 0),
+                                2, cv2.LINE_AA)
+                recortes = [_com_faixa_legenda(desenhar, [
+                    nome_amostra,
+                    (datetime.now(timezone.utc) - timedelta(hours=3)).strftime('%Y-%m-%d %H:%M:%S'),
+                    f"Placas: {len(placas)}",
+                    f"Contagem TOTAL: {resumo_total.get('total', 0)} UFC",
+                ])]
+            else:
+                recortes = []
+                for placa, (x, y, r, _) in zip(placas, circulos):
+                    y0, y1, x0, x1 = recorte_placa(img.shape, x, y, r, 4)
+                    recorte = img[y0:y1, x0:x1].copy()
+                    desenhar_colonias(recorte, placa["colony_data"], deslocamento=(x0, y0))
+                    recortes.append(_com_faixa_legenda(recorte, linhas_legenda(
+                        placa["nome_amostra"], placa["resumo"]["X-Resumo-Total"],
+                        float(placa["resumo"]["X-Feedback-Densidade-Colonias-Cm2"]),
+                        float(placa["resumo"]["X-Feedback-Estimativa-Total-Colonias"]),
+                    )))
+        with medir_estagio(tempos_estagios, "encode"):
+            imagens_anotadas = [codificar_imagem(recorte) for recorte in recortes]
+
+    headers = {
+        "X-Placas-Detectadas": str(len(placas)),
+        "X-Resumo-Total": str(resumo_total.get('total', 0)),
+        "X-Resumo-Amarela": str(resumo_total.get('amarela', 0)),
+        "X-Resumo-Bege": str(resumo_total.get('bege', 0)),
+        "X-Resumo-Clara": str(resumo_total.get('clara', 0)),
+        "X-Resumo-Rosada": str(resumo_total.get('rosada', 0)),
+        "X-Motor-Segmentacao": parametros.get("motor_segmentacao", "watershed"),
+        # Uma troca de modelo no meio da foto pode fazer placas diferentes usarem versões diferentes
+        "X-Modelo-Cor": ",".join(sorted({placa["resumo"]["X-Modelo-Cor"] for placa in placas})),
+    }
+    return resumo_total, imagens_anotadas, headers, placas
+
+class ErroProcessamento(Exception):
+    """Erro HTTP levantado dentro de um worker; HTTPException não é serializável entre processos."""
+
+    def __init__(self, status_code, detail):
+        super().__init__(status_code, detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+# Progresso das tarefas assíncronas (/tarefas/): os workers enviam (tarefa_id, etapa) por uma fila
+# multiprocessing criada no processo principal e repassada a cada worker na inicialização do pool
+_fila_progresso = None
+
+
+def obter_fila_progresso():
+    global _fila_progresso
+    if _fila_progresso is None:
+        _fila_progresso = multiprocessing.get_context("spawn").Queue()
+    return _fila_progresso
+
+
+def fechar_fila_progresso():
+    """Libera a fila (e seus semáforos) depois que os pools foram encerrados."""
+    global _fila_progresso
+    if _fila_progresso is not None:
+        _fila_progresso.close()
+        _fila_progresso = None
+
+
+# Cancelamento de tarefas em execução: o processo principal grava o número da tarefa cancelada na posição
+# numero % TAREFAS_POSICOES_CANCELAMENTO de um vetor compartilhado, e o worker confere a cada etapa
+TAREFAS_POSICOES_CANCELAMENTO = 4096
+_tarefas_canceladas = None
+
+
+def obter_tarefas_canceladas():
+    global _tarefas_canceladas
+    if _tarefas_canceladas is None:
+        _tarefas_canceladas = multiprocessing.get_context("spawn").RawArray("q", TAREFAS_POSICOES_CANCELAMENTO)
+    return _tarefas_canceladas
+
+
+def marcar_tarefa_cancelada(numero):
+    obter_tarefas_canceladas()[numero % TAREFAS_POSICOES_CANCELAMENTO] = numero
+
+
+def tarefa_cancelada(numero):
+    return _tarefas_canceladas is not None and _tarefas_canceladas[numero % TAREFAS_POSICOES_CANCELAMENTO] == numero
+
+
+class TarefaCancelada(Exception):
+    """Interrompe processar_imagem entre duas etapas quando a tarefa foi cancelada."""
+
+
+class AvisoProgresso:
+    """Callback ``progresso`` de processar_imagem para a tarefa ``tarefa_id``; serializável entre processos.
+
+    Com ``numero`` (o da Tarefa) também interrompe a análise na próxima etapa se a tarefa for cancelada.
+    """
+
+    def __init__(self, tarefa_id, numero=None):
+        self.tarefa_id = tarefa_id
+        self.numero = numero
+
+    def __call__(self, etapa):
+        if self.numero is not None and tarefa_cancelada(self.numero):
+            raise TarefaCancelada(self.tarefa_id)
+        _fila_progresso.put((self.tarefa_id, etapa))
+
+
+# Troca do modelo de cor nos workers: o processo principal incrementa um contador compartilhado a cada
+# modelo ativado e o worker que fica para trás recarrega em segundo plano ao começar a próxima tarefa
+_geracao_modelo_cor = None
+_geracao_modelo_cor_local = 0
+_lock_recarga_modelo_cor = threading.Lock()
+
+
+def obter_geracao_modelo_cor():
+    global _geracao_modelo_cor
+    if _geracao_modelo_cor is None:
+        _geracao_modelo_cor = multiprocessing.get_context("spawn").RawValue("q", 0)
+    return _geracao_modelo_cor
+
+
+def recarregar_modelo_cor():
+    """Recarrega o modelo no processo principal e, se ele foi ativado, avisa os workers do pool."""
+    global _geracao_modelo_cor_local
+    with _lock_recarga_modelo_cor:
+        ativado, resultado = carregar_modelo_cor()
+        if ativado and _geracao_modelo_cor is not None:
+            _geracao_modelo_cor.value += 1
+            _geracao_modelo_cor_local = _geracao_modelo_cor.value
+    return ativado, resultado
+
+
+def _sincronizar_modelo_cor():
+    global _geracao_modelo_cor_local
+    if _geracao_modelo_cor is None or _geracao_modelo_cor.value == _geracao_modelo_cor_local:
+        return
+    _geracao_modelo_cor_local = _geracao_modelo_cor.value
+    # A tarefa atual segue com o modelo ativo; as próximas usam o novo quando a carga terminar
+    threading.Thread(target=carregar_modelo_cor, name="recarregar-modelo-cor", daemon=True).start()
+
+
+def _inicializar_worker(opencv_threads, fila_progresso=None, geracao_modelo_cor=None, workers_prontos=None,
+                        tarefas_canceladas=None):
+    global _fila_progresso, _geracao_modelo_cor, _geracao_modelo_cor_local, _tarefas_canceladas
+    cv2.setNumThreads(opencv_threads)
+    if fila_progresso is not None:
+        _fila_progresso = fila_progresso
+    if tarefas_canceladas is not None:
+        _tarefas_canceladas = tarefas_canceladas
+    if geracao_modelo_cor is not None:
+        _geracao_modelo_cor = geracao_modelo_cor
+        _geracao_modelo_cor_local = geracao_modelo_cor.value
+    # Sem esperar, as primeiras tarefas do worker seriam classificadas pelas regras HSV
+    aguardar_modelo_cor()
+    if workers_prontos is not None:
+        with workers_prontos.get_lock():
+            workers_prontos.value += 1
+
+
+def _aquecer_worker():
+    return modelo_cor.versao
+
+
+def _executar_com_medicoes(funcao, *args, **kwargs):
+    """Roda ``funcao`` e devolve o resultado seguido das medições (tempos por estágio e contadores)."""
+    _sincronizar_modelo_cor()
+    medicoes = {"tempos": {}, "contadores": {}}
+    inicio = time.perf_counter()
+    try:
+        resultado = funcao(*args, tempos_estagios=medicoes["tempos"], contadores=medicoes["contadores"], **kwargs)
+    except HTTPException as e:
+        raise ErroProcessamento(e.status_code, e.detail)
+    medicoes["processamento_s"] = time.perf_counter() - inicio
+    return (*resultado, medicoes)
+
+
+def _processar_imagem_worker(*args, **kwargs):
+    return _executar_com_medicoes(processar_imagem, *args, **kwargs)
+
+
+def _processar_placas_worker(*args, **kwargs):
+    return _executar_com_medicoes(processar_placas, *args, **kwargs)
+
+
+class ExecutorProcessamento:
+    """Pool limitado de workers para o pipeline, com fila máxima e timeout por tarefa."""
+
+    def __init__(self, workers, max_fila, timeout_s, opencv_threads, usar_processos=True):
+        self.workers = workers
+        self.usar_processos = usar_processos
+        self.max_fila = max_fila
+        self.timeout_s = timeout_s
+        self.opencv_threads = opencv_threads
+        self.em_execucao = 0
+        self.aguardando = 0
+        self._pool = None
+        self._vaga_liberada = None
+        self._workers_prontos = None
+
+    @property
+    def capacidade(self):
+        return max(1, self.workers) + self.max_fila
+
+    @property
+    def processando(self):
+        return min(self.em_execucao, max(1, self.workers))
+
+    @property
+    def em_fila(self):
+        """Tarefas submetidas aguardando um worker mais as que aguardam uma vaga (lotes)."""
+        return self.em_execucao - self.processando + self.aguardando
+
+    @property
+    def usa_processos(self):
+        return self.workers > 0 and self.usar_processos
+
+    @property
+    def workers_prontos(self):
+        """Workers do pool que já terminaram de carregar o modelo de cor."""
+        if not self.usa_processos:
+            return max(1, self.workers) if _modelo_cor_carregado.is_set() else 0
+        return self._workers_prontos.value if self._workers_prontos is not None else 0
+
+    @property
+    def pronto(self):
+        return self.workers_prontos >= max(1, self.workers)
+
+    def _obter_pool(self):
+        if self._pool is None:
+            if self.usa_processos:
+                contexto = multiprocessing.get_context("spawn")
+                self._workers_prontos = contexto.Value("i", 0)
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=contexto,
+                    initializer=_inicializar_worker,
+                    initargs=(
+                        self.opencv_threads, obter_fila_progresso(), obter_geracao_modelo_cor(), self._workers_prontos,
+                        obter_tarefas_canceladas(),
+                    ),
+                )
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=max(1, self.workers))
+            logger.info(
+                f"Pool de processamento iniciado: workers={self.workers}, fila máxima={self.max_fila}, "
+                f"timeout={self.timeout_s}s, threads OpenCV por worker={self.opencv_threads}"
+            )
+        return self._pool
+
+    def _liberar(self, _future):
+        self.em_execucao -= 1
+        if self._vaga_liberada is not None:
+            self._vaga_liberada.set()
+
+    async def aguardar_vaga(self):
+        if self._vaga_liberada is None:
+            self._vaga_liberada = asyncio.Event()
+        if self.em_execucao < self.capacidade:
+            return
+        self.aguardando += 1
+        try:
+            while self.em_execucao >= self.capacidade:
+                self._vaga_liberada.clear()
+                await self._vaga_liberada.wait()
+        finally:
+            self.aguardando -= 1
+
+    async def executar(self, funcao, *args, esperar_vaga=False, **kwargs):
+        """Executa ``funcao`` no pool. Com ``esperar_vaga`` aguarda uma vaga na fila em vez de retornar 503."""
+        if esperar_vaga:
+            await self.aguardar_vaga()
+        if self.em_execucao >= self.capacidade:
+            raise HTTPException(
+                status_code=503,
+                detail="Servidor ocupado processando outras imagens. Tente novamente em instantes.",
+                headers={"Retry-After": str(PROCESS_POOL_RETRY_AFTER_S)},
+            )
+        loop = asyncio.get_running_loop()
+        try:
+            future = self._obter_pool().submit(funcao, *args, **kwargs)
+        except BrokenProcessPool:
+            self.reiniciar()
+            future = self._obter_pool().submit(funcao, *args, **kwargs)
+        self.em_execucao += 1
+        # A vaga só é liberada quando a tarefa termina de fato, mesmo após um timeout
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(self._liberar, f))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.timeout_s)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="Tempo limite de processamento excedido.")
+        except ErroProcessamento as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+        except BrokenProcessPool:
+            logger.error("Pool de processamento quebrado (worker encerrado); recriando.")
+            self.reiniciar()
+            raise
+
+    def aquecer(self):
+        """Inicia todos os workers do pool de uma vez, em vez de um a um nas primeiras tarefas."""
+        if not self.usa_processos:
+            return
+        pool = self._obter_pool()
+        for _ in range(self.workers):
+            pool.submit(_aquecer_worker)
+
+    def reiniciar(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+            self._workers_prontos = None
+            self.aquecer()
+
+    def encerrar(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+            self._workers_prontos = None
+
+
+executor_processamento = ExecutorProcessamento(
+    PROCESS_POOL_WORKERS, PROCESS_POOL_MAX_QUEUE, PROCESS_JOB_TIMEOUT_S, OPENCV_THREADS_PER_WORKER
+)
+
+# Sessões de ajuste de parâmetros: a imagem é enviada uma vez e os estágios ficam em cache
+SESSAO_WORKERS = int(os.getenv("SESSAO_WORKERS", "2"))
+SESSAO_TTL_S = float(os.getenv("SESSAO_TTL_S", "900"))
+SESSAO_MAX_MB = float(os.getenv("SESSAO_MAX_MB", "512"))
+
+
+def _tamanho_bytes(valor):
+    if isinstance(valor, np.ndarray):
+        return valor.nbytes
+    if isinstance(valor, (bytes, bytearray)):
+        return len(valor)
+    if isinstance(valor, dict):
+        return sum(_tamanho_bytes(v) for v in valor.values())
+    if isinstance(valor, (tuple, list)):
+        return sum(_tamanho_bytes(v) for v in valor)
+    return 0
+
+
+class SessaoAjuste:
+    def __init__(self, imagem_bytes, nome_amostra):
+        self.imagem_bytes = imagem_bytes
+        self.nome_amostra = nome_amostra
+        self.estagios = {}
+        self.lock = threading.Lock()
+        self.ultimo_acesso = time.monotonic()
+        self.tamanho_bytes = len(imagem_bytes)
+
+
+class CacheSessoes:
+    """Sessões de ajuste em memória, com expiração por TTL e remoção LRU acima do limite de memória."""
+
+    def __init__(self, max_bytes, ttl_s):
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self._sessoes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def criar(self, imagem_bytes, nome_amostra):
+        sessao_id = uuid.uuid4().hex
+        with self._lock:
+            self._sessoes[sessao_id] = SessaoAjuste(imagem_bytes, nome_amostra)
+            self._aplicar_limites()
+        return sessao_id
+
+    def obter(self, sessao_id):
+        with self._lock:
+            self._aplicar_limites()
+            sessao = self._sessoes.get(sessao_id)
+            if sessao is not None:
+                sessao.ultimo_acesso = time.monotonic()
+                self._sessoes.move_to_end(sessao_id)
+            return sessao
+
+    def remover(self, sessao_id):
+        with self._lock:
+            return self._sessoes.pop(sessao_id, None) is not None
+
+    def __len__(self):
+        return len(self._sessoes)
+
+    def atualizar_tamanho(self, sessao):
+        with self._lock:
+            sessao.tamanho_bytes = len(sessao.imagem_bytes) + _tamanho_bytes(sessao.estagios)
+            self._aplicar_limites()
+
+    def _aplicar_limites(self):
+        agora = time.monotonic()
+        for sessao_id in [k for k, v in self._sessoes.items() if agora - v.ultimo_acesso > self.ttl_s]:
+            del self._sessoes[sessao_id]
+        total = sum(v.tamanho_bytes for v in self._sessoes.values())
+        # Remove as menos usadas, mas nunca a mais recente
+        while total > self.max_bytes and len(self._sessoes) > 1:
+            _, removida = self._sessoes.popitem(last=False)
+            total -= removida.tamanho_bytes
+
+
+cache_sessoes = CacheSessoes(int(SESSAO_MAX_MB * 1024 * 1024), SESSAO_TTL_S)
+# Os estágios em cache vivem na memória deste processo, por isso as sessões usam threads
+executor_sessoes = ExecutorProcessamento(
+    SESSAO_WORKERS, PROCESS_POOL_MAX_QUEUE, PROCESS_JOB_TIMEOUT_S, OPENCV_THREADS_PER_WORKER, usar_processos=False
+)
+
+
+def _processar_sessao_worker(sessao, nome_amostra, **parametros):
+    with sessao.lock:
+        try:
+            return _processar_imagem_worker(
+                sessao.imagem_bytes, nome_amostra, cache_estagios=sessao.estagios, **parametros
+            )
+        finally:
+            cache_sessoes.atualizar_tamanho(sessao)
+
+
+_parar_observador_modelo_cor = threading.Event()
+
+
+def _observar_modelo_cor():
+    """Recarrega o modelo de cor quando o arquivo dele ou a LUT mudam."""
+    aguardar_modelo_cor()
+    pendente = None
+    while not _parar_observador_modelo_cor.wait(COLOR_MODEL_WATCH_S):
+        assinatura = assinatura_arquivos_modelo_cor()
+        if assinatura == _assinatura_modelo_cor:
+            pendente = None
+        elif assinatura != pendente:
+            # Espera os arquivos ficarem iguais por uma verificação inteira, para não ler uma cópia em andamento
+            pendente = assinatura
+        else:
+            pendente = None
+            try:
+                recarregar_modelo_cor()
+            except Exception:
+                logger.exception("Erro ao recarregar o modelo de cor")
+
+
+@app.on_event("startup")
+def iniciar_observador_modelo_cor():
+    if COLOR_MODEL_WATCH_S > 0:
+        threading.Thread(target=_observar_modelo_cor, name="observar-modelo-cor", daemon=True).start()
+
+
+@app.on_event("startup")
+def aquecer_pool_processamento():
+    # Os workers carregam o modelo de cor já no início; /pronto só responde 200 depois disso
+    executor_processamento.aquecer()
+
+
+@app.on_event("shutdown")
+def encerrar_backend():
+    _parar_observador_modelo_cor.set()
+    gerenciador_tarefas.encerrar()
+    executor_processamento.encerrar()
+    executor_sessoes.encerrar()
+    fechar_fila_progresso()
+    gravador_logs.encerrar()
+    PENDING_FEEDBACK.fechar()
+
+
+# Métricas agregadas em memória, expostas em /metrics no formato texto do Prometheus
+METRICAS_LIMITES_S = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICAS_LIMITES_PIXELS = (2.5e5, 5e5, 1e6, 2e6, 4e6, 8e6, 1.6e7, 3.2e7, 6.4e7)
+METRICAS_LIMITES_COLONIAS = (0, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+def _rotulos_prometheus(nomes, valores):
+    def escapar(valor):
+        return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return ",".join(f'{nome}="{escapar(valor)}"' for nome, valor in zip(nomes, valores))
+
+
+class Histograma:
+    """Histograma cumulativo (buckets ``le``) com rótulos, no formato do Prometheus."""
+
+    def __init__(self, nome, descricao, limites, rotulos=()):
+        self.nome = nome
+        self.descricao = descricao
+        self.limites = tuple(limites)
+        self.rotulos = tuple(rotulos)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observar(self, valor, *valores_rotulos):
+        indice = bisect.bisect_left(self.limites, valor)
+        with self._lock:
+            serie = self._series.get(valores_rotulos)
+            if serie is None:
+                serie = self._series[valores_rotulos] = [[0] * (len(self.limites) + 1), 0.0]
+            serie[0][indice] += 1
+            serie[1] += valor
+
+    def exportar(self):
+        linhas = [f"# HELP {self.nome} {self.descricao}", f"# TYPE {self.nome} histogram"]
+        with self._lock:
+            series = sorted((chave, list(contagens), soma) for chave, (contagens, soma) in self._series.items())
+        for valores_rotulos, contagens, soma in series:
+            rotulos = _rotulos_prometheus(self.rotulos, valores_rotulos)
+            prefixo = rotulos + "," if rotulos else ""
+            acumulado = 0
+            for limite, contagem in zip(self.limites + (float("inf"),), contagens):
+                acumulado += contagem
+                le = "+Inf" if limite == float("inf") else f"{limite:g}"
+                linhas.append(f'{self.nome}_bucket{{{prefixo}le="{le}"}} {acumulado}')
+            sufixo = f"{{{rotulos}}}" if rotulos else ""
+            linhas.append(f"{self.nome}_sum{sufixo} {soma:.6f}")
+            linhas.append(f"{self.nome}_count{sufixo} {acumulado}")
+        return linhas
+
+
+class Contador:
+    """Contador monotônico com rótulos, no formato do Prometheus."""
+
+    def __init__(self, nome, descricao, rotulos=()):
+        self.nome = nome
+        self.descricao = descricao
+        self.rotulos = tuple(rotulos)
+        self._valores = {}
+        self._lock = threading.Lock()
+
+    def incrementar(self, *valores_rotulos, valor=1):
+        with self._lock:
+            self._valores[valores_rotulos] = self._valores.get(valores_rotulos, 0) + valor
+
+    def exportar(self):
+        linhas = [f"# HELP {self.nome} {self.descricao}", f"# TYPE {self.nome} counter"]
+        with self._lock:
+            valores = sorted(self._valores.items())
+        for valores_rotulos, valor in valores:
+            rotulos = _rotulos_prometheus(self.rotulos, valores_rotulos)
+            linhas.append(f"{self.nome}{{{rotulos}}} {valor}" if rotulos else f"{self.nome} {valor}")
+        return linhas
+
+
+def _medidor(nome, descricao, valores):
+    """Linhas de um gauge; ``valores`` é uma lista de (dict de rótulos, valor)."""
+    linhas = [f"# HELP {nome} {descricao}", f"# TYPE {nome} gauge"]
+    for rotulos, valor in valores:
+        texto_rotulos = _rotulos_prometheus(rotulos.keys(), rotulos.values())
+        linhas.append(f"{nome}{{{texto_rotulos}}} {valor}" if texto_rotulos else f"{nome} {valor}")
+    return linhas
+
+
+class MetricasServidor:
+    """Agrega durações por estágio, contagens de pixels/colônias e requisições por endpoint."""
+
+    def __init__(self, prefixo="contador_colonias"):
+        self.prefixo = prefixo
+        self.requisicoes = Contador(
+            f"{prefixo}_requisicoes_total", "Requisições HTTP atendidas", ("endpoint", "metodo", "status")
+        )
+        self.duracao_requisicao = Histograma(
+            f"{prefixo}_requisicao_duracao_segundos", "Duração das requisições HTTP até o início da resposta",
+            METRICAS_LIMITES_S, ("endpoint",),
+        )
+        self.duracao_estagio = Histograma(
+            f"{prefixo}_estagio_duracao_segundos", "Duração de cada estágio de processar_imagem",
+            METRICAS_LIMITES_S, ("estagio",),
+        )
+        self.duracao_processamento = Histograma(
+            f"{prefixo}_processamento_duracao_segundos", "Duração de processar_imagem no worker", METRICAS_LIMITES_S,
+        )
+        self.espera_fila = Histograma(
+            f"{prefixo}_fila_espera_segundos", "Espera na fila do pool mais transferência entre processos",
+            METRICAS_LIMITES_S,
+        )
+        self.pixels = Histograma(
+            f"{prefixo}_pixels", "Pixels por imagem (originais, processados e do recorte da placa)",
+            METRICAS_LIMITES_PIXELS, ("tipo",),
+        )
+        self.colonias = Histograma(
+            f"{prefixo}_colonias_por_imagem", "Regiões avaliadas e colônias contadas por imagem",
+            METRICAS_LIMITES_COLONIAS, ("tipo",),
+        )
+
+    def registrar_requisicao(self, endpoint, metodo, status, duracao_s):
+        self.requisicoes.incrementar(endpoint, metodo, str(status))
+        self.duracao_requisicao.observar(duracao_s, endpoint)
+
+    def registrar_processamento(self, medicoes, espera_s):
+        for estagio, duracao in medicoes["tempos"].items():
+            self.duracao_estagio.observar(duracao, estagio)
+        self.duracao_processamento.observar(medicoes["processamento_s"])
+        self.espera_fila.observar(espera_s)
+        contadores = medicoes["contadores"]
+        for tipo in ("originais", "processados", "placa"):
+            if f"pixels_{tipo}" in contadores:
+                self.pixels.observar(contadores[f"pixels_{tipo}"], tipo)
+        for tipo in ("avaliadas", "contadas"):
+            if f"colonias_{tipo}" in contadores:
+                self.colonias.observar(contadores[f"colonias_{tipo}"], tipo)
+
+    def exportar(self, executores):
+        linhas = []
+        for metrica in (self.requisicoes, self.duracao_requisicao, self.duracao_estagio, self.duracao_processamento,
+                        self.espera_fila, self.pixels, self.colonias):
+            linhas.extend(metrica.exportar())
+        linhas.extend(_medidor(f"{self.prefixo}_pool_em_execucao", "Tarefas sendo processadas por um worker",
+                               [({"executor": nome}, e.processando) for nome, e in executores.items()]))
+        linhas.extend(_medidor(f"{self.prefixo}_pool_fila", "Tarefas aguardando um worker",
+                               [({"executor": nome}, e.em_fila) for nome, e in executores.items()]))
+        linhas.extend(_medidor(f"{self.prefixo}_pool_capacidade", "Tarefas aceitas antes de responder 503",
+                               [({"executor": nome}, e.capacidade) for nome, e in executores.items()]))
+        linhas.extend(_medidor(f"{self.prefixo}_sessoes_ativas", "Sessões de ajuste em memória",
+                               [({}, len(cache_sessoes))]))
+        linhas.extend(_medidor(f"{self.prefixo}_tokens_feedback", "Tokens de feedback armazenados",
+                               [({}, len(PENDING_FEEDBACK))]))
+        return "\n".join(linhas) + "\n"
+
+
+metricas = MetricasServidor()
+
+
+def cabecalho_server_timing(tempos, **extras):
+    """Monta o cabeçalho Server-Timing (durações em ms) a partir de tempos em segundos."""
+    itens = list(tempos.items()) + [(nome, duracao) for nome, duracao in extras.items() if duracao is not None]
+    return ", ".join(f"{nome};dur={duracao * 1000:.1f}" for nome, duracao in itens)
+
+
+async def executar_contagem(executor, funcao, *args, **kwargs):
+    """Executa o pipeline no ``executor``, registra as métricas e adiciona o cabeçalho Server-Timing.
+
+    Retorna a mesma tupla de processar_imagem.
+    """
+    inicio = time.perf_counter()
+    resumo, imagem, headers, colony_data, medicoes = await executor.executar(funcao, *args, **kwargs)
+    total_s = time.perf_counter() - inicio
+    espera_s = max(0.0, total_s - medicoes["processamento_s"])
+    metricas.registrar_processamento(medicoes, espera_s)
+    headers["Server-Timing"] = cabecalho_server_timing(medicoes["tempos"], fila=espera_s, total=total_s)
+    return resumo, imagem, headers, colony_data
+
+
+def descrever_erro_contagem(erro, nome_amostra):
+    """Registra a falha de uma contagem e retorna (status HTTP, mensagem); chamar dentro do ``except``."""
+    if isinstance(erro, HTTPException):
+        logger.warning(f"HTTPException para {nome_amostra}: {erro.detail} (Status: {erro.status_code})")
+        return erro.status_code, erro.detail
+    if isinstance(erro, ValueError):
+        logger.error(f"Erro de valor (ex: decodificação) para {nome_amostra}: {str(erro)}")
+        return 400, str(erro)
+    logger.exception(f"Erro interno inesperado durante o processamento para {nome_amostra}")
+    return 500, "Erro interno no servidor. Tente novamente mais tarde."
+
+
+@contextmanager
+def erros_de_contagem(nome_amostra):
+    """Converte falhas do bloco em HTTPException (400 para ValueError, 500 para as inesperadas)."""
+    try:
+        yield
+    except HTTPException as e:
+        descrever_erro_contagem(e, nome_amostra)
+        raise
+    except Exception as e:
+        status_code, detail = descrever_erro_contagem(e, nome_amostra)
+        raise HTTPException(status_code=status_code, detail=detail)
+
+
+@app.middleware("http")
+async def medir_requisicao(request, call_next):
+    inicio = time.perf_counter()
+    status = 500
+    try:
+        resposta = await call_next(request)
+        status = resposta.status_code
+        return resposta
+    finally:
+        rota = request.scope.get("route")
+        endpoint = getattr(rota, "path", None) or "nao_encontrado"
+        metricas.registrar_requisicao(endpoint, request.method, status, time.perf_counter() - inicio)
+
+
+# Cache de resultados de /contar/ endereçado pelo conteúdo (hash da imagem + parâmetros da análise).
+# Guarda só contagens e colônias: a imagem anotada é redesenhada a cada acerto, com a legenda do pedido.
+# Desativado com RESULT_CACHE_MAX_MB=0; RESULT_CACHE_DIR habilita a camada em disco.
+RESULT_CACHE_MAX_MB = float(os.getenv("RESULT_CACHE_MAX_MB", "0"))
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR") or None
+RESULT_CACHE_DISK_MAX_MB = float(os.getenv("RESULT_CACHE_DISK_MAX_MB", "1024"))
+
+
+def chave_resultado(imagem_bytes, **parametros):
+    """Hash SHA-256 dos bytes da imagem e dos parâmetros normalizados do formulário."""
+    normalizados = {}
+    for nome, valor in sorted(parametros.items()):
+        if valor is None or isinstance(valor, str):
+            normalizados[nome] = valor
+        elif isinstance(valor, (int, np.integer)) and not isinstance(valor, bool):
+            normalizados[nome] = int(valor)
+        else:
+            normalizados[nome] = repr(float(valor))
+    hasher = hashlib.sha256(imagem_bytes)
+    hasher.update(json.dumps(normalizados, sort_keys=True).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+class CacheResultados:
+    """Cache LRU de resultados (headers e colony_data) com limite em bytes e camada opcional em disco."""
+
+    def __init__(self, max_bytes, diretorio=None, max_bytes_disco=0):
+        self.max_bytes = max_bytes
+        self.diretorio = diretorio
+        self.max_bytes_disco = max_bytes_disco
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evictions_disco = 0
+        self._itens = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        if self.diretorio:
+            os.makedirs(self.diretorio, exist_ok=True)
+
+    @property
+    def ativo(self):
+        return self.max_bytes > 0 or bool(self.diretorio)
+
+    @staticmethod
+    def _tamanho(headers, colony_data):
+        # Estimativa: ~100 bytes por registro de colônia e por header
+        return 100 * (len(colony_data) + len(headers))
+
+    def obter(self, chave):
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is not None:
+                self._itens.move_to_end(chave)
+                self.hits += 1
+                return item
+        item = self._ler_disco(chave)
+        with self._lock:
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._inserir_memoria(chave, item)
+        return item
+
+    def armazenar(self, chave, headers, colony_data):
+        item = (dict(headers), colony_data)
+        with self._lock:
+            self._inserir_memoria(chave, item)
+        self._gravar_disco(chave, item)
+
+    def _inserir_memoria(self, chave, item):
+        if self.max_bytes <= 0:
+            return
+        tamanho = self._tamanho(*item)
+        if tamanho > self.max_bytes:
+            return
+        antigo = self._itens.pop(chave, None)
+        if antigo is not None:
+            self._bytes -= self._tamanho(*antigo)
+        self._itens[chave] = item
+        self._bytes += tamanho
+        while self._bytes > self.max_bytes:
+            _, removido = self._itens.popitem(last=False)
+            self._bytes -= self._tamanho(*removido)
+            self.evictions += 1
+
+    def _ler_disco(self, chave):
+        if not self.diretorio:
+            return None
+        caminho = os.path.join(self.diretorio, chave + ".json")
+        try:
+            with open(caminho, encoding="utf-8") as f:
+                dados = json.load(f)
+            os.utime(caminho)
+        except (OSError, ValueError):
+            return None
+        return dados["headers"], dados["colony_data"]
+
+    def _gravar_disco(self, chave, item):
+        if not self.diretorio:
+            return
+        headers, colony_data = item
+        caminho = os.path.join(self.diretorio, chave + ".json")
+        try:
+            # Grava em um arquivo temporário e renomeia para que leitores nunca vejam dados parciais
+            with open(caminho + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({"headers": headers, "colony_data": colony_data}, f, ensure_ascii=False)
+            os.replace(caminho + ".tmp", caminho)
+            self._limitar_disco()
+        except OSError as e:
+            logger.warning(f"Falha ao gravar cache de resultados em disco: {e}")
+
+    def _limitar_disco(self):
+        arquivos = []
+        for nome in os.listdir(self.diretorio):
+            if nome.endswith(".json"):
+                caminho = os.path.join(self.diretorio, nome)
+                try:
+                    info = os.stat(caminho)
+                except OSError:
+                    continue
+                arquivos.append((info.st_mtime, info.st_size, caminho))
+        total = sum(tamanho for _, tamanho, _ in arquivos)
+        for _, tamanho, caminho in sorted(arquivos):
+            if total <= self.max_bytes_disco:
+                break
+            try:
+                os.remove(caminho)
+            except OSError:
+                pass
+            total -= tamanho
+            with self._lock:
+                self.evictions_disco += 1
+
+    def estatisticas(self):
+        with self._lock:
+            return {
+                "ativo": self.ativo,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "evictions_disco": self.evictions_disco,
+                "itens_memoria": len(self._itens),
+                "bytes_memoria": self._bytes,
+                "max_bytes_memoria": self.max_bytes,
+                "diretorio": self.diretorio,
+            }
+
+
+cache_resultados = CacheResultados(
+    int(RESULT_CACHE_MAX_MB * 1024 * 1024), RESULT_CACHE_DIR, int(RESULT_CACHE_DISK_MAX_MB * 1024 * 1024)
+)
+
+
+# Imagens anotadas mantidas para download posterior (ex.: resultados de lote), em ordem LRU
+MAX_IMAGENS_ARMAZENADAS = int(os.getenv("MAX_IMAGENS_ARMAZENADAS", "500"))
+IMAGENS_PROCESSADAS = OrderedDict()
+
+
+def armazenar_imagem(token, imagem_bytes):
+    IMAGENS_PROCESSADAS[token] = imagem_bytes
+    IMAGENS_PROCESSADAS.move_to_end(token)
+    while len(IMAGENS_PROCESSADAS) > MAX_IMAGENS_ARMAZENADAS:
+        IMAGENS_PROCESSADAS.popitem(last=False)
+
+
+def registrar_resultado(colony_data):
+    """Registra o log de HSV e guarda as colônias para feedback, retornando o token."""
+    log_analysis_data(colony_data)
+    token = uuid.uuid4().hex
+    PENDING_FEEDBACK.armazenar(token, colony_data)
+    return token
+
+
+# Renderização sob demanda (GET /renderizar/{token}): por análise são guardados a imagem enviada,
+# as colônias contadas e os dados da legenda; as imagens já codificadas ficam em um segundo cache.
+RENDER_SOURCE_MAX_MB = float(os.getenv("RENDER_SOURCE_MAX_MB", "256"))
+RENDER_CACHE_MAX_MB = float(os.getenv("RENDER_CACHE_MAX_MB", "64"))
+
+
+class CacheLRU:
+    """Cache LRU em memória limitado pela soma dos tamanhos (bytes) informados em armazenar."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._itens = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def obter(self, chave):
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is None:
+                return None
+            self._itens.move_to_end(chave)
+            return item[0]
+
+    def armazenar(self, chave, valor, tamanho):
+        if tamanho > self.max_bytes:
+            return
+        with self._lock:
+            antigo = self._itens.pop(chave, None)
+            if antigo is not None:
+                self._bytes -= antigo[1]
+            self._itens[chave] = (valor, tamanho)
+            self._bytes += tamanho
+            while self._bytes > self.max_bytes:
+                _, (_, tamanho_removido) = self._itens.popitem(last=False)
+                self._bytes -= tamanho_removido
+
+    def __len__(self):
+        return len(self._itens)
+
+
+fontes_renderizacao = CacheLRU(int(RENDER_SOURCE_MAX_MB * 1024 * 1024))
+cache_renderizacoes = CacheLRU(int(RENDER_CACHE_MAX_MB * 1024 * 1024))
+
+
+def registrar_fonte_renderizacao(token, imagem_bytes, nome_amostra, headers, colony_data):
+    """Guarda o necessário para renderizar a análise ``token`` depois, sem reprocessar a imagem; retorna a fonte."""
+    classes, dados, _ = compactar_colonias(colony_data)
+    fonte = (
+        imagem_bytes,
+        nome_amostra,
+        datetime.now(timezone.utc) - timedelta(hours=3),
+        int(headers["X-Resumo-Total"]),
+        float(headers["X-Feedback-Densidade-Colonias-Cm2"]),
+        float(headers["X-Feedback-Estimativa-Total-Colonias"]),
+        classes,
+        dados,
+    )
+    fontes_renderizacao.armazenar(token, fonte, len(imagem_bytes) + len(dados))
+    return fonte
+
+
+def renderizar_resultado(fonte, formato, qualidade=None, lado_max=None, tempos_estagios=None):
+    """Redesenha a imagem anotada de uma análise a partir da imagem enviada e das colônias guardadas."""
+    imagem_bytes, nome_amostra, hora, total, densidade, estimativa, classes, dados = fonte
+    img = decodificar_imagem(imagem_bytes, nome_amostra, tempos_estagios)[0]
+    texto_cabecalho = linhas_legenda(nome_amostra, total, densidade, estimativa, hora)
+    with medir_estagio(tempos_estagios, "desenho"):
+        desenhar = desenhar_anotacoes(img, expandir_colonias(classes, dados), texto_cabecalho)
+    with medir_estagio(tempos_estagios, "encode"):
+        return codificar_imagem(desenhar, formato, qualidade, lado_max)
+
+
+FORMATOS_RESPOSTA = ("imagem", "json")
+
+
+def validar_formato_resposta(formato_resposta):
+    if formato_resposta not in FORMATOS_RESPOSTA:
+        raise HTTPException(
+            status_code=400, detail=f"formato_resposta deve ser um de: {', '.join(FORMATOS_RESPOSTA)}"
+        )
+    return formato_resposta == "imagem"
+
+
+def conteudo_resultado(nome_amostra, token, headers, colony_data, imagem_url=None):
+    """Resultado de uma análise em JSON; sem ``imagem_url`` a imagem aponta para /renderizar/{token}."""
+    return {
+        "nome_amostra": nome_amostra,
+        "token": token,
+        "resumo": headers,
+        "colony_data": colony_data,
+        "imagem_url": imagem_url or f"/renderizar/{token}",
     }
-    
-    logger.info(f"[{nome_amostra}] Processamento total da imagem levou: {time.time() - total_process_start_time:.4f}s")
-    return resumo_contagem, BytesIO(buffer.tobytes()), feedback_headers, colony_data
+
+
+def resposta_json(nome_amostra, token, headers, colony_data):
+    """Resposta de /contar/ com formato_resposta=json: contagens e colônias, sem imagem."""
+    return JSONResponse(content=conteudo_resultado(nome_amostra, token, headers, colony_data), headers=headers)
+
+
+# Tarefas assíncronas (/tarefas/): o envio retorna um id na hora, o processamento usa o mesmo pool de
+# /contar/ e o progresso de cada etapa é transmitido por Server-Sent Events. Tarefas finalizadas ficam
+# disponíveis por TAREFAS_TTL_S; acima de TAREFAS_MAX as finalizadas mais antigas são removidas.
+TAREFAS_TTL_S = float(os.getenv("TAREFAS_TTL_S", "600"))
+TAREFAS_MAX = int(os.getenv("TAREFAS_MAX", "1000"))
+TAREFAS_HEARTBEAT_S = float(os.getenv("TAREFAS_HEARTBEAT_S", "15"))
+STATUS_FINAIS_TAREFA = ("concluida", "erro", "cancelada")
+
+
+class Tarefa:
+    """Estado e eventos de uma análise assíncrona; só é alterada no loop de eventos."""
+
+    _numeros = itertools.count(1)
+
+    def __init__(self, nome_amostra):
+        self.tarefa_id = uuid.uuid4().hex
+        # Identifica a tarefa no vetor compartilhado de cancelamento (marcar_tarefa_cancelada)
+        self.numero = next(Tarefa._numeros)
+        self.nome_amostra = nome_amostra
+        self.status = "na_fila"
+        self.etapa = None
+        self.resultado = None
+        self.erro = None
+        self.eventos = []
+        self.execucao = None
+        self.inicio = time.perf_counter()
+        self.finalizada_em = None
+        self._atualizada = asyncio.Event()
+
+    @property
+    def finalizada(self):
+        return self.status in STATUS_FINAIS_TAREFA
+
+    def emitir(self, evento, **dados):
+        """Registra um evento e acorda quem acompanha a tarefa em aguardar_eventos."""
+        self.eventos.append({"evento": evento, "t": round(time.perf_counter() - self.inicio, 3), **dados})
+        atualizada, self._atualizada = self._atualizada, asyncio.Event()
+        atualizada.set()
+
+    def finalizar(self, status, **dados):
+        self.status = status
+        self.finalizada_em = time.monotonic()
+        self.emitir(status, **dados)
+
+    async def aguardar_eventos(self, desde, timeout):
+        """Retorna os eventos a partir do índice ``desde``, esperando até ``timeout`` s se ainda não houver."""
+        atualizada = self._atualizada
+        if len(self.eventos) <= desde:
+            try:
+                await asyncio.wait_for(atualizada.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.eventos[desde:]
+
+    def estado(self):
+        return {
+            "tarefa_id": self.tarefa_id,
+            "nome_amostra": self.nome_amostra,
+            "status": self.status,
+            "etapa": self.etapa,
+            "resultado": self.resultado,
+            "erro": self.erro,
+            "eventos_url": f"/tarefas/{self.tarefa_id}/eventos",
+        }
+
+
+class GerenciadorTarefas:
+    """Tarefas em memória, com expiração das finalizadas e repasse do progresso vindo dos workers."""
+
+    def __init__(self, max_tarefas, ttl_s):
+        self.max_tarefas = max_tarefas
+        self.ttl_s = ttl_s
+        self._tarefas = OrderedDict()
+        self._loop = None
+        self._leitor = None
+
+    def criar(self, nome_amostra):
+        self._aplicar_limites()
+        tarefa = Tarefa(nome_amostra)
+        self._tarefas[tarefa.tarefa_id] = tarefa
+        self._iniciar_leitor()
+        return tarefa
+
+    def obter(self, tarefa_id):
+        self._aplicar_limites()
+        return self._tarefas.get(tarefa_id)
+
+    def remover(self, tarefa_id):
+        return self._tarefas.pop(tarefa_id, None) is not None
+
+    def __len__(self):
+        return len(self._tarefas)
+
+    def _aplicar_limites(self):
+        agora = time.monotonic()
+        finalizadas = [k for k, t in self._tarefas.items() if t.finalizada]
+        for tarefa_id in finalizadas:
+            if agora - self._tarefas[tarefa_id].finalizada_em > self.ttl_s:
+                del self._tarefas[tarefa_id]
+        # Tarefas em andamento nunca são removidas
+        for tarefa_id in [k for k in finalizadas if k in self._tarefas][:max(0, len(self._tarefas) - self.max_tarefas)]:
+            del self._tarefas[tarefa_id]
+
+    def registrar_progresso(self, tarefa_id, etapa):
+        tarefa = self._tarefas.get(tarefa_id)
+        # O progresso chega por outra fila e pode atrasar em relação ao resultado; depois do fim é ignorado
+        if tarefa is None or tarefa.finalizada:
+            return
+        if etapa == "iniciada":
+            tarefa.status = "processando"
+        tarefa.etapa = etapa
+        tarefa.emitir("etapa", etapa=etapa)
+
+    def _iniciar_leitor(self):
+        self._loop = asyncio.get_running_loop()
+        if self._leitor is not None:
+            return
+        fila = obter_fila_progresso()
+
+        def ler_progresso():
+            while True:
+                item = fila.get()
+                if item is None:
+                    return
+                try:
+                    self._loop.call_soon_threadsafe(self.registrar_progresso, *item)
+                except RuntimeError:  # loop encerrado
+                    pass
+
+        self._leitor = threading.Thread(target=ler_progresso, name="progresso-tarefas", daemon=True)
+        self._leitor.start()
+
+    def encerrar(self):
+        for tarefa in self._tarefas.values():
+            if tarefa.execucao is not None and not tarefa.finalizada:
+                tarefa.execucao.cancel()
+        if self._leitor is not None:
+            obter_fila_progresso().put(None)
+            self._leitor.join(timeout=5)
+            self._leitor = None
+
+
+gerenciador_tarefas = GerenciadorTarefas(TAREFAS_MAX, TAREFAS_TTL_S)
+
+
+async def executar_tarefa(tarefa, conteudo_arquivo, renderizar, parametros):
+    """Processa a imagem da tarefa no pool de /contar/ e guarda o resultado (ou o erro) na tarefa."""
+    try:
+        _, imagem_processada, response_headers_dict, colony_data = await executar_contagem(
+            executor_processamento,
+            _processar_imagem_worker,
+            conteudo_arquivo,
+            tarefa.nome_amostra,
+            esperar_vaga=True,
+            renderizar=renderizar,
+            progresso=AvisoProgresso(tarefa.tarefa_id, tarefa.numero),
+            **parametros,
+        )
+    except asyncio.CancelledError:
+        if not tarefa.finalizada:
+            tarefa.finalizar("cancelada")
+        return
+    except Exception as e:
+        status_code, detail = descrever_erro_contagem(e, tarefa.nome_amostra)
+        tarefa.erro = {"status_code": status_code, "detail": detail}
+    if tarefa.finalizada:
+        return
+    if tarefa.erro is not None:
+        tarefa.finalizar("erro", **tarefa.erro)
+        return
+
+    token = registrar_resultado(colony_data)
+    registrar_fonte_renderizacao(token, conteudo_arquivo, tarefa.nome_amostra, response_headers_dict, colony_data)
+    response_headers_dict["X-Feedback-Token"] = token
+    imagem_url = None
+    if renderizar:
+        armazenar_imagem(token, imagem_processada.getvalue())
+        imagem_url = f"/imagem/{token}"
+    tarefa.resultado = conteudo_resultado(tarefa.nome_amostra, token, response_headers_dict, colony_data, imagem_url)
+    tarefa.etapa = ETAPAS_PROGRESSO[-1] if renderizar else "classificada"
+    tarefa.finalizar("concluida", resultado=tarefa.resultado)
+
 
 @app.post("/contar/", summary="Conta e classifica colônias em uma imagem")
 async def contar_colonias_endpoint(
@@ -406,44 +3093,141 @@ async def contar_colonias_endpoint(
     local_max_filter_size: int = Form(7, description="Tamanho do filtro de máximo local"),
     thresh_block_size: int = Form(41, description="Tamanho do bloco do adaptive threshold"),
     thresh_c: int = Form(4, description="Constante C do adaptive threshold"),
+    alta_resolucao: bool = Form(
+        False, description="Segmenta na resolução original em blocos (fotos grandes, colônias puntiformes)"
+    ),
+    motor_segmentacao: str = Form(
+        "watershed", description="'watershed' (completo) ou 'componentes' (rápido para placas esparsas)"
+    ),
+    formato_resposta: str = Form(
+        "imagem", description="'imagem' (JPEG anotado) ou 'json' (contagens e colony_data, sem desenhar a imagem)"
+    ),
 ):
+    inicio = time.perf_counter()
+    renderizar = validar_formato_resposta(formato_resposta)
     conteudo_arquivo = await file.read()
     if not conteudo_arquivo:
         raise HTTPException(status_code=400, detail="Arquivo enviado está vazio.")
 
-    try:
-        resumo_da_contagem, imagem_processada, response_headers_dict, colony_data = processar_imagem(
+    parametros = dict(
+        x_manual=x,
+        y_manual=y,
+        r_manual=r,
+        area_min=area_min,
+        circularidade_min=circularidade_min,
+        max_colony_size_factor=max_colony_size_factor,
+        local_max_filter_size=local_max_filter_size,
+        thresh_block_size=thresh_block_size,
+        thresh_c=thresh_c,
+        alta_resolucao=alta_resolucao,
+        motor_segmentacao=motor_segmentacao,
+    )
+    with erros_de_contagem(nome_amostra):
+        chave_cache = None
+        if cache_resultados.ativo:
+            # O nome da amostra fica fora da chave: ele só aparece na legenda, redesenhada a cada acerto. A
+            # versão do modelo de cor entra, para um modelo novo não receber resultados do anterior
+            versao_modelo = modelo_cor.versao
+            chave_cache = chave_resultado(conteudo_arquivo, **parametros, modelo_cor=versao_modelo)
+            em_cache = await asyncio.to_thread(cache_resultados.obter, chave_cache)
+            if em_cache is not None:
+                headers_em_cache, colony_data = em_cache
+                logger.debug("[%s] Resultado obtido do cache.", nome_amostra)
+                response_headers_dict = dict(headers_em_cache)
+                token = registrar_resultado(colony_data)
+                fonte = registrar_fonte_renderizacao(
+                    token, conteudo_arquivo, nome_amostra, response_headers_dict, colony_data
+                )
+                response_headers_dict["X-Feedback-Token"] = token
+                response_headers_dict["X-Cache"] = "HIT"
+                if not renderizar:
+                    response_headers_dict["Server-Timing"] = cabecalho_server_timing(
+                        {}, cache=time.perf_counter() - inicio
+                    )
+                    return resposta_json(nome_amostra, token, response_headers_dict, colony_data)
+                tempos = {}
+                imagem_bytes = await asyncio.to_thread(
+                    renderizar_resultado, fonte, "jpeg", None, None, tempos
+                )
+                response_headers_dict["Server-Timing"] = cabecalho_server_timing(
+                    tempos, cache=time.perf_counter() - inicio
+                )
+                return StreamingResponse(BytesIO(imagem_bytes), media_type="image/jpeg", headers=response_headers_dict)
+
+        resumo_da_contagem, imagem_processada, response_headers_dict, colony_data = await executar_contagem(
+            executor_processamento,
+            _processar_imagem_worker,
             conteudo_arquivo,
             nome_amostra,
-            x_manual=x,
-            y_manual=y,
-            r_manual=r,
-            area_min=area_min,
-            circularidade_min=circularidade_min,
-            max_colony_size_factor=max_colony_size_factor,
-            local_max_filter_size=local_max_filter_size,
-            thresh_block_size=thresh_block_size,
-            thresh_c=thresh_c,
+            renderizar=renderizar,
+            **parametros,
         )
-        log_analysis_data(colony_data)
-        token = uuid.uuid4().hex
-        PENDING_FEEDBACK[token] = colony_data
+        if chave_cache is not None:
+            # Um worker que ainda não recarregou o modelo responde com a versão anterior; esse resultado
+            # não corresponde à chave e fica fora do cache
+            if response_headers_dict["X-Modelo-Cor"] == versao_modelo:
+                await asyncio.to_thread(cache_resultados.armazenar, chave_cache, response_headers_dict, colony_data)
+            response_headers_dict["X-Cache"] = "MISS"
+        token = registrar_resultado(colony_data)
+        registrar_fonte_renderizacao(token, conteudo_arquivo, nome_amostra, response_headers_dict, colony_data)
         response_headers_dict["X-Feedback-Token"] = token
+        if not renderizar:
+            return resposta_json(nome_amostra, token, response_headers_dict, colony_data)
         return StreamingResponse(imagem_processada, media_type="image/jpeg", headers=response_headers_dict)
-    except ValueError as e:
-        logger.error(f"Erro de valor (ex: decodificação) para {nome_amostra}: {str(e)}")
-        raise HTTPException(status_code=400, detail=str(e))
-    except HTTPException as e:
-        logger.warning(f"HTTPException para {nome_amostra}: {e.detail} (Status: {e.status_code})")
-        raise e
-    except Exception as e:
-        logger.exception(f"Erro interno inesperado durante o processamento para {nome_amostra}")
-        raise HTTPException(status_code=500, detail="Erro interno no servidor. Tente novamente mais tarde.")
+
+
+@app.get("/pronto", summary="Indica se o modelo de cor terminou de carregar, aqui e nos workers do pool")
+async def pronto():
+    classificador = modelo_cor
+    estado = {
+        "pronto": _modelo_cor_carregado.is_set() and executor_processamento.pronto,
+        "modelo_cor": classificador.status,
+        "versao_modelo_cor": classificador.versao,
+        "lut_cor": classificador.lut is not None,
+        "workers_prontos": executor_processamento.workers_prontos,
+        "workers": max(1, executor_processamento.workers),
+    }
+    if not estado["pronto"]:
+        return JSONResponse(status_code=503, content=estado)
+    return estado
+
+
+@app.get("/modelo_cor", summary="Versão e estado do modelo de cor ativo")
+async def get_modelo_cor():
+    classificador = modelo_cor
+    return {
+        "versao": classificador.versao,
+        "status": classificador.status,
+        "lut_cor": classificador.lut is not None,
+        "ultimo_erro": _erro_modelo_cor,
+        "verificacao_s": COLOR_MODEL_WATCH_S,
+    }
+
+
+@app.post("/modelo_cor/recarregar", summary="Recarrega o modelo de cor do disco e o ativa se passar na validação")
+async def recarregar_modelo_cor_endpoint():
+    anterior = modelo_cor.versao
+    # A carga roda em uma thread: as contagens seguem com o modelo atual até a troca
+    ativado, resultado = await asyncio.to_thread(recarregar_modelo_cor)
+    if not ativado:
+        raise HTTPException(status_code=422, detail=f"Modelo rejeitado: {resultado}")
+    return {"versao": resultado, "versao_anterior": anterior, "status": modelo_cor.status}
+
+
+@app.get("/metrics", summary="Métricas de latência, fila e contagens no formato do Prometheus")
+async def get_metrics():
+    conteudo = metricas.exportar({"processamento": executor_processamento, "sessoes": executor_sessoes})
+    return Response(content=conteudo, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/cache/estatisticas", summary="Estatísticas do cache de resultados")
+async def get_estatisticas_cache():
+    return cache_resultados.estatisticas()
 
 
 @app.get("/colony_data/{token}", summary="Obtém dados das colônias para feedback")
 async def get_colony_data(token: str):
-    dados = PENDING_FEEDBACK.get(token)
+    dados = PENDING_FEEDBACK.obter(token)
     if dados is None:
         raise HTTPException(status_code=404, detail="Token inválido")
     return {"data": dados}
@@ -461,7 +3245,7 @@ class FeedbackPayload(BaseModel):
 
 @app.post("/feedback_treinamento", summary="Armazena feedback de cores corrigidas")
 async def feedback_treinamento(payload: FeedbackPayload):
-    dados = PENDING_FEEDBACK.get(payload.token)
+    dados = PENDING_FEEDBACK.obter(payload.token)
     if dados is None:
         raise HTTPException(status_code=404, detail="Token inválido")
     linhas = []
@@ -481,8 +3265,473 @@ async def feedback_treinamento(payload: FeedbackPayload):
             })
     if not linhas:
         raise HTTPException(status_code=400, detail="Nenhuma correção válida")
-    csv_path = os.path.join(os.path.dirname(__file__), "feedback_data.csv")
-    df = pd.DataFrame(linhas)
-    df.to_csv(csv_path, mode="a", header=not os.path.exists(csv_path), index=False)
-    del PENDING_FEEDBACK[payload.token]
-    return {"salvos": len(linhas)}
+    gravador_logs.registrar(FEEDBACK_LOG_PATH, FEEDBACK_LOG_COLUMNS, linhas)
+    PENDING_FEEDBACK.remover(payload.token)
+    return {"salvos": len(linhas), "modelo_cor": dados[0].get("modelo_cor")}
+
+
+EXTENSOES_IMAGEM = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp")
+
+# Limites por arquivo zip de /contar_lote/: número de entradas e soma dos tamanhos descompactados declarados
+LOTE_ZIP_MAX_ARQUIVOS = int(os.getenv("LOTE_ZIP_MAX_ARQUIVOS", "1000"))
+LOTE_ZIP_MAX_MB = float(os.getenv("LOTE_ZIP_MAX_MB", "2048"))
+
+
+class ZipExcedeLimites(ValueError):
+    """Arquivo zip com mais entradas ou mais bytes descompactados que LOTE_ZIP_MAX_ARQUIVOS/LOTE_ZIP_MAX_MB."""
+
+
+def extrair_imagens_zip(arquivo_zip):
+    """Retorna (nome, ZipInfo) de cada imagem de ``arquivo_zip``, sem descompactá-las.
+
+    Levanta ZipExcedeLimites antes de qualquer leitura quando o arquivo passa dos limites do lote.
+    """
+    entradas = arquivo_zip.infolist()
+    if len(entradas) > LOTE_ZIP_MAX_ARQUIVOS:
+        raise ZipExcedeLimites(f"{len(entradas)} entradas (máximo {LOTE_ZIP_MAX_ARQUIVOS})")
+    tamanho_total = sum(info.file_size for info in entradas)
+    if tamanho_total > LOTE_ZIP_MAX_MB * 1024 * 1024:
+        raise ZipExcedeLimites(
+            f"{tamanho_total / (1024 * 1024):.1f} MB descompactados (máximo {LOTE_ZIP_MAX_MB:.1f} MB)"
+        )
+    imagens = []
+    for info in entradas:
+        nome = info.filename
+        if info.is_dir() or nome.startswith("__MACOSX/") or os.path.basename(nome).startswith("."):
+            continue
+        if nome.lower().endswith(EXTENSOES_IMAGEM):
+            imagens.append((nome, info))
+    return imagens
+
+
+@app.post("/contar_lote/", summary="Conta colônias em várias imagens e transmite os resultados em NDJSON")
+async def contar_lote_endpoint(
+    files: list[UploadFile] = File(..., description="Imagens das placas de Petri ou arquivos .zip com imagens"),
+    nome_lote: str = Form(None, description="Prefixo opcional para o nome das amostras"),
+    area_min: float = Form(10.0, description="Área mínima da colônia (px)"),
+    circularidade_min: float = Form(0.40, description="Circularidade mínima"),
+    max_colony_size_factor: float = Form(
+        MAX_COLONY_RADIUS_FACTOR_OF_PETRI_MARGIN,
+        description="Fator máximo do raio da colônia em relação à margem"
+    ),
+    local_max_filter_size: int = Form(7, description="Tamanho do filtro de máximo local"),
+    thresh_block_size: int = Form(41, description="Tamanho do bloco do adaptive threshold"),
+    thresh_c: int = Form(4, description="Constante C do adaptive threshold"),
+    alta_resolucao: bool = Form(
+        False, description="Segmenta na resolução original em blocos (fotos grandes, colônias puntiformes)"
+    ),
+    motor_segmentacao: str = Form(
+        "watershed", description="'watershed' (completo) ou 'componentes' (rápido para placas esparsas)"
+    ),
+    formato_resposta: str = Form(
+        "imagem", description="'json' pula o desenho das imagens; elas ficam disponíveis em /renderizar/{token}"
+    ),
+):
+    renderizar = validar_formato_resposta(formato_resposta)
+    # Cada imagem é (nome, bytes) ou, dentro de um zip, (nome, (arquivo_zip, ZipInfo)); os membros do zip
+    # só são descompactados quando a tarefa da imagem roda
+    imagens = []
+    arquivos_zip = []
+    try:
+        for upload in files:
+            conteudo = await upload.read()
+            nome_arquivo = upload.filename or f"imagem_{len(imagens) + 1}"
+            if nome_arquivo.lower().endswith(".zip") or (conteudo[:4] == b"PK\x03\x04"):
+                try:
+                    arquivo_zip = zipfile.ZipFile(BytesIO(conteudo))
+                except zipfile.BadZipFile:
+                    raise HTTPException(status_code=400, detail=f"Arquivo zip inválido: {nome_arquivo}")
+                arquivos_zip.append(arquivo_zip)
+                try:
+                    membros = extrair_imagens_zip(arquivo_zip)
+                except ZipExcedeLimites as e:
+                    raise HTTPException(
+                        status_code=413, detail=f"Arquivo zip excede os limites do lote: {nome_arquivo}, {e}"
+                    )
+                imagens.extend((nome, (arquivo_zip, info)) for nome, info in membros)
+            else:
+                imagens.append((nome_arquivo, conteudo))
+        if not imagens:
+            raise HTTPException(status_code=400, detail="Nenhuma imagem enviada.")
+    except HTTPException:
+        for arquivo_zip in arquivos_zip:
+            arquivo_zip.close()
+        raise
+    logger.info(f"Lote recebido com {len(imagens)} imagens.")
+
+    async def processar_placa(nome_arquivo, conteudo):
+        nome_amostra = os.path.splitext(os.path.basename(nome_arquivo))[0]
+        if nome_lote:
+            nome_amostra = f"{nome_lote} - {nome_amostra}"
+        linha = {"arquivo": nome_arquivo, "nome_amostra": nome_amostra}
+        if isinstance(conteudo, tuple):
+            arquivo_zip, info = conteudo
+            try:
+                conteudo = await asyncio.to_thread(arquivo_zip.read, info)
+            except (zipfile.BadZipFile, zlib.error, OSError, NotImplementedError, RuntimeError) as e:
+                return {**linha, "status": "erro", "status_code": 400, "detail": f"Falha ao ler do arquivo zip: {e}"}
+        if not conteudo:
+            return {**linha, "status": "erro", "status_code": 400, "detail": "Arquivo enviado está vazio."}
+        try:
+            _, imagem_processada, response_headers_dict, colony_data = await executar_contagem(
+                executor_processamento,
+                _processar_imagem_worker,
+                conteudo,
+                nome_amostra,
+                esperar_vaga=True,
+                area_min=area_min,
+                circularidade_min=circularidade_min,
+                max_colony_size_factor=max_colony_size_factor,
+                local_max_filter_size=local_max_filter_size,
+                thresh_block_size=thresh_block_size,
+                thresh_c=thresh_c,
+                alta_resolucao=alta_resolucao,
+                motor_segmentacao=motor_segmentacao,
+                renderizar=renderizar,
+            )
+        except Exception as e:
+            status_code, detail = descrever_erro_contagem(e, nome_amostra)
+            return {**linha, "status": "erro", "status_code": status_code, "detail": detail}
+        token = registrar_resultado(colony_data)
+        registrar_fonte_renderizacao(token, conteudo, nome_amostra, response_headers_dict, colony_data)
+        if renderizar:
+            armazenar_imagem(token, imagem_processada.getvalue())
+        response_headers_dict["X-Feedback-Token"] = token
+        return {
+            **linha,
+            "status": "ok",
+            "token": token,
+            "resumo": response_headers_dict,
+            "imagem_url": f"/imagem/{token}" if renderizar else f"/renderizar/{token}",
+        }
+
+    async def gerar_linhas():
+        # Limita o lote ao número de workers para não ocupar sozinho toda a fila do pool
+        limite = asyncio.Semaphore(max(1, executor_processamento.workers))
+
+        async def processar_com_limite(nome_arquivo, conteudo):
+            async with limite:
+                return await processar_placa(nome_arquivo, conteudo)
+
+        tarefas = [asyncio.ensure_future(processar_com_limite(nome, conteudo)) for nome, conteudo in imagens]
+        try:
+            for proxima in asyncio.as_completed(tarefas):
+                yield json.dumps(await proxima, ensure_ascii=False) + "\n"
+        finally:
+            for tarefa in tarefas:
+                tarefa.cancel()
+            await asyncio.gather(*tarefas, return_exceptions=True)
+            for arquivo_zip in arquivos_zip:
+                arquivo_zip.close()
+
+    return StreamingResponse(gerar_linhas(), media_type="application/x-ndjson")
+
+
+@app.post("/contar_placas/", summary="Conta colônias em cada placa de uma foto com várias placas")
+async def contar_placas_endpoint(
+    file: UploadFile = File(..., description="Foto com várias placas de Petri (bandeja, rack)"),
+    nome_amostra: str = Form(..., description="Identificação da amostra; cada placa recebe o sufixo ' - placa N'."),
+    max_placas: int = Form(PLACAS_MAX, ge=1, le=24, description="Número máximo de placas a detectar"),
+    imagens: str = Form(
+        "combinada", description="'combinada' (uma imagem com todas as placas), 'por_placa' ou 'nenhuma'"
+    ),
+    area_min: float = Form(10.0, description="Área mínima da colônia (px)"),
+    circularidade_min: float = Form(0.40, description="Circularidade mínima"),
+    max_colony_size_factor: float = Form(
+        MAX_COLONY_RADIUS_FACTOR_OF_PETRI_MARGIN,
+        description="Fator máximo do raio da colônia em relação à margem"
+    ),
+    local_max_filter_size: int = Form(7, description="Tamanho do filtro de máximo local"),
+    thresh_block_size: int = Form(41, description="Tamanho do bloco do adaptive threshold"),
+    thresh_c: int = Form(4, description="Constante C do adaptive threshold"),
+    alta_resolucao: bool = Form(
+        False, description="Segmenta na resolução original em blocos (fotos grandes, colônias puntiformes)"
+    ),
+    motor_segmentacao: str = Form(
+        "watershed", description="'watershed' (completo) ou 'componentes' (rápido para placas esparsas)"
+    ),
+):
+    if imagens not in MODOS_IMAGEM_PLACAS:
+        raise HTTPException(status_code=400, detail=f"imagens deve ser um de: {', '.join(MODOS_IMAGEM_PLACAS)}")
+    conteudo_arquivo = await file.read()
+    if not conteudo_arquivo:
+        raise HTTPException(status_code=400, detail="Arquivo enviado está vazio.")
+    with erros_de_contagem(nome_amostra):
+        _, imagens_anotadas, response_headers_dict, placas = await executar_contagem(
+            executor_processamento,
+            _processar_placas_worker,
+            conteudo_arquivo,
+            nome_amostra,
+            max_placas=max_placas,
+            imagens=imagens,
+            area_min=area_min,
+            circularidade_min=circularidade_min,
+            max_colony_size_factor=max_colony_size_factor,
+            local_max_filter_size=local_max_filter_size,
+            thresh_block_size=thresh_block_size,
+            thresh_c=thresh_c,
+            alta_resolucao=alta_resolucao,
+            motor_segmentacao=motor_segmentacao,
+        )
+
+    # Cada placa é uma análise própria: token de feedback, renderização sob demanda e, com
+    # imagens=por_placa, o recorte anotado em /imagem/{token}
+    for placa in placas:
+        token = registrar_resultado(placa["colony_data"])
+        registrar_fonte_renderizacao(
+            token, conteudo_arquivo, placa["nome_amostra"], placa["resumo"], placa["colony_data"]
+        )
+        placa["resumo"]["X-Feedback-Token"] = token
+        placa["token"] = token
+        placa["imagem_url"] = f"/renderizar/{token}"
+    if imagens == "por_placa":
+        for placa, imagem in zip(placas, imagens_anotadas):
+            armazenar_imagem(placa["token"], imagem)
+            placa["imagem_url"] = f"/imagem/{placa['token']}"
+    imagem_url = None
+    if imagens == "combinada":
+        token_imagem = uuid.uuid4().hex
+        armazenar_imagem(token_imagem, imagens_anotadas[0])
+        imagem_url = f"/imagem/{token_imagem}"
+
+    conteudo = {
+        "nome_amostra": nome_amostra,
+        "placas_detectadas": len(placas),
+        "resumo": response_headers_dict,
+        "placas": placas,
+        "imagem_url": imagem_url,
+    }
+    return JSONResponse(content=conteudo, headers=response_headers_dict)
+
+
+@app.get("/imagem/{token}", summary="Obtém a imagem anotada de uma análise")
+async def get_imagem(token: str):
+    imagem = IMAGENS_PROCESSADAS.get(token)
+    if imagem is None:
+        raise HTTPException(status_code=404, detail="Token inválido ou imagem expirada")
+    return Response(content=imagem, media_type="image/jpeg")
+
+
+@app.get("/renderizar/{token}", summary="Renderiza sob demanda a imagem anotada de uma análise")
+async def renderizar_endpoint(
+    token: str,
+    formato: str = Query("jpeg", description="jpeg, webp ou png"),
+    qualidade: int = Query(90, ge=1, le=100, description="Qualidade de 1 a 100 (JPEG e WebP)"),
+    lado_max: int = Query(None, ge=16, description="Maior lado da imagem em px (padrão: tamanho da análise)"),
+):
+    inicio = time.perf_counter()
+    formato = "jpeg" if formato.lower() == "jpg" else formato.lower()
+    if formato not in FORMATOS_IMAGEM:
+        raise HTTPException(status_code=400, detail=f"formato deve ser um de: {', '.join(FORMATOS_IMAGEM)}")
+    if FORMATOS_IMAGEM[formato][2] is None:
+        qualidade = None
+    media_type = FORMATOS_IMAGEM[formato][1]
+
+    chave = (token, formato, qualidade, lado_max)
+    imagem = cache_renderizacoes.obter(chave)
+    if imagem is not None:
+        headers = {"X-Cache": "HIT", "Server-Timing": cabecalho_server_timing({}, cache=time.perf_counter() - inicio)}
+        return Response(content=imagem, media_type=media_type, headers=headers)
+
+    fonte = fontes_renderizacao.obter(token)
+    if fonte is None:
+        raise HTTPException(status_code=404, detail="Token inválido ou análise expirada")
+    tempos = {}
+    try:
+        imagem = await asyncio.to_thread(renderizar_resultado, fonte, formato, qualidade, lado_max, tempos)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    cache_renderizacoes.armazenar(chave, imagem, len(imagem))
+    headers = {"X-Cache": "MISS", "Server-Timing": cabecalho_server_timing(tempos, total=time.perf_counter() - inicio)}
+    return Response(content=imagem, media_type=media_type, headers=headers)
+
+
+@app.post("/sessoes/", summary="Cria uma sessão de ajuste de parâmetros para uma imagem")
+async def criar_sessao(
+    file: UploadFile = File(..., description="Imagem da placa de Petri"),
+    nome_amostra: str = Form(..., description="Identificação da amostra."),
+):
+    conteudo_arquivo = await file.read()
+    if not conteudo_arquivo:
+        raise HTTPException(status_code=400, detail="Arquivo enviado está vazio.")
+    sessao_id = cache_sessoes.criar(conteudo_arquivo, nome_amostra)
+    return {"sessao_id": sessao_id, "ttl_s": SESSAO_TTL_S}
+
+
+@app.post("/sessoes/{sessao_id}/contar/", summary="Reprocessa a imagem da sessão com novos parâmetros")
+async def contar_sessao_endpoint(
+    sessao_id: str,
+    x: int = Form(None, description="Coord. X manual do centro da placa (pixels na imagem original)"),
+    y: int = Form(None, description="Coord. Y manual do centro da placa (pixels na imagem original)"),
+    r: int = Form(None, description="Raio manual da placa (pixels na imagem original)"),
+    area_min: float = Form(10.0, description="Área mínima da colônia (px)"),
+    circularidade_min: float = Form(0.40, description="Circularidade mínima"),
+    max_colony_size_factor: float = Form(
+        MAX_COLONY_RADIUS_FACTOR_OF_PETRI_MARGIN,
+        description="Fator máximo do raio da colônia em relação à margem"
+    ),
+    local_max_filter_size: int = Form(7, description="Tamanho do filtro de máximo local"),
+    thresh_block_size: int = Form(41, description="Tamanho do bloco do adaptive threshold"),
+    thresh_c: int = Form(4, description="Constante C do adaptive threshold"),
+    alta_resolucao: bool = Form(
+        False, description="Segmenta na resolução original em blocos (fotos grandes, colônias puntiformes)"
+    ),
+    motor_segmentacao: str = Form(
+        "watershed", description="'watershed' (completo) ou 'componentes' (rápido para placas esparsas)"
+    ),
+    formato_resposta: str = Form(
+        "imagem", description="'imagem' (JPEG anotado) ou 'json' (contagens e colony_data, sem desenhar a imagem)"
+    ),
+):
+    renderizar = validar_formato_resposta(formato_resposta)
+    sessao = cache_sessoes.obter(sessao_id)
+    if sessao is None:
+        raise HTTPException(status_code=404, detail="Sessão inválida ou expirada")
+    nome_amostra = sessao.nome_amostra
+    with erros_de_contagem(nome_amostra):
+        _, imagem_processada, response_headers_dict, colony_data = await executar_contagem(
+            executor_sessoes,
+            _processar_sessao_worker,
+            sessao,
+            nome_amostra,
+            x_manual=x,
+            y_manual=y,
+            r_manual=r,
+            area_min=area_min,
+            circularidade_min=circularidade_min,
+            max_colony_size_factor=max_colony_size_factor,
+            local_max_filter_size=local_max_filter_size,
+            thresh_block_size=thresh_block_size,
+            thresh_c=thresh_c,
+            alta_resolucao=alta_resolucao,
+            motor_segmentacao=motor_segmentacao,
+            renderizar=renderizar,
+        )
+        token = registrar_resultado(colony_data)
+        registrar_fonte_renderizacao(token, sessao.imagem_bytes, nome_amostra, response_headers_dict, colony_data)
+        response_headers_dict["X-Feedback-Token"] = token
+        if not renderizar:
+            return resposta_json(nome_amostra, token, response_headers_dict, colony_data)
+        return StreamingResponse(imagem_processada, media_type="image/jpeg", headers=response_headers_dict)
+
+
+@app.delete("/sessoes/{sessao_id}", summary="Encerra uma sessão de ajuste e libera o cache")
+async def remover_sessao(sessao_id: str):
+    if not cache_sessoes.remover(sessao_id):
+        raise HTTPException(status_code=404, detail="Sessão inválida ou expirada")
+    return {"removida": sessao_id}
+
+
+@app.post("/tarefas/", status_code=202, summary="Envia uma imagem para contagem assíncrona e retorna o id da tarefa")
+async def criar_tarefa(
+    file: UploadFile = File(..., description="Imagem da placa de Petri"),
+    nome_amostra: str = Form(..., description="Identificação da amostra."),
+    x: int = Form(None, description="Coord. X manual do centro da placa (pixels na imagem original)"),
+    y: int = Form(None, description="Coord. Y manual do centro da placa (pixels na imagem original)"),
+    r: int = Form(None, description="Raio manual da placa (pixels na imagem original)"),
+    area_min: float = Form(10.0, description="Área mínima da colônia (px)"),
+    circularidade_min: float = Form(0.40, description="Circularidade mínima"),
+    max_colony_size_factor: float = Form(
+        MAX_COLONY_RADIUS_FACTOR_OF_PETRI_MARGIN,
+        description="Fator máximo do raio da colônia em relação à margem"
+    ),
+    local_max_filter_size: int = Form(7, description="Tamanho do filtro de máximo local"),
+    thresh_block_size: int = Form(41, description="Tamanho do bloco do adaptive threshold"),
+    thresh_c: int = Form(4, description="Constante C do adaptive threshold"),
+    alta_resolucao: bool = Form(
+        False, description="Segmenta na resolução original em blocos (fotos grandes, colônias puntiformes)"
+    ),
+    motor_segmentacao: str = Form(
+        "watershed", description="'watershed' (completo) ou 'componentes' (rápido para placas esparsas)"
+    ),
+    formato_resposta: str = Form(
+        "imagem", description="'imagem' guarda o JPEG anotado em /imagem/{token}; 'json' não desenha a imagem"
+    ),
+):
+    renderizar = validar_formato_resposta(formato_resposta)
+    if motor_segmentacao not in MOTORES_SEGMENTACAO:
+        raise HTTPException(
+            status_code=400, detail=f"motor_segmentacao deve ser um de: {', '.join(MOTORES_SEGMENTACAO)}"
+        )
+    conteudo_arquivo = await file.read()
+    if not conteudo_arquivo:
+        raise HTTPException(status_code=400, detail="Arquivo enviado está vazio.")
+    if executor_processamento.em_execucao >= executor_processamento.capacidade:
+        raise HTTPException(
+            status_code=503,
+            detail="Servidor ocupado processando outras imagens. Tente novamente em instantes.",
+            headers={"Retry-After": str(PROCESS_POOL_RETRY_AFTER_S)},
+        )
+
+    parametros = dict(
+        x_manual=x,
+        y_manual=y,
+        r_manual=r,
+        area_min=area_min,
+        circularidade_min=circularidade_min,
+        max_colony_size_factor=max_colony_size_factor,
+        local_max_filter_size=local_max_filter_size,
+        thresh_block_size=thresh_block_size,
+        thresh_c=thresh_c,
+        alta_resolucao=alta_resolucao,
+        motor_segmentacao=motor_segmentacao,
+    )
+    tarefa = gerenciador_tarefas.criar(nome_amostra)
+    tarefa.emitir("na_fila")
+    tarefa.execucao = asyncio.create_task(executar_tarefa(tarefa, conteudo_arquivo, renderizar, parametros))
+    return JSONResponse(
+        status_code=202, content=tarefa.estado(), headers={"Location": f"/tarefas/{tarefa.tarefa_id}"}
+    )
+
+
+def _obter_tarefa(tarefa_id):
+    tarefa = gerenciador_tarefas.obter(tarefa_id)
+    if tarefa is None:
+        raise HTTPException(status_code=404, detail="Tarefa inválida ou expirada")
+    return tarefa
+
+
+@app.get("/tarefas/{tarefa_id}", summary="Estado e resultado de uma tarefa")
+async def obter_tarefa(tarefa_id: str):
+    return _obter_tarefa(tarefa_id).estado()
+
+
+@app.get("/tarefas/{tarefa_id}/eventos", summary="Progresso da tarefa por Server-Sent Events")
+async def eventos_tarefa(tarefa_id: str, request: Request):
+    tarefa = _obter_tarefa(tarefa_id)
+    # Reconexões do EventSource enviam o id do último evento recebido
+    ultimo_id = request.headers.get("last-event-id", "")
+    inicio = int(ultimo_id) + 1 if ultimo_id.isdigit() else 0
+
+    async def gerar_eventos():
+        enviados = inicio
+        while True:
+            novos = await tarefa.aguardar_eventos(enviados, TAREFAS_HEARTBEAT_S)
+            if not novos:
+                # Comentário SSE: mantém a conexão viva em proxies com timeout de inatividade
+                yield ": ping\n\n"
+                continue
+            for evento in novos:
+                yield f"id: {enviados}\nevent: {evento['evento']}\ndata: {json.dumps(evento, ensure_ascii=False)}\n\n"
+                enviados += 1
+            if tarefa.finalizada and enviados >= len(tarefa.eventos):
+                return
+
+    return StreamingResponse(
+        gerar_eventos(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.delete("/tarefas/{tarefa_id}", summary="Cancela uma tarefa ou descarta o resultado de uma tarefa finalizada")
+async def remover_tarefa(tarefa_id: str):
+    """Cancela a tarefa. Na fila ela não chega a rodar; em um worker ela para ao fim da etapa em andamento
+    (a segmentação, a mais longa, não é interrompida no meio) e a vaga no pool é liberada.
+    """
+    tarefa = _obter_tarefa(tarefa_id)
+    if tarefa.finalizada:
+        gerenciador_tarefas.remover(tarefa_id)
+        return {"tarefa_id": tarefa_id, "status": tarefa.status, "removida": True}
+    marcar_tarefa_cancelada(tarefa.numero)
+    tarefa.execucao.cancel()
+    tarefa.finalizar("cancelada")
+    return {"tarefa_id": tarefa_id, "status": tarefa.status, "removida": False}
@@ -0,0 +1,80 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+import main  # noqa: E402
+from synthetic_plates import gerar_placa  # noqa: E402
+
+
+def gerar_placa_cinza(semente, largura, altura):
+    """Placa sintética em tons de cinza com posição, raio e número de colônias variando com a semente."""
+    rng = np.random.default_rng(semente)
+    img, verdade = gerar_placa(
+        semente, largura, altura,
+        n_colonias=int(rng.integers(20, 400)),
+        raio_colonia=(3, 14),
+        sobreposicao=float(rng.uniform(0, 0.3)),
+        mistura_cores={"amarela": 1.0, "rosada": 1.0, "clara": 1.0, "bege": 1.0},
+        deslocamento_placa=(float(rng.uniform(-0.1, 0.1)), float(rng.uniform(-0.1, 0.1))),
+        raio_placa_frac=float(rng.uniform(0.30, 0.47)),
+    )
+    placa = verdade["placa"]
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), (placa["cx"], placa["cy"], placa["r"])
+
+
+def medir(detector, imagens, tolerancia_px):
+    tempos, erros, falhas = [], [], 0
+    for gray, (cx, cy, raio) in imagens:
+        inicio = time.perf_counter()
+        circulo = detector(gray)
+        tempos.append(time.perf_counter() - inicio)
+        if circulo is None:
+            falhas += 1
+            continue
+        erro = max(abs(float(circulo[0]) - cx), abs(float(circulo[1]) - cy), abs(float(circulo[2]) - raio))
+        if erro > tolerancia_px:
+            falhas += 1
+        else:
+            erros.append(erro)
+    return {
+        "tempo_medio_s": float(np.mean(tempos)),
+        "tempo_p95_s": float(np.percentile(tempos, 95)),
+        "erro_medio_px": float(np.mean(erros)) if erros else None,
+        "falhas": falhas,
+        "imagens": len(imagens),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Compara tempo e precisão da detecção de placa")
+    parser.add_argument("--imagens", type=int, default=40, help="Número de placas sintéticas")
+    parser.add_argument("--tolerancia", type=float, default=10.0, help="Erro máximo (px) para considerar acerto")
+    parser.add_argument("--json", help="Arquivo para salvar o resultado em JSON")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    tamanhos = [(1200, 900), (900, 1200), (1200, 1200), (1200, 800)]
+    imagens = [gerar_placa_cinza(i, *tamanhos[i % len(tamanhos)]) for i in range(args.imagens)]
+
+    resultado = {
+        "completo": medir(main.detectar_placa_hough_completo, imagens, args.tolerancia),
+        "piramide": medir(lambda g: (main.detectar_placas_candidatas(g) or [None])[0], imagens, args.tolerancia),
+    }
+    for modo, r in resultado.items():
+        erro = f"{r['erro_medio_px']:.2f}" if r["erro_medio_px"] is not None else "-"
+        print(f"{modo:>9}: {r['tempo_medio_s'] * 1000:7.1f} ms médio, p95 {r['tempo_p95_s'] * 1000:7.1f} ms, "
+              f"erro médio {erro} px, falhas {r['falhas']}/{r['imagens']}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(resultado, f, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
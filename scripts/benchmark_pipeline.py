@@ -0,0 +1,177 @@
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import cv2
+import numpy as np
+
+DIR_SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(DIR_SCRIPTS, "..", "backend"))
+import main  # noqa: E402
+from synthetic_plates import codificar, gerar_placa  # noqa: E402
+
+ESTAGIOS = [
+    "decodificacao", "redimensionamento", "placa", "preprocessamento", "limiarizacao",
+    "componentes", "distancia", "watershed", "marcadores", "classificacao", "desenho", "encode",
+]
+CLASSES = ["amarela", "bege", "clara", "rosada"]
+
+
+def _tamanho(texto):
+    """'1200x900' -> (1200, 900)"""
+    largura, _, altura = texto.lower().partition("x")
+    return int(largura), int(altura)
+
+
+def commit_atual():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=DIR_SCRIPTS, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def medir_cenario(largura, altura, n_colonias, sobreposicao, semente, repeticoes, mistura_cores,
+                  alta_resolucao=False, motor_segmentacao="watershed"):
+    """Roda processar_imagem em uma placa sintética e devolve tempos por estágio (mediana) e erro de contagem."""
+    # Raio das colônias proporcional à resolução, como numa foto real da mesma placa
+    escala = min(largura, altura) / 900
+    img, verdade = gerar_placa(
+        semente, largura, altura, n_colonias,
+        raio_colonia=(max(2, int(5 * escala)), max(3, int(10 * escala))),
+        sobreposicao=sobreposicao, mistura_cores=mistura_cores,
+    )
+    imagem_bytes = codificar(img)
+
+    opcoes = dict(alta_resolucao=alta_resolucao, motor_segmentacao=motor_segmentacao)
+    main.processar_imagem(imagem_bytes, "aquecimento", **opcoes)
+    tempos_por_estagio = {estagio: [] for estagio in ESTAGIOS}
+    totais = []
+    for _ in range(repeticoes):
+        tempos = {}
+        inicio = time.perf_counter()
+        resumo, _, cabecalhos, _ = main.processar_imagem(
+            imagem_bytes, "benchmark", tempos_estagios=tempos, **opcoes
+        )
+        totais.append(time.perf_counter() - inicio)
+        for estagio in ESTAGIOS:
+            tempos_por_estagio[estagio].append(tempos.get(estagio, 0.0))
+
+    detectado = resumo.get("total", 0)
+    return {
+        "id": (f"{largura}x{altura}_n{n_colonias}_s{sobreposicao:g}" + ("_ar" if alta_resolucao else "")
+               + ("" if motor_segmentacao == "watershed" else f"_{motor_segmentacao}")),
+        "largura": largura,
+        "altura": altura,
+        "colonias": n_colonias,
+        "sobreposicao": sobreposicao,
+        "bytes_entrada": len(imagem_bytes),
+        "tempos_ms": {e: round(float(np.median(v)) * 1000, 3) for e, v in tempos_por_estagio.items()},
+        "total_ms": round(float(np.median(totais)) * 1000, 3),
+        "contagem": {
+            "verdade": verdade["total"],
+            "detectada": detectado,
+            "erro": detectado - verdade["total"],
+            "erro_relativo": round((detectado - verdade["total"]) / max(verdade["total"], 1), 4),
+            "por_cor": {
+                c: {"verdade": verdade["por_cor"].get(c, 0), "detectada": resumo.get(c, 0)} for c in CLASSES
+            },
+            "avaliadas": int(cabecalhos["X-Feedback-Avaliadas"]),
+        },
+    }
+
+
+def comparar(resultado, referencia, limite):
+    """Imprime a razão atual/referência por cenário e estágio; retorna os cenários que pioraram além do limite."""
+    anteriores = {c["id"]: c for c in referencia["cenarios"]}
+    regressoes = []
+    print(f"\nComparação com {referencia.get('commit') or 'referência'} (razão atual/anterior):")
+    for cenario in resultado["cenarios"]:
+        anterior = anteriores.get(cenario["id"])
+        if anterior is None:
+            continue
+        razao_total = cenario["total_ms"] / max(anterior["total_ms"], 1e-9)
+        piores = sorted(
+            ((e, cenario["tempos_ms"].get(e, 0) / max(anterior["tempos_ms"].get(e, 0), 1e-3)) for e in ESTAGIOS
+             if anterior["tempos_ms"].get(e, 0) >= 1.0),
+            key=lambda item: -item[1],
+        )[:3]
+        erro = f"erro {anterior['contagem']['erro']:+d} -> {cenario['contagem']['erro']:+d}"
+        detalhes = ", ".join(f"{e} {r:.2f}x" for e, r in piores)
+        print(f"  {cenario['id']:<38} total {razao_total:.2f}x  {erro}  ({detalhes})")
+        if razao_total > limite or abs(cenario["contagem"]["erro"]) > abs(anterior["contagem"]["erro"]):
+            regressoes.append(cenario["id"])
+    return regressoes
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(
+        description="Mede o tempo de cada estágio de processar_imagem e o erro de contagem em placas sintéticas"
+    )
+    parser.add_argument("--tamanhos", type=_tamanho, nargs="+", default=[(1200, 900), (2400, 1800), (4000, 3000)])
+    parser.add_argument("--densidades", type=int, nargs="+", default=[50, 200, 600], help="Colônias por placa")
+    parser.add_argument("--sobreposicao", type=float, nargs="+", default=[0.0, 0.3])
+    parser.add_argument("--alta-resolucao", action="store_true",
+                        help="Usa o modo alta_resolucao (segmentação em blocos na resolução original)")
+    parser.add_argument("--motores", nargs="+", default=["watershed"], choices=main.MOTORES_SEGMENTACAO,
+                        help="Motores de segmentação a medir (cada um vira um cenário)")
+    parser.add_argument("--repeticoes", type=int, default=3)
+    parser.add_argument("--semente", type=int, default=0)
+    parser.add_argument("--json", help="Arquivo para salvar o resultado em JSON")
+    parser.add_argument("--comparar", help="JSON de uma execução anterior para comparar")
+    parser.add_argument("--limite", type=float, default=1.15,
+                        help="Razão de tempo total acima da qual o cenário é marcado como regressão")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    main.aguardar_modelo_cor()
+    mistura_cores = {c: 1.0 for c in CLASSES}
+
+    cenarios = []
+    for largura, altura in args.tamanhos:
+        for n_colonias in args.densidades:
+            for sobreposicao in args.sobreposicao:
+                for motor in args.motores:
+                    cenario = medir_cenario(
+                        largura, altura, n_colonias, sobreposicao, args.semente, args.repeticoes, mistura_cores,
+                        args.alta_resolucao, motor,
+                    )
+                    cenarios.append(cenario)
+                    contagem = cenario["contagem"]
+                    mais_lentos = sorted(cenario["tempos_ms"].items(), key=lambda item: -item[1])[:3]
+                    print(f"{cenario['id']:<38} {cenario['total_ms']:8.1f} ms  "
+                          f"contagem {contagem['detectada']}/{contagem['verdade']} ({contagem['erro_relativo']:+.1%})  "
+                          + ", ".join(f"{e} {t:.1f}" for e, t in mais_lentos))
+
+    resultado = {
+        "commit": commit_atual(),
+        "data": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "opencv": cv2.__version__,
+        "modelo_cor": main.modelo_cor.status,
+        "versao_modelo_cor": main.modelo_cor.versao,
+        "repeticoes": args.repeticoes,
+        "semente": args.semente,
+        "cenarios": cenarios,
+    }
+
+    regressoes = []
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            regressoes = comparar(resultado, json.load(f), args.limite)
+        resultado["regressoes"] = regressoes
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(resultado, f, indent=2)
+    if regressoes:
+        print(f"\nRegressões: {', '.join(regressoes)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,90 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+
+
+def medir_importacao():
+    """Tempo de `import main` em um interpretador novo."""
+    codigo = (
+        "import time, logging; logging.disable(logging.CRITICAL); "
+        "t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+    )
+    saida = subprocess.run(
+        [sys.executable, "-c", codigo], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+    )
+    return float(saida.stdout.strip().splitlines()[-1])
+
+
+def porta_livre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def medir_primeira_resposta(timeout_s=60):
+    """Inicia o uvicorn e mede o tempo até a primeira resposta HTTP e até /pronto retornar 200."""
+    porta = porta_livre()
+    inicio = time.perf_counter()
+    processo = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(porta), "--log-level", "warning"],
+        cwd=BACKEND_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    primeira_resposta = None
+    pronto = None
+    try:
+        while time.perf_counter() - inicio < timeout_s:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{porta}/pronto", timeout=1) as resposta:
+                    status = resposta.status
+            except urllib.error.HTTPError as e:
+                status = e.code
+            except (urllib.error.URLError, ConnectionError, socket.timeout):
+                time.sleep(0.01)
+                continue
+            agora = time.perf_counter() - inicio
+            if primeira_resposta is None:
+                primeira_resposta = agora
+            if status == 200:
+                pronto = agora
+                break
+            time.sleep(0.01)
+    finally:
+        processo.terminate()
+        processo.wait(timeout=10)
+    return primeira_resposta, pronto
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mede o tempo de importação e de inicialização do backend")
+    parser.add_argument("--repeticoes", type=int, default=3)
+    parser.add_argument("--json", help="Arquivo para salvar o resultado em JSON")
+    args = parser.parse_args()
+
+    importacoes = [medir_importacao() for _ in range(args.repeticoes)]
+    respostas = [medir_primeira_resposta() for _ in range(args.repeticoes)]
+    resultado = {
+        "importacao_s": min(importacoes),
+        "primeira_resposta_s": min(r[0] for r in respostas if r[0] is not None),
+        "pronto_s": min(r[1] for r in respostas if r[1] is not None),
+        "modelo_cor": os.path.exists(os.path.join(BACKEND_DIR, "color_model.pkl")),
+    }
+    print(f"import main:       {resultado['importacao_s']:.3f}s")
+    print(f"primeira resposta: {resultado['primeira_resposta_s']:.3f}s")
+    print(f"/pronto = 200:     {resultado['pronto_s']:.3f}s")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(resultado, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import pandas as pd
+
+DIR_SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(DIR_SCRIPTS, "..", "backend"))
+import main  # noqa: E402
+
+COLUNAS_INICIAIS = ["arquivo", "nome_amostra", "placa", "status", "erro", "processamento_s"]
+COLUNAS_COLONIAS = ["arquivo", "placa", "indice", "h", "s", "v", "pred", "cx", "cy", "r", "modelo_cor"]
+PARAMETROS = {
+    "area_min": float,
+    "circularidade_min": float,
+    "max_colony_size_factor": float,
+    "local_max_filter_size": int,
+    "thresh_block_size": int,
+    "thresh_c": int,
+}
+# Headers que viram números nas tabelas; os demais (X-Modelo-Cor, X-Motor-Segmentacao, ...) ficam como texto
+HEADERS_NUMERICOS = {
+    **dict.fromkeys([
+        "X-Resumo-Total", "X-Resumo-Amarela", "X-Resumo-Bege", "X-Resumo-Clara", "X-Resumo-Rosada",
+        "X-Feedback-Avaliadas", "X-Feedback-Filtradas-Area", "X-Feedback-Filtradas-Circularidade",
+        "X-Feedback-Filtradas-Tamanho-Maximo", "X-Feedback-Desenhadas", "X-Feedback-Raio-Detectado-Px",
+        "X-Feedback-Estimativa-Total-Colonias",
+    ], int),
+    **dict.fromkeys([
+        "X-Feedback-Confianca-Placa", "X-Feedback-Area-Amostrada-Cm2", "X-Feedback-Densidade-Colonias-Cm2",
+    ], float),
+}
+
+
+def _coluna(header):
+    """'X-Feedback-Densidade-Colonias-Cm2' -> 'feedback_densidade_colonias_cm2'"""
+    return header.lower().removeprefix("x-").replace("-", "_")
+
+
+def _valor(header, texto):
+    """Converte os headers de HEADERS_NUMERICOS ('62' -> 62); os demais ficam como texto.
+
+    A conversão é por nome e não pelo conteúdo: uma versão do modelo como '120e45678901' não pode
+    virar número, senão o tipo da coluna mudaria de uma parte para outra.
+    """
+    tipo = HEADERS_NUMERICOS.get(header)
+    if tipo is None or not isinstance(texto, str):
+        return texto
+    try:
+        return tipo(texto)
+    except ValueError:
+        # X-Feedback-Confianca-Placa é 'manual' quando a placa é informada; fica vazio na tabela
+        return None
+
+
+def listar_imagens(raiz):
+    """Caminhos relativos das imagens sob ``raiz``, em ordem, sem montar a lista inteira na memória."""
+    for diretorio, subdiretorios, arquivos in os.walk(raiz):
+        subdiretorios.sort()
+        for nome in sorted(arquivos):
+            if nome.lower().endswith(main.EXTENSOES_IMAGEM):
+                yield os.path.relpath(os.path.join(diretorio, nome), raiz)
+
+
+def _inicializar_worker():
+    # O paralelismo é entre imagens: uma thread do OpenCV por processo evita disputar os núcleos
+    main.cv2.setNumThreads(1)
+    logging.disable(logging.CRITICAL)
+    main.aguardar_modelo_cor()
+
+
+def contar_arquivo(raiz, arquivo, opcoes):
+    """Conta as colônias de uma imagem (em um worker) e devolve (linhas do resumo, linhas das colônias)."""
+    nome_amostra = os.path.splitext(os.path.basename(arquivo))[0]
+    base = {"arquivo": arquivo, "nome_amostra": nome_amostra}
+    inicio = time.perf_counter()
+    try:
+        with open(os.path.join(raiz, arquivo), "rb") as f:
+            imagem_bytes = f.read()
+        if opcoes["max_placas"] > 1:
+            _, imagens, _, placas = main.processar_placas(
+                imagem_bytes, nome_amostra, max_placas=opcoes["max_placas"],
+                imagens="combinada" if opcoes["imagens"] else "nenhuma", **opcoes["parametros"],
+            )
+            resultados = [
+                ({"x": p["x"], "y": p["y"], "r": p["r"], "confianca": p["confianca"], **p["resumo"]}, p["colony_data"])
+                for p in placas
+            ]
+            imagem = imagens[0] if imagens else None
+        else:
+            _, imagem, headers, colony_data = main.processar_imagem(
+                imagem_bytes, nome_amostra, renderizar=opcoes["imagens"], **opcoes["parametros"]
+            )
+            resultados = [(headers, colony_data)]
+            imagem = imagem.getvalue() if imagem is not None else None
+    except main.HTTPException as e:
+        return [{**base, "placa": 0, "status": "erro", "erro": str(e.detail)}], []
+    except Exception as e:
+        return [{**base, "placa": 0, "status": "erro", "erro": f"{type(e).__name__}: {e}"}], []
+
+    if imagem is not None:
+        # O nome inteiro (com a extensão original) evita que a.jpg e a.png na mesma pasta se sobrescrevam
+        destino = os.path.join(opcoes["saida"], "imagens", arquivo + ".jpg")
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        with open(destino, "wb") as f:
+            f.write(imagem)
+    duracao = round(time.perf_counter() - inicio, 4)
+    linhas, colonias = [], []
+    for placa, (campos, colony_data) in enumerate(resultados, 1):
+        linhas.append({
+            **base, "placa": placa, "status": "ok", "erro": "", "processamento_s": duracao,
+            **{_coluna(nome) if nome.startswith("X-") else nome: _valor(nome, valor) for nome, valor in campos.items()},
+        })
+        if opcoes["colonias"]:
+            colonias.extend(
+                {"arquivo": arquivo, "placa": placa, "indice": indice, **colonia}
+                for indice, colonia in enumerate(colony_data)
+            )
+    return linhas, colonias
+
+
+def _gravar_tabela(linhas, caminho, formato, colunas):
+    # Tipos anuláveis: linhas de erro não têm contagens e não devem transformar inteiros em float
+    tabela = pd.DataFrame(linhas).convert_dtypes()
+    tabela = tabela[[c for c in colunas if c in tabela] + [c for c in tabela if c not in colunas]]
+    temporario = f"{caminho}.tmp"
+    if formato == "parquet":
+        tabela.to_parquet(temporario, index=False)
+    else:
+        tabela.to_csv(temporario, index=False)
+    os.replace(temporario, caminho)
+
+
+class SaidaPartes:
+    """Grava os resultados em partes numeradas em ``<saida>/partes``.
+
+    A parte do resumo é gravada por último e serve de checkpoint: as imagens listadas nela estão
+    concluídas. Uma parte de colônias sem o resumo correspondente (execução interrompida entre as duas
+    gravações) é descartada na retomada, e as imagens dela são processadas de novo.
+    """
+
+    def __init__(self, saida, formato):
+        self.diretorio = os.path.join(saida, "partes")
+        self.formato = formato
+        os.makedirs(self.diretorio, exist_ok=True)
+        for temporario in glob.glob(os.path.join(self.diretorio, "*.tmp")):
+            os.remove(temporario)
+        numeros_resumo = self._numeros("resumo")
+        for numero in self._numeros("colonias") - numeros_resumo:
+            os.remove(self._caminho("colonias", numero))
+        self.proximo = max(numeros_resumo, default=0) + 1
+
+    def _caminho(self, tipo, numero):
+        return os.path.join(self.diretorio, f"{tipo}_{numero:06d}.{self.formato}")
+
+    def _numeros(self, tipo):
+        return {
+            int(os.path.basename(caminho)[len(tipo) + 1:].split(".")[0])
+            for caminho in glob.glob(os.path.join(self.diretorio, f"{tipo}_*.{self.formato}"))
+        }
+
+    def partes_resumo(self):
+        return [self._caminho("resumo", numero) for numero in sorted(self._numeros("resumo"))]
+
+    def ler_resumo(self, caminho, colunas=None):
+        if self.formato == "parquet":
+            return pd.read_parquet(caminho, columns=colunas)
+        return pd.read_csv(caminho, usecols=colunas)
+
+    def concluidas(self):
+        """Imagens já registradas em alguma parte do resumo."""
+        feitas = set()
+        for caminho in self.partes_resumo():
+            feitas.update(self.ler_resumo(caminho, ["arquivo"])["arquivo"].astype(str))
+        return feitas
+
+    def gravar(self, linhas, colonias):
+        if colonias:
+            _gravar_tabela(colonias, self._caminho("colonias", self.proximo), self.formato, COLUNAS_COLONIAS)
+        _gravar_tabela(linhas, self._caminho("resumo", self.proximo), self.formato, COLUNAS_INICIAIS)
+        self.proximo += 1
+
+    def consolidar_resumo(self, saida):
+        """Junta as partes do resumo em ``<saida>/resumo.<formato>`` (as colônias ficam só nas partes)."""
+        partes = [self.ler_resumo(caminho) for caminho in self.partes_resumo()]
+        if not partes:
+            return None
+        caminho = os.path.join(saida, f"resumo.{self.formato}")
+        resumo = pd.concat(partes, ignore_index=True).sort_values(["arquivo", "placa"])
+        _gravar_tabela(resumo.to_dict("records"), caminho, self.formato, COLUNAS_INICIAIS)
+        return caminho
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(
+        description="Conta colônias em todas as imagens de um diretório (e subdiretórios), sem passar pela API"
+    )
+    parser.add_argument("entrada", help="Diretório com as fotos das placas")
+    parser.add_argument("saida", help="Diretório de saída (resumo, partes, checkpoint e imagens anotadas)")
+    parser.add_argument("--formato", choices=["csv", "parquet"], default="csv", help="Formato das tabelas")
+    parser.add_argument("--colonias", action="store_true", help="Grava também uma linha por colônia")
+    parser.add_argument("--imagens", action="store_true", help="Grava as imagens anotadas em <saida>/imagens")
+    parser.add_argument("--max-placas", type=int, default=1,
+                        help="Acima de 1, detecta até N placas por foto e grava uma linha por placa")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processos em paralelo")
+    parser.add_argument("--lote", type=int, default=200, help="Imagens por parte gravada (checkpoint)")
+    parser.add_argument("--alta-resolucao", action="store_true", help="Modo alta_resolucao de /contar/")
+    parser.add_argument("--motor-segmentacao", choices=main.MOTORES_SEGMENTACAO, default="watershed")
+    for nome, tipo in PARAMETROS.items():
+        parser.add_argument(f"--{nome.replace('_', '-')}", type=tipo, help=f"{nome} de /contar/")
+    args = parser.parse_args()
+
+    if args.formato == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            parser.error("--formato parquet requer pyarrow")
+    if not os.path.isdir(args.entrada):
+        parser.error(f"{args.entrada} não é um diretório")
+
+    parametros = {nome: getattr(args, nome) for nome in PARAMETROS if getattr(args, nome) is not None}
+    parametros.update(alta_resolucao=args.alta_resolucao, motor_segmentacao=args.motor_segmentacao)
+    execucao = {
+        "entrada": os.path.abspath(args.entrada),
+        "formato": args.formato,
+        "colonias": args.colonias,
+        "max_placas": args.max_placas,
+        "parametros": parametros,
+    }
+    os.makedirs(args.saida, exist_ok=True)
+    caminho_execucao = os.path.join(args.saida, "execucao.json")
+    if os.path.exists(caminho_execucao):
+        with open(caminho_execucao, encoding="utf-8") as f:
+            anterior = json.load(f)
+        if anterior != execucao:
+            parser.error(f"{args.saida} tem uma execução com outras opções ({caminho_execucao}); use outro diretório")
+    else:
+        with open(caminho_execucao, "w", encoding="utf-8") as f:
+            json.dump(execucao, f, indent=2, ensure_ascii=False)
+
+    saida = SaidaPartes(args.saida, args.formato)
+    concluidas = saida.concluidas()
+    if concluidas:
+        print(f"Retomando: {len(concluidas)} imagens já processadas")
+    opcoes = {
+        "saida": args.saida,
+        "imagens": args.imagens,
+        "colonias": args.colonias,
+        "max_placas": args.max_placas,
+        "parametros": parametros,
+    }
+
+    pendentes_arquivos = (a for a in listar_imagens(args.entrada) if a not in concluidas)
+    linhas, colonias, no_lote = [], [], 0
+    processadas, erros = 0, 0
+    inicio = time.perf_counter()
+    executor = ProcessPoolExecutor(
+        max_workers=args.workers, mp_context=multiprocessing.get_context("spawn"), initializer=_inicializar_worker
+    )
+    em_andamento = set()
+    interrompido = False
+    try:
+        while True:
+            # No máximo 2 imagens por worker em andamento: a memória não cresce com o tamanho do acervo
+            while len(em_andamento) < 2 * args.workers:
+                arquivo = next(pendentes_arquivos, None)
+                if arquivo is None:
+                    break
+                em_andamento.add(executor.submit(contar_arquivo, args.entrada, arquivo, opcoes))
+            if not em_andamento:
+                break
+            prontas, em_andamento = wait(em_andamento, return_when=FIRST_COMPLETED)
+            for futura in prontas:
+                linhas_imagem, colonias_imagem = futura.result()
+                linhas.extend(linhas_imagem)
+                colonias.extend(colonias_imagem)
+                no_lote += 1
+                processadas += 1
+                erros += linhas_imagem[0]["status"] == "erro"
+            if no_lote >= args.lote:
+                saida.gravar(linhas, colonias)
+                linhas, colonias, no_lote = [], [], 0
+                decorrido = time.perf_counter() - inicio
+                print(f"{processadas} imagens ({processadas / decorrido:.2f} imagens/s), {erros} com erro")
+    except KeyboardInterrupt:
+        interrompido = True
+    finally:
+        # Mesmo interrompido, o que já terminou vira uma parte e não é refeito na retomada
+        if linhas:
+            saida.gravar(linhas, colonias)
+        executor.shutdown(wait=not interrompido, cancel_futures=True)
+    if interrompido:
+        print(f"Interrompido após {processadas} imagens; rode o mesmo comando para continuar.")
+        sys.exit(130)
+
+    decorrido = time.perf_counter() - inicio
+    print(f"Concluído: {processadas} imagens em {decorrido:.1f}s "
+          f"({processadas / max(decorrido, 1e-9):.2f} imagens/s), {erros} com erro")
+    caminho_resumo = saida.consolidar_resumo(args.saida)
+    if caminho_resumo:
+        print(f"Resumo em {caminho_resumo}" + (f"; colônias em {saida.diretorio}/colonias_*" if args.colonias else ""))
+
+
+if __name__ == "__main__":
+    main_cli()
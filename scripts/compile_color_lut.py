@@ -0,0 +1,42 @@
+import argparse
+import os
+import sys
+
+import joblib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+from main import VERSAO_REGRAS_HSV, compilar_lut_cor, salvar_lut_cor, versao_arquivo_modelo  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Pré-calcula a classe de cor para todo o espaço HSV do OpenCV (LUT 180x256x256)"
+    )
+    parser.add_argument(
+        "--modelo",
+        default="backend/color_model.pkl",
+        help="Modelo treinado (color_model.pkl) a ser compilado",
+    )
+    parser.add_argument(
+        "--regras-hsv",
+        action="store_true",
+        help="Compila as regras HSV fixas (classificar_cor_hsv) em vez do modelo",
+    )
+    parser.add_argument(
+        "--saida",
+        default="backend/color_model_lut.npy",
+        help="Arquivo .npy da LUT; as classes são salvas em um .json ao lado",
+    )
+    args = parser.parse_args()
+
+    modelo = None if args.regras_hsv else joblib.load(args.modelo)
+    versao = VERSAO_REGRAS_HSV if args.regras_hsv else versao_arquivo_modelo(args.modelo)
+    lut, classes = compilar_lut_cor(modelo)
+    caminho_classes = os.path.splitext(args.saida)[0] + ".json"
+    # A versão do modelo vai junto das classes; o backend ignora a LUT se ela não for do modelo em uso
+    salvar_lut_cor(lut, classes, args.saida, caminho_classes, versao_modelo=versao)
+    print(f"LUT do modelo {versao} salva em {args.saida} ({len(classes)} classes: {', '.join(classes)})")
+
+
+if __name__ == "__main__":
+    main()
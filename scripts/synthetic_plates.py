@@ -0,0 +1,199 @@
+import argparse
+import json
+import os
+
+import cv2
+import numpy as np
+
+# Cores BGR escolhidas para cair sem ambiguidade em cada classe de classificar_cor_hsv e
+# ficar mais escuras que o ágar (a segmentação procura regiões escuras no cinza)
+CORES_COLONIAS = {
+    "amarela": (30, 170, 200),
+    "rosada": (150, 110, 210),
+    "clara": (190, 190, 188),
+    "bege": (140, 150, 160),
+}
+COR_AGAR = (215, 220, 225)
+COR_BORDA = (120, 120, 120)
+
+# Fração do raio da placa onde as colônias são colocadas; o backend conta até 0.90 * r
+FRACAO_RAIO_COLONIAS = 0.82
+
+
+def _sortear_cor(rng, mistura_cores):
+    classes = sorted(mistura_cores)
+    pesos = np.array([mistura_cores[c] for c in classes], dtype=np.float64)
+    return classes[int(rng.choice(len(classes), p=pesos / pesos.sum()))]
+
+
+def gerar_placa(
+    semente,
+    largura=1200,
+    altura=900,
+    n_colonias=100,
+    raio_colonia=(6, 12),
+    sobreposicao=0.0,
+    mistura_cores=None,
+    deslocamento_placa=(0.0, 0.0),
+    raio_placa_frac=0.45,
+    vinheta=0.08,
+    ruido=0.0,
+):
+    """Gera uma placa de Petri sintética e a contagem real.
+
+    A mesma ``semente`` com os mesmos parâmetros produz sempre a mesma imagem.
+
+    - ``sobreposicao``: fração (0-1) das colônias encostadas/sobrepostas a uma já existente;
+      as demais são colocadas sem contato.
+    - ``mistura_cores``: pesos por classe (chaves de CORES_COLONIAS); padrão é só 'amarela'.
+    - ``deslocamento_placa``: deslocamento do centro da placa em fração da largura/altura.
+    - ``raio_placa_frac``: raio da placa em fração do menor lado da imagem.
+    - ``vinheta``: escurecimento relativo na borda da placa (iluminação irregular).
+    - ``ruido``: desvio padrão do ruído por pixel; o equalizeHist do pré-processamento o amplifica
+      bastante, então valores acima de 0 geram falsas colônias de propósito.
+
+    Retorna (imagem BGR, verdade) onde ``verdade`` tem a placa (cx, cy, r), o total, a contagem
+    por cor e a lista de colônias (cx, cy, r, cor).
+    """
+    rng = np.random.default_rng(semente)
+    mistura_cores = mistura_cores or {"amarela": 1.0}
+    desconhecidas = set(mistura_cores) - set(CORES_COLONIAS)
+    if desconhecidas:
+        raise ValueError(f"Cores desconhecidas: {sorted(desconhecidas)}")
+
+    raio_placa = int(min(largura, altura) * raio_placa_frac)
+    cx_placa = int(largura / 2 + deslocamento_placa[0] * largura)
+    cy_placa = int(altura / 2 + deslocamento_placa[1] * altura)
+
+    img = np.full((altura, largura, 3), 45, np.uint8)
+    cv2.circle(img, (cx_placa, cy_placa), raio_placa, COR_AGAR, -1)
+    cv2.circle(img, (cx_placa, cy_placa), raio_placa, COR_BORDA, max(2, raio_placa // 80))
+
+    raio_util = raio_placa * FRACAO_RAIO_COLONIAS
+    colonias = []
+    tentativas = 0
+    while len(colonias) < n_colonias and tentativas < n_colonias * 200:
+        tentativas += 1
+        r = int(rng.integers(raio_colonia[0], raio_colonia[1] + 1))
+        if colonias and rng.uniform() < sobreposicao:
+            # Encosta em uma colônia existente com sobreposição parcial (centros a 70-95% da soma dos raios)
+            vizinha = colonias[int(rng.integers(len(colonias)))]
+            angulo = rng.uniform(0, 2 * np.pi)
+            distancia = (vizinha[2] + r) * rng.uniform(0.70, 0.95)
+            cx = vizinha[0] + distancia * np.cos(angulo)
+            cy = vizinha[1] + distancia * np.sin(angulo)
+            livre = all(np.hypot(cx - c[0], cy - c[1]) >= 0.70 * (r + c[2]) for c in colonias)
+        else:
+            angulo = rng.uniform(0, 2 * np.pi)
+            distancia = (raio_util - r) * np.sqrt(rng.uniform())
+            cx = cx_placa + distancia * np.cos(angulo)
+            cy = cy_placa + distancia * np.sin(angulo)
+            livre = all(np.hypot(cx - c[0], cy - c[1]) >= r + c[2] + 3 for c in colonias)
+        if not livre or np.hypot(cx - cx_placa, cy - cy_placa) + r > raio_util:
+            continue
+        colonias.append((int(round(cx)), int(round(cy)), r, _sortear_cor(rng, mistura_cores)))
+
+    for cx, cy, r, cor in colonias:
+        variacao = rng.integers(-8, 9, 3)
+        bgr = tuple(int(np.clip(v + d, 0, 255)) for v, d in zip(CORES_COLONIAS[cor], variacao))
+        cv2.circle(img, (cx, cy), r, bgr, -1, cv2.LINE_AA)
+
+    img = cv2.GaussianBlur(img, (3, 3), 0).astype(np.float32)
+    if vinheta > 0:
+        yy, xx = np.mgrid[0:altura, 0:largura]
+        distancia_rel = np.hypot(xx - cx_placa, yy - cy_placa) / max(raio_placa, 1)
+        img *= (1 - vinheta * np.minimum(distancia_rel, 1.0) ** 2)[..., None]
+    if ruido > 0:
+        img += rng.normal(0, ruido, img.shape)
+    img = np.clip(img, 0, 255).astype(np.uint8)
+
+    por_cor = {cor: 0 for cor in CORES_COLONIAS}
+    for *_, cor in colonias:
+        por_cor[cor] += 1
+    verdade = {
+        "placa": {"cx": cx_placa, "cy": cy_placa, "r": raio_placa},
+        "total": len(colonias),
+        "por_cor": por_cor,
+        "colonias": [{"cx": cx, "cy": cy, "r": r, "cor": cor} for cx, cy, r, cor in colonias],
+    }
+    return img, verdade
+
+
+def gerar_bandeja(semente, linhas=2, colunas=3, lado_placa=600, n_colonias=50, **kwargs):
+    """Foto sintética de uma bandeja com ``linhas`` x ``colunas`` placas lado a lado.
+
+    Cada placa é gerada por gerar_placa em uma célula de ``lado_placa`` px com semente própria; os
+    demais argumentos (raio_colonia, sobreposicao, mistura_cores, ...) valem para todas. Retorna
+    (imagem BGR, verdades), com uma verdade por placa em coordenadas da bandeja, na ordem das linhas.
+    """
+    img = np.full((linhas * lado_placa, colunas * lado_placa, 3), 45, np.uint8)
+    verdades = []
+    for i in range(linhas * colunas):
+        linha, coluna = divmod(i, colunas)
+        y0, x0 = linha * lado_placa, coluna * lado_placa
+        placa, verdade = gerar_placa(semente + i, lado_placa, lado_placa, n_colonias, **kwargs)
+        img[y0:y0 + lado_placa, x0:x0 + lado_placa] = placa
+        verdade["placa"] = {**verdade["placa"], "cx": verdade["placa"]["cx"] + x0,
+                            "cy": verdade["placa"]["cy"] + y0}
+        verdade["colonias"] = [{**c, "cx": c["cx"] + x0, "cy": c["cy"] + y0} for c in verdade["colonias"]]
+        verdades.append(verdade)
+    return img, verdades
+
+
+def codificar(img, formato="jpg", qualidade=92):
+    """Codifica a imagem como o frontend enviaria (JPEG por padrão)."""
+    parametros = [cv2.IMWRITE_JPEG_QUALITY, qualidade] if formato in ("jpg", "jpeg") else []
+    ok, buffer = cv2.imencode(f".{formato}", img, parametros)
+    if not ok:
+        raise ValueError(f"Não foi possível codificar a imagem como {formato}")
+    return buffer.tobytes()
+
+
+def _mistura(texto):
+    """'amarela=2,rosada=1' -> {'amarela': 2.0, 'rosada': 1.0}"""
+    mistura = {}
+    for item in texto.split(","):
+        cor, _, peso = item.partition("=")
+        mistura[cor.strip()] = float(peso or 1)
+    return mistura
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gera placas de Petri sintéticas com contagem real conhecida")
+    parser.add_argument("--saida", default="placas_sinteticas", help="Diretório de saída")
+    parser.add_argument("--quantidade", type=int, default=10)
+    parser.add_argument("--semente", type=int, default=0, help="Semente da primeira placa")
+    parser.add_argument("--largura", type=int, default=1200)
+    parser.add_argument("--altura", type=int, default=900)
+    parser.add_argument("--colonias", type=int, default=100)
+    parser.add_argument("--raio-colonia", type=int, nargs=2, default=(6, 12), metavar=("MIN", "MAX"))
+    parser.add_argument("--sobreposicao", type=float, default=0.0)
+    parser.add_argument("--cores", type=_mistura, default=None, help="Ex.: amarela=2,rosada=1,clara=1")
+    parser.add_argument("--formato", default="jpg", choices=["jpg", "png"])
+    parser.add_argument("--bandeja", type=int, nargs=2, metavar=("LINHAS", "COLUNAS"),
+                        help="Gera fotos de bandeja com LINHAS x COLUNAS placas (cada uma com --largura px de lado)")
+    args = parser.parse_args()
+
+    os.makedirs(args.saida, exist_ok=True)
+    for i in range(args.quantidade):
+        semente = args.semente + i
+        if args.bandeja:
+            img, verdade = gerar_bandeja(
+                semente, *args.bandeja, args.largura, args.colonias, raio_colonia=tuple(args.raio_colonia),
+                sobreposicao=args.sobreposicao, mistura_cores=args.cores,
+            )
+        else:
+            img, verdade = gerar_placa(
+                semente, args.largura, args.altura, args.colonias, tuple(args.raio_colonia),
+                args.sobreposicao, args.cores,
+            )
+        base = os.path.join(args.saida, f"placa_{semente:04d}")
+        with open(f"{base}.{args.formato}", "wb") as f:
+            f.write(codificar(img, args.formato))
+        with open(f"{base}.json", "w", encoding="utf-8") as f:
+            json.dump(verdade, f, indent=2)
+    print(f"{args.quantidade} placas salvas em {args.saida}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,137 @@
 import argparse
+import io
+import json
+import os
+import time
+
+import joblib
 import pandas as pd
 from sklearn.ensemble import RandomForestClassifier
-import joblib
+
+try:
+    import fcntl
+except ImportError:  # Windows: sem trava entre processos
+    fcntl = None
+
+DIR_BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+LOGS_BACKEND = [
+    os.path.join(DIR_BACKEND, "analysis_hsv_log.csv"),
+    os.path.join(DIR_BACKEND, "feedback_data.csv"),
+]
+COLUNAS = ["h", "s", "v", "label"]
+VERSAO_CHECKPOINT = 1
+
+
+class _Trecho(io.RawIOBase):
+    """Leitura de ``arquivo`` até o byte ``fim``, para não pegar um lote que o backend ainda está gravando."""
+
+    def __init__(self, arquivo, fim):
+        self.arquivo = arquivo
+        self.restante = fim - arquivo.tell()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.restante <= 0:
+            return 0
+        dados = self.arquivo.read(min(len(buffer), self.restante))
+        buffer[:len(dados)] = dados
+        self.restante -= len(dados)
+        return len(dados)
+
+
+def _tamanho_consistente(arquivo):
+    """Tamanho do arquivo entre dois lotes: o GravadorLogs do backend grava cada lote sob trava exclusiva."""
+    if fcntl is None:
+        return os.fstat(arquivo.fileno()).st_size
+    fcntl.flock(arquivo, fcntl.LOCK_SH)
+    try:
+        return os.fstat(arquivo.fileno()).st_size
+    finally:
+        fcntl.flock(arquivo, fcntl.LOCK_UN)
+
+
+def agregar(tabelas):
+    """Soma os pesos de linhas (h, s, v, label) iguais."""
+    tabelas = [t for t in tabelas if len(t)]
+    if not tabelas:
+        return pd.DataFrame({c: pd.Series(dtype="uint8") for c in COLUNAS[:3]}).assign(
+            label=pd.Series(dtype="object"), peso=pd.Series(dtype="int64")
+        )
+    return pd.concat(tabelas, ignore_index=True).groupby(COLUNAS, as_index=False, observed=True)["peso"].sum()
+
+
+def ler_fonte(caminho, inicio, tamanho_bloco):
+    """Lê as linhas de ``caminho`` a partir do byte ``inicio``, em blocos, já agregadas em pesos.
+
+    Retorna (tabela h, s, v, label, peso; linhas lidas; byte em que a leitura parou).
+    """
+    with open(caminho, "rb") as arquivo:
+        fim = _tamanho_consistente(arquivo)
+        cabecalho = arquivo.readline().decode("utf-8").strip().split(",")
+        if not set(COLUNAS) <= set(cabecalho):
+            raise ValueError(f"{caminho}: colunas esperadas {COLUNAS}, encontradas {cabecalho}")
+        arquivo.seek(max(inicio, arquivo.tell()))
+        if arquivo.tell() >= fim:
+            return agregar([]), 0, fim
+        blocos = pd.read_csv(
+            io.BufferedReader(_Trecho(arquivo, fim)), header=None, names=cabecalho, usecols=COLUNAS,
+            chunksize=tamanho_bloco, encoding="utf-8",
+        )
+        parciais, linhas = [], 0
+        for bloco in blocos:
+            linhas += len(bloco)
+            bloco = bloco.dropna()
+            hsv = bloco[COLUNAS[:3]].apply(pd.to_numeric, errors="coerce")
+            validas = hsv.notna().all(axis=1) & (hsv >= 0).all(axis=1) & (hsv <= 255).all(axis=1)
+            bloco = hsv[validas].astype("uint8").assign(label=bloco["label"][validas].astype(str), peso=1)
+            parciais.append(bloco.groupby(COLUNAS, as_index=False, observed=True)["peso"].sum())
+            # Junta os parciais de tempos em tempos para a memória ficar limitada pelas combinações distintas
+            if len(parciais) >= 8:
+                parciais = [agregar(parciais)]
+    return agregar(parciais), linhas, fim
+
+
+def salvar(objeto, caminho):
+    """Grava em um temporário e renomeia; o backend observa o modelo e não pode ler um arquivo parcial."""
+    temporario = f"{caminho}.tmp"
+    joblib.dump(objeto, temporario)
+    os.replace(temporario, caminho)
+
+
+def carregar_checkpoint(caminho):
+    if not os.path.exists(caminho):
+        return None
+    checkpoint = joblib.load(caminho)
+    if checkpoint.get("versao") != VERSAO_CHECKPOINT:
+        print(f"Checkpoint {caminho} de versão incompatível; refazendo a leitura completa.")
+        return None
+    return checkpoint
+
+
+def treinar(tabela, arvores, n_jobs, modelo_anterior=None, arvores_novas=0):
+    """Ajusta a floresta nas combinações distintas, com a contagem de cada uma como peso da amostra.
+
+    Com ``modelo_anterior`` e ``arvores_novas`` as árvores existentes são mantidas (warm start) e só
+    as novas são ajustadas, desde que as classes não tenham mudado.
+    """
+    X = tabela[COLUNAS[:3]].to_numpy()
+    y = tabela["label"].to_numpy()
+    pesos = tabela["peso"].to_numpy()
+    if modelo_anterior is not None and arvores_novas > 0:
+        if set(modelo_anterior.classes_) == set(y):
+            clf = modelo_anterior
+            clf.set_params(warm_start=True, n_jobs=n_jobs, n_estimators=len(clf.estimators_) + arvores_novas)
+        else:
+            print("As classes mudaram desde o último treino; treinando todas as árvores de novo.")
+            clf = RandomForestClassifier(n_estimators=arvores, random_state=42, n_jobs=n_jobs)
+    else:
+        clf = RandomForestClassifier(n_estimators=arvores, random_state=42, n_jobs=n_jobs)
+    clf.fit(X, y, sample_weight=pesos)
+    # O backend classifica as colônias de uma imagem por chamada; paralelismo ali só adicionaria overhead
+    clf.set_params(warm_start=False, n_jobs=None)
+    return clf
 
 
 def main():
@@ -13,25 +143,89 @@ def main():
         action="store_true",
         help="Inclui dados de HSV gerados pelo backend (analysis_hsv_log.csv e feedback_data.csv)",
     )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Lê só as linhas acrescentadas desde o último checkpoint e as soma à tabela de pesos salva",
+    )
+    parser.add_argument(
+        "--arvores-novas",
+        type=int,
+        default=0,
+        help="Com --incremental, mantém as árvores do modelo salvo e ajusta só N árvores novas (warm start)",
+    )
+    parser.add_argument("--arvores", type=int, default=200, help="Número de árvores em um treino completo")
+    parser.add_argument("--n-jobs", type=int, default=-1, help="Núcleos usados no treino (-1: todos)")
+    parser.add_argument("--tamanho-bloco", type=int, default=1_000_000, help="Linhas lidas por bloco")
+    parser.add_argument("--checkpoint", help="Arquivo do checkpoint (padrão: <saida>.checkpoint)")
+    parser.add_argument("--json", help="Arquivo para salvar o relatório de leitura, treino e tamanho em JSON")
     args = parser.parse_args()
 
-    dados = pd.read_csv(args.csv)
-    if args.include_backend_data:
-        for extra in ["backend/analysis_hsv_log.csv", "backend/feedback_data.csv"]:
-            try:
-                df_extra = pd.read_csv(extra)
-                dados = pd.concat([dados, df_extra], ignore_index=True)
-            except FileNotFoundError:
-                continue
-        dados = dados.drop_duplicates()
-    X = dados[["h", "s", "v"]]
-    y = dados["label"]
-
-    clf = RandomForestClassifier(n_estimators=200, random_state=42)
-    clf.fit(X, y)
-
-    joblib.dump(clf, args.saida)
-    print(f"Modelo salvo em {args.saida}")
+    caminho_checkpoint = args.checkpoint or f"{args.saida}.checkpoint"
+    fontes = [args.csv] + ([c for c in LOGS_BACKEND if os.path.exists(c)] if args.include_backend_data else [])
+    fontes = [os.path.abspath(f) for f in fontes]
+
+    checkpoint = carregar_checkpoint(caminho_checkpoint) if args.incremental else None
+    if args.incremental and checkpoint is None:
+        print("Nenhum checkpoint encontrado; fazendo leitura completa.")
+    if checkpoint is not None:
+        encolhidos = [f for f in fontes if os.path.getsize(f) < checkpoint["fontes"].get(f, 0)]
+        if encolhidos:
+            # Arquivo substituído ou truncado: não dá para saber quais linhas saíram da tabela
+            print(f"Arquivos menores que no checkpoint ({', '.join(encolhidos)}); refazendo a leitura completa.")
+            checkpoint = None
+    offsets = dict(checkpoint["fontes"]) if checkpoint is not None else {}
+
+    inicio = time.perf_counter()
+    parciais = [checkpoint["tabela"]] if checkpoint is not None else []
+    linhas_lidas = 0
+    for fonte in fontes:
+        tabela_fonte, linhas, offsets[fonte] = ler_fonte(fonte, offsets.get(fonte, 0), args.tamanho_bloco)
+        parciais.append(tabela_fonte)
+        linhas_lidas += linhas
+    tabela = agregar(parciais)
+    tempo_leitura = time.perf_counter() - inicio
+    if tabela.empty:
+        parser.error("Nenhuma linha válida para treinar.")
+    print(f"Leitura: {linhas_lidas} linhas novas em {tempo_leitura:.2f}s "
+          f"({linhas_lidas / max(tempo_leitura, 1e-9):,.0f} linhas/s); "
+          f"{len(tabela)} combinações (h, s, v, label) distintas, {int(tabela['peso'].sum())} amostras no total")
+
+    modelo_anterior = None
+    if checkpoint is not None and args.arvores_novas > 0 and os.path.exists(args.saida):
+        modelo_anterior = joblib.load(args.saida)
+    if checkpoint is not None and linhas_lidas == 0 and os.path.exists(args.saida):
+        print("Nenhuma linha nova desde o último checkpoint; modelo mantido.")
+        return
+
+    inicio = time.perf_counter()
+    clf = treinar(tabela, args.arvores, args.n_jobs, modelo_anterior, args.arvores_novas)
+    tempo_treino = time.perf_counter() - inicio
+    arvores_ajustadas = args.arvores_novas if clf is modelo_anterior else len(clf.estimators_)
+    print(f"Treino: {arvores_ajustadas} árvores ajustadas ({len(clf.estimators_)} no modelo) em {tempo_treino:.2f}s "
+          f"com n_jobs={args.n_jobs} ({len(tabela) / max(tempo_treino, 1e-9):,.0f} combinações/s, "
+          f"{tabela['peso'].sum() / max(tempo_treino, 1e-9):,.0f} amostras/s)")
+
+    salvar(clf, args.saida)
+    salvar({"versao": VERSAO_CHECKPOINT, "fontes": offsets, "tabela": tabela}, caminho_checkpoint)
+    tamanho_mb = os.path.getsize(args.saida) / 1024 / 1024
+    nos = sum(arvore.tree_.node_count for arvore in clf.estimators_)
+    print(f"Modelo salvo em {args.saida} ({tamanho_mb:.2f} MB, {nos} nós); checkpoint em {caminho_checkpoint}")
+
+    if args.json:
+        relatorio = {
+            "linhas_lidas": linhas_lidas,
+            "combinacoes_distintas": len(tabela),
+            "amostras": int(tabela["peso"].sum()),
+            "leitura_s": round(tempo_leitura, 3),
+            "treino_s": round(tempo_treino, 3),
+            "arvores_ajustadas": arvores_ajustadas,
+            "arvores": len(clf.estimators_),
+            "nos": int(nos),
+            "tamanho_modelo_mb": round(tamanho_mb, 3),
+        }
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(relatorio, f, indent=2)
 
 
 if __name__ == "__main__":
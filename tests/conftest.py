@@ -0,0 +1,47 @@
+import os
+import sys
+
+import pytest
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(RAIZ, "backend"))
+sys.path.insert(0, os.path.join(RAIZ, "scripts"))
+
+# Carga síncrona: os testes não devem depender de quando o modelo de cor termina de carregar
+os.environ.setdefault("COLOR_MODEL_BACKGROUND_LOAD", "0")
+
+import main  # noqa: E402
+from synthetic_plates import codificar, gerar_placa  # noqa: E402
+
+# (semente, deslocamento da placa em fração da imagem, sobreposição)
+PLACAS = [
+    (1, (0.0, 0.0), 0.0),
+    (2, (0.0, 0.0), 0.3),
+    (3, (0.12, -0.08), 0.2),
+    (4, (-0.2, 0.15), 0.3),
+]
+
+
+@pytest.fixture(scope="session", params=PLACAS, ids=lambda p: f"semente{p[0]}")
+def placa_sintetica(request):
+    """Imagem JPEG de uma placa sintética e a placa verdadeira (cx, cy, r)."""
+    semente, deslocamento, sobreposicao = request.param
+    img, verdade = gerar_placa(
+        semente, 800, 600, 80, sobreposicao=sobreposicao, deslocamento_placa=deslocamento,
+        mistura_cores={"amarela": 2, "rosada": 1, "clara": 1, "bege": 1},
+    )
+    return codificar(img), verdade["placa"]
+
+
+@pytest.fixture
+def capturar_marcadores(monkeypatch):
+    """Guarda os marcadores e o deslocamento de cada chamada de extrair_estatisticas_colonias."""
+    capturados = []
+    original = main.extrair_estatisticas_colonias
+
+    def extrair(markers, img, deslocamento=(0, 0)):
+        capturados.append((markers.copy(), deslocamento))
+        return original(markers, img, deslocamento=deslocamento)
+
+    monkeypatch.setattr(main, "extrair_estatisticas_colonias", extrair)
+    return capturados
@@ -0,0 +1,43 @@
+"""A segmentação em blocos (alta_resolucao) deve contar igual à segmentação num bloco só."""
+import pytest
+
+import main
+from synthetic_plates import codificar, gerar_placa
+
+
+@pytest.fixture(scope="module", params=[1, 2], ids=lambda s: f"semente{s}")
+def placa_grande(request):
+    img, verdade = gerar_placa(
+        request.param, 2400, 1800, 200, raio_colonia=(12, 24), sobreposicao=0.2,
+        mistura_cores={"amarela": 1, "rosada": 1},
+    )
+    return codificar(img), verdade["placa"]
+
+
+def contar(imagem_bytes, placa):
+    resumo, _, headers, colony_data = main.processar_imagem(
+        imagem_bytes, "teste", placa["cx"], placa["cy"], placa["r"], alta_resolucao=True, renderizar=False
+    )
+    return resumo, headers, sorted((c["cx"], c["cy"], c["r"]) for c in colony_data)
+
+
+def test_blocos_igual_a_bloco_unico(placa_grande, monkeypatch):
+    imagem_bytes, placa = placa_grande
+    quantidades = []
+    blocos_segmentacao = main.blocos_segmentacao
+
+    def registrar_blocos(*args):
+        quantidades.append(len(blocos_segmentacao(*args)))
+        return blocos_segmentacao(*args)
+
+    monkeypatch.setattr(main, "blocos_segmentacao", registrar_blocos)
+    monkeypatch.setattr(main, "TILE_SIZE", 512)
+    blocos = contar(imagem_bytes, placa)
+    assert quantidades[-1] > 4
+
+    monkeypatch.setattr(main, "TILE_SIZE", 100000)
+    unico = contar(imagem_bytes, placa)
+    assert quantidades[-1] == 1
+
+    assert blocos[0] == unico[0]
+    assert blocos[2] == unico[2]
@@ -0,0 +1,121 @@
+"""Regressão da extração vetorizada contra o laço por marcador original de processar_imagem."""
+from collections import Counter
+
+import cv2
+import numpy as np
+import pytest
+
+import main
+
+PARAMETROS = [
+    {},
+    {"area_min": 30.0, "circularidade_min": 0.6, "max_colony_size_factor": 0.05},
+    {"area_min": 0.0, "circularidade_min": 0.0, "max_colony_size_factor": 1.0},
+    {"area_min": 5.0, "circularidade_min": 0.8, "max_colony_size_factor": 0.1, "local_max_filter_size": 5},
+    {"thresh_block_size": 61, "thresh_c": 2, "local_max_filter_size": 9},
+]
+
+
+def laco_original(markers, img, x, y, r_margem_calculada, area_min=10.0, circularidade_min=0.40,
+                  max_colony_size_factor=main.MAX_COLONY_RADIUS_FACTOR_OF_PETRI_MARGIN):
+    """Laço por marcador de processar_imagem antes da vetorização, sem o desenho e a classificação."""
+    total_avaliadas = 0
+    total_filtradas_area = 0
+    total_filtradas_circularidade = 0
+    total_filtradas_tamanho_maximo = 0
+    colonias = []
+    circularidades = []
+    AREA_MIN_COLONIA = float(area_min)
+    AREA_MAX_COLONIA = np.pi * (r_margem_calculada**2) * 0.05
+    CIRCULARIDADE_MIN = float(circularidade_min)
+    for marker_val in np.unique(markers):
+        if marker_val <= 1:
+            continue
+        mask_colonia = np.zeros(markers.shape, dtype=np.uint8)
+        mask_colonia[markers == marker_val] = 255
+        contours, _ = cv2.findContours(mask_colonia, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        if not contours:
+            continue
+        cnt = max(contours, key=cv2.contourArea)
+        area = cv2.contourArea(cnt)
+        total_avaliadas += 1
+        if area < AREA_MIN_COLONIA or area > AREA_MAX_COLONIA:
+            total_filtradas_area += 1
+            continue
+        perimeter = cv2.arcLength(cnt, True)
+        if perimeter < main.MIN_PERIMETER_THRESHOLD:
+            total_filtradas_circularidade += 1
+            continue
+        circularity = 4 * np.pi * (area / (perimeter * perimeter))
+        circularidades.append(circularity)
+        if circularity < CIRCULARIDADE_MIN:
+            total_filtradas_circularidade += 1
+            continue
+        (cx, cy), radius_colonia_float = cv2.minEnclosingCircle(cnt)
+        center_colonia = (int(cx), int(cy))
+        if np.linalg.norm(np.array(center_colonia) - np.array((x, y))) > r_margem_calculada:
+            continue
+        if radius_colonia_float > (r_margem_calculada * float(max_colony_size_factor)):
+            total_filtradas_tamanho_maximo += 1
+            continue
+        mean_color_bgr = cv2.mean(img, mask=mask_colonia)[:3]
+        hsv_pixel = cv2.cvtColor(np.uint8([[mean_color_bgr]]), cv2.COLOR_BGR2HSV)[0][0]
+        colonias.append({
+            "h": int(hsv_pixel[0]),
+            "s": int(hsv_pixel[1]),
+            "v": int(hsv_pixel[2]),
+            "cx": center_colonia[0],
+            "cy": center_colonia[1],
+            "r": int(radius_colonia_float),
+        })
+    contadores = {
+        "X-Feedback-Avaliadas": str(total_avaliadas),
+        "X-Feedback-Filtradas-Area": str(total_filtradas_area),
+        "X-Feedback-Filtradas-Circularidade": str(total_filtradas_circularidade),
+        "X-Feedback-Filtradas-Tamanho-Maximo": str(total_filtradas_tamanho_maximo),
+        "X-Feedback-Desenhadas": str(len(colonias)),
+    }
+    return contadores, colonias, circularidades
+
+
+def contar_e_comparar(imagem_bytes, capturados, x_manual=None, y_manual=None, r_manual=None, **parametros):
+    """Roda processar_imagem e o laço original nos mesmos marcadores; retorna as circularidades do original."""
+    img, gray, altura_orig, largura_orig = main.decodificar_imagem(imagem_bytes, "teste")
+    x, y, r, _ = main.localizar_placa(gray, altura_orig, largura_orig, "teste", x_manual, y_manual, r_manual)
+
+    capturados.clear()
+    resumo, _, headers, colony_data = main.processar_imagem(
+        imagem_bytes, "teste", x_manual, y_manual, r_manual, renderizar=False, **parametros
+    )
+    assert len(capturados) == 1
+    # Os marcadores vêm do recorte da placa; o laço original percorria a imagem inteira
+    recorte, (x0, y0) = capturados[0]
+    markers = np.zeros(gray.shape, dtype=np.int32)
+    markers[y0:y0 + recorte.shape[0], x0:x0 + recorte.shape[1]] = recorte
+
+    filtros = {k: v for k, v in parametros.items() if k in ("area_min", "circularidade_min", "max_colony_size_factor")}
+    contadores, colonias, circularidades = laco_original(markers, img, x, y, int(r * 0.90), **filtros)
+
+    assert {k: headers[k] for k in contadores} == contadores
+    assert [{k: c[k] for k in ("h", "s", "v", "cx", "cy", "r")} for c in colony_data] == colonias
+    hsv = np.array([[c["h"], c["s"], c["v"]] for c in colonias], dtype=np.uint8)
+    assert [c["pred"] for c in colony_data] == main.classificar_cores(hsv)
+    assert resumo == {**Counter(c["pred"] for c in colony_data), "total": len(colonias)}
+    return circularidades
+
+
+@pytest.mark.parametrize("parametros", PARAMETROS)
+@pytest.mark.parametrize("circulo", ["automatico", "manual"])
+def test_extracao_igual_ao_laco_original(placa_sintetica, capturar_marcadores, circulo, parametros):
+    imagem_bytes, placa = placa_sintetica
+    manual = (placa["cx"], placa["cy"], placa["r"]) if circulo == "manual" else ()
+    contar_e_comparar(imagem_bytes, capturar_marcadores, *manual, **parametros)
+
+
+def test_limite_de_circularidade(placa_sintetica, capturar_marcadores):
+    """Com circularidade_min igual à circularidade de uma colônia, ela é mantida como no laço original."""
+    imagem_bytes, _ = placa_sintetica
+    circularidades = contar_e_comparar(imagem_bytes, capturar_marcadores, circularidade_min=0.0)
+    limite = float(np.median(circularidades))
+    contar_e_comparar(imagem_bytes, capturar_marcadores, circularidade_min=limite)
+    contar_e_comparar(imagem_bytes, capturar_marcadores, circularidade_min=float(np.nextafter(limite, np.inf)))
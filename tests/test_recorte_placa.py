@@ -0,0 +1,68 @@
+"""O recorte da placa (margem_recorte/recorte_placa) deve contar igual à segmentação na imagem inteira."""
+import pytest
+
+import main
+from synthetic_plates import codificar, gerar_placa
+
+# (deslocamento da placa em fração da imagem, raio em fração do menor lado)
+PLACAS = {
+    "centralizada": ((0.0, 0.0), 0.45),
+    "descentralizada": ((0.18, -0.12), 0.35),
+    "cortada_pela_borda": ((0.3, 0.2), 0.45),
+}
+
+PARAMETROS = [
+    {},
+    {"local_max_filter_size": 6},
+    {"local_max_filter_size": 12, "thresh_block_size": 101},
+    {"thresh_block_size": 151, "thresh_c": 1},
+    {"thresh_c": 0},
+    {"thresh_c": -3, "local_max_filter_size": 4},
+]
+
+
+@pytest.fixture(scope="module", params=list(PLACAS), ids=str)
+def placa(request):
+    deslocamento, raio = PLACAS[request.param]
+    img, verdade = gerar_placa(
+        7, 800, 600, 80, sobreposicao=0.3, deslocamento_placa=deslocamento, raio_placa_frac=raio,
+        mistura_cores={"amarela": 2, "rosada": 1, "clara": 1},
+    )
+    return request.param, codificar(img), verdade["placa"]
+
+
+def contar(imagem_bytes, manual, parametros):
+    resumo, _, headers, colony_data = main.processar_imagem(
+        imagem_bytes, "teste", *manual, renderizar=False, **parametros
+    )
+    return resumo, headers, colony_data
+
+
+@pytest.mark.parametrize("parametros", PARAMETROS)
+@pytest.mark.parametrize("circulo", ["automatico", "manual"])
+def test_recorte_igual_a_imagem_inteira(placa, monkeypatch, circulo, parametros):
+    nome, imagem_bytes, verdade = placa
+    manual = (verdade["cx"], verdade["cy"], verdade["r"]) if circulo == "manual" else ()
+
+    recortes = []
+    recorte_placa = main.recorte_placa
+
+    def registrar_recorte(*args):
+        recortes.append(recorte_placa(*args))
+        return recortes[-1]
+
+    monkeypatch.setattr(main, "recorte_placa", registrar_recorte)
+    recortado = contar(imagem_bytes, manual, parametros)
+    if parametros.get("thresh_c", 4) > 0:
+        y0, y1, x0, x1 = recortes[-1]
+        assert (y1 - y0) * (x1 - x0) < 800 * 600 or nome == "cortada_pela_borda"
+    else:
+        assert not recortes
+
+    monkeypatch.setattr(main, "recorte_placa", lambda shape, *args: (0, shape[0], 0, shape[1]))
+    inteira = contar(imagem_bytes, manual, parametros)
+
+    assert recortado[0] == inteira[0]
+    assert recortado[1] == inteira[1]
+    assert recortado[2] == inteira[2]
+    assert int(recortado[1]["X-Feedback-Desenhadas"]) > 0